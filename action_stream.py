@@ -0,0 +1,144 @@
+import json
+import re
+
+THINK_END = "</think>"
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+class ActionStreamParser:
+    """
+    Incremental parser for a JSON array of actions arriving in chunks.
+
+    feed() takes the next piece of streamed model output and returns the
+    actions whose objects were closed by it, so they can be validated and
+    shown while the rest is still being generated. Reasoning before a
+    </think> tag and a leading markdown code fence are skipped. A single
+    object instead of an array is accepted, like json.loads on the full
+    output would.
+
+    Every character is scanned once; only the text of complete objects is
+    handed to json.loads.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.actions = []
+        self._start = None      # Index of the '[' or '{' that opens the output
+        self._pos = 0           # Next character to scan
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._object_start = None
+        self._done = False
+        self._text_start = 0    # Start of the text after the last </think>
+        self._searched = 0      # End of the text already searched for </think>
+        self._thought_ended = False
+
+    @property
+    def done(self):
+        """
+        True once the top-level array (or single object) is closed.
+        """
+        return self._done
+
+    def _skip_whitespace(self, pos):
+        return _WHITESPACE.match(self.buffer, pos).end()
+
+    def _find_start(self):
+        # Reasoning comes before the answer; look for a </think> in the new text only
+        search_from = max(0, self._searched - len(THINK_END) + 1)
+        end_of_thought = self.buffer.rfind(THINK_END, search_from)
+        if end_of_thought != -1:
+            self._text_start = end_of_thought + len(THINK_END)
+            self._thought_ended = True
+        self._searched = len(self.buffer)
+
+        pos = self._skip_whitespace(self._text_start)
+        rest = self.buffer[pos:pos + len("<think>")]
+        if "```".startswith(rest) or "<think>".startswith(rest):
+            return False  # Fence or tag not complete yet
+        if self.buffer.startswith("```", pos):
+            newline = self.buffer.find("\n", pos)
+            if newline == -1:
+                return False
+            pos = self._skip_whitespace(newline + 1)
+        if pos == len(self.buffer) or self.buffer.startswith("<think>", pos):
+            return False
+        if self.buffer[pos] not in "[{":
+            if not self._thought_ended:
+                # Possibly reasoning without an opening tag; wait for </think>
+                return False
+            raise ValueError(f"Expected a JSON array, got: {self.buffer[pos:pos + 40]!r}")
+
+        self._start = pos
+        self._pos = pos
+        return True
+
+    def feed(self, text):
+        """
+        Add the next chunk of model output.
+
+        :param text: Chunk of the streamed completion.
+        :return: List of the actions completed by this chunk.
+        """
+        self.buffer += text
+        if self._done or (self._start is None and not self._find_start()):
+            return []
+
+        completed = []
+        buffer = self.buffer
+        for pos in range(self._pos, len(buffer)):
+            char = buffer[pos]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+                # Actions are the objects directly inside the array, or the single top-level object
+                if char == "{" and self._object_start is None and (
+                        self._depth == 2 and buffer[self._start] == "[" or self._depth == 1):
+                    self._object_start = pos
+            elif char in "]}":
+                self._depth -= 1
+                if char == "}" and self._object_start is not None and self._depth == (1 if buffer[self._start] == "[" else 0):
+                    action = json.loads(buffer[self._object_start:pos + 1])
+                    self._object_start = None
+                    self.actions.append(action)
+                    completed.append(action)
+                if self._depth == 0:
+                    self._done = True
+                    self._pos = pos + 1
+                    return completed
+        self._pos = len(buffer)
+        return completed
+
+    def close(self):
+        """
+        Check that the output was complete.
+
+        :return: All parsed actions.
+        :raises ValueError: If the output ended before the array was closed.
+        """
+        if not self._done:
+            raise ValueError("Model output ended before the JSON array was closed")
+        return self.actions
+
+
+def parse_actions(text):
+    """
+    Parse a complete model output with ActionStreamParser.
+
+    :return: List of actions.
+    """
+    parser = ActionStreamParser()
+    parser.feed(text)
+    return parser.close()
@@ -1,20 +1,59 @@
 import requests
 from bunq.sdk.context.api_context import ApiContext
 from bunq.sdk.context.bunq_context import BunqContext
-from bunq import ApiEnvironmentType
+from bunq import ApiEnvironmentType, Pagination
 from bunq.sdk.model.generated.endpoint import (
     MonetaryAccountBankApiObject,
     MonetaryAccountApiObject,
     PaymentApiObject,
+    PaymentBatchApiObject,
     RequestInquiryApiObject,
     RequestResponseApiObject,
 )
 from bunq.sdk.model.generated.object_ import AmountObject, PointerObject
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 import time
 import os
+import sys
+
+# The history modules import each other by bare name (e.g. resilience), so they
+# are imported that way here too. Importing one as history.<name> as well would
+# load a second copy, with its own circuit breakers and rate limit buckets.
+# Appended, so the root modules (this api.py) keep precedence over history/api.py.
+HISTORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history")
+if HISTORY_DIR not in sys.path:
+    sys.path.append(HISTORY_DIR)
+
+from resilience import call_with_retry, idempotency_headers, load_api_context
+from pending_requests import PendingRequestIndex
 
 BUNQ_HOST = "https://public-api.sandbox.bunq.com"  # or your desired default host
 
+# Payments sent per payment-batch call
+PAYMENT_BATCH_SIZE = 100
+
+# Accounts fetched per page when listing a user's monetary accounts
+ACCOUNT_PAGE_SIZE = 200
+
+# Payments fetched per page when looking for the payments of a failed payment-batch call
+PAYMENT_PAGE_SIZE = 200
+
+
+class PaymentBatchOutcomeUnknown(Exception):
+    """
+    A payment-batch call failed, and the account's payments couldn't show
+    whether bunq executed it anyway. Its payments must not be sent again.
+    """
+
+def _post_checked(url):
+    """
+    POST to a URL and raise requests.HTTPError on an error status, so it can be retried.
+    """
+    response = requests.post(url)
+    response.raise_for_status()
+    return response
+
 def create_user_and_save_context():
     """
     Creates a new sandbox user by requesting an API key, then creates installation, device registration,
@@ -23,8 +62,7 @@ def create_user_and_save_context():
     """
     # Step 1: Get API key by creating a new sandbox user
     url = f"{BUNQ_HOST}/v1/sandbox-user-person"
-    response = requests.post(url)
-    response.raise_for_status()
+    response = call_with_retry("POST sandbox-user-person", _post_checked, url)
     api_key = response.json()["Response"][0]["ApiKey"]["api_key"]
     user_id = response.json()["Response"][0]["ApiKey"]["user"]["UserPerson"]["id"]
 
@@ -33,9 +71,9 @@ def create_user_and_save_context():
     context_filename = f"contexts/{user_id}.json"
 
     # Step 2: Create API context for sandbox
-    api_context = ApiContext.create(ApiEnvironmentType.SANDBOX, api_key, f"User {user_id}")
+    api_context = call_with_retry("POST session-server", ApiContext.create, ApiEnvironmentType.SANDBOX, api_key, f"User {user_id}")
     api_context.save(context_filename)
-    BunqContext.load_api_context(api_context)
+    load_api_context(api_context)
 
     # Step 3: Get user context using BunqContext
     user_context = BunqContext.user_context()
@@ -55,11 +93,14 @@ def create_monetary_account_for_user(user_id: int, currency: str = "EUR"):
     """
     context_filename = f"contexts/{user_id}.json"
     api_context = ApiContext.restore(context_filename)
-    BunqContext.load_api_context(api_context)
+    load_api_context(api_context)
 
     # Create the monetary account
-    account = MonetaryAccountBankApiObject.create(
-        currency
+    account = call_with_retry(
+        "POST monetary-account-bank",
+        MonetaryAccountBankApiObject.create,
+        currency,
+        custom_headers=idempotency_headers()
     )
     # Get the id of the newly created account
     account_id = account.value
@@ -70,6 +111,36 @@ def create_monetary_account_for_user(user_id: int, currency: str = "EUR"):
 
     return account_id
 
+def create_monetary_accounts_for_user(user_id: int, currencies):
+    """
+    Creates several monetary accounts for the user with a single context load.
+    A failed creation doesn't stop the others.
+    :param user_id: The user id.
+    :param currencies: Currency of every account to create.
+    :return: List with the id of every created account, or the exception that prevented it.
+    """
+    context_filename = f"contexts/{user_id}.json"
+    api_context = ApiContext.restore(context_filename)
+    load_api_context(api_context)
+
+    results = []
+    for currency in currencies:
+        try:
+            account = call_with_retry(
+                "POST monetary-account-bank",
+                MonetaryAccountBankApiObject.create,
+                currency,
+                custom_headers=idempotency_headers()
+            )
+            results.append(account.value)
+        except Exception as e:
+            results.append(e)
+
+    BunqContext._api_context = None
+    BunqContext._user_context = None
+
+    return results
+
 def create_payment(
     user_id: int,
     monetary_account_id: int,
@@ -84,9 +155,11 @@ def create_payment(
     """
     context_filename = f"contexts/{user_id}.json"
     api_context = ApiContext.restore(context_filename)
-    BunqContext.load_api_context(api_context)
+    load_api_context(api_context)
 
-    payment = PaymentApiObject.create(
+    payment = call_with_retry(
+        "POST payment",
+        PaymentApiObject.create,
         {"value": amount_value, "currency": amount_currency},
         {
             "type": counterparty_alias.type_,
@@ -94,7 +167,8 @@ def create_payment(
             "name": counterparty_alias.name
         },
         description,
-        monetary_account_id
+        monetary_account_id,
+        custom_headers=idempotency_headers()
     )
     # Get the id of the newly created payment
     payment_id = payment.value
@@ -103,6 +177,123 @@ def create_payment(
     BunqContext._user_context = None
     return payment_id
 
+def _newest_payment_id(monetary_account_id: int):
+    """
+    :return: The id of the newest payment of a monetary account, or None if it has none.
+    """
+    pagination = Pagination()
+    pagination.count = 1
+    payments = call_with_retry("GET payment", PaymentApiObject.list, monetary_account_id, params=pagination.url_params_count_only).value
+    return payments[0].id_ if payments else None
+
+def _payments_since(monetary_account_id: int, newest_payment_id):
+    """
+    :return: The payments of a monetary account newer than newest_payment_id
+             (all of them if it is None).
+    """
+    pagination = Pagination()
+    pagination.count = PAYMENT_PAGE_SIZE
+    if newest_payment_id is None:
+        response = call_with_retry("GET payment", PaymentApiObject.list, monetary_account_id, params=pagination.url_params_count_only)
+        payments = list(response.value)
+        while response.pagination.has_next_page_assured():
+            response = call_with_retry("GET payment", PaymentApiObject.list, monetary_account_id, params=response.pagination.url_params_next_page)
+            payments.extend(response.value)
+        return payments
+
+    pagination.newer_id = newest_payment_id
+    response = call_with_retry("GET payment", PaymentApiObject.list, monetary_account_id, params=pagination.url_params_previous_page)
+    payments = list(response.value)
+    while response.value and response.pagination.has_previous_page():
+        response = call_with_retry("GET payment", PaymentApiObject.list, monetary_account_id, params=response.pagination.url_params_previous_page)
+        payments.extend(response.value)
+    return payments
+
+def _payment_key(amount_value, counterparty_iban, description):
+    return abs(Decimal(str(amount_value))), counterparty_iban, description
+
+def _find_executed_batch(monetary_account_id: int, chunk, newest_payment_id, known_batch_ids):
+    """
+    Looks for a payment batch made since newest_payment_id with exactly the
+    payments of a chunk, e.g. one whose response was lost after bunq executed it.
+    :param chunk: List of (amount value, amount currency, counterparty alias, description) tuples.
+    :param known_batch_ids: Ids of batches already accounted for, which are skipped.
+    :return: The id of the matching batch, or None.
+    """
+    expected = sorted(
+        _payment_key(amount_value, counterparty_alias.value, description)
+        for amount_value, _, counterparty_alias, description in chunk
+    )
+    batches = {}
+    for payment in _payments_since(monetary_account_id, newest_payment_id):
+        batch_id = getattr(payment, "batch_id", None)
+        if batch_id is None or batch_id in known_batch_ids:
+            continue
+        counterparty_iban = getattr(payment.counterparty_alias, "iban", None)
+        batches.setdefault(batch_id, []).append(_payment_key(payment.amount.value, counterparty_iban, payment.description))
+    for batch_id, made in batches.items():
+        if sorted(made) == expected:
+            return batch_id
+    return None
+
+def create_payment_batch(user_id: int, monetary_account_id: int, payments):
+    """
+    Sends several payments from one monetary account with payment-batch calls
+    of up to PAYMENT_BATCH_SIZE payments each. A failed call doesn't stop the
+    others; bunq rejects a batch as a whole, so none of its payments were made.
+    A call can also fail after bunq executed it (e.g. a timeout or a 5xx after
+    commit), so the account's payments are checked for the batch before a
+    failure is reported.
+    :param user_id: The user id.
+    :param monetary_account_id: The id of the monetary account to pay from.
+    :param payments: List of (amount value, amount currency, counterparty alias, description) tuples.
+    :return: List with the payment batch id of every call, or the exception that
+             made it fail: PaymentBatchOutcomeUnknown if the check itself failed,
+             otherwise none of the call's payments were made.
+    """
+    context_filename = f"contexts/{user_id}.json"
+    api_context = ApiContext.restore(context_filename)
+    load_api_context(api_context)
+
+    results = []
+    try:
+        # Payments newer than this one are looked through when a call fails
+        newest_payment_id = _newest_payment_id(monetary_account_id)
+        for start in range(0, len(payments), PAYMENT_BATCH_SIZE):
+            chunk = payments[start:start + PAYMENT_BATCH_SIZE]
+            batch = [
+                PaymentApiObject(
+                    amount=AmountObject(amount_value, amount_currency),
+                    counterparty_alias=PointerObject(counterparty_alias.type_, counterparty_alias.value, counterparty_alias.name),
+                    description=description
+                )
+                for amount_value, amount_currency, counterparty_alias, description in chunk
+            ]
+            try:
+                results.append(call_with_retry(
+                    "POST payment-batch",
+                    PaymentBatchApiObject.create,
+                    batch,
+                    monetary_account_id,
+                    custom_headers=idempotency_headers()
+                ).value)
+            except Exception as e:
+                known_batch_ids = {result for result in results if not isinstance(result, Exception)}
+                try:
+                    batch_id = _find_executed_batch(monetary_account_id, chunk, newest_payment_id, known_batch_ids)
+                except Exception as check_error:
+                    results.append(PaymentBatchOutcomeUnknown(f"{e}; checking for its payments failed: {check_error}"))
+                    continue
+                if batch_id is not None:
+                    print(f"Payment batch call failed ({e}), but its payments were made as batch {batch_id}")
+                    results.append(batch_id)
+                else:
+                    results.append(e)
+    finally:
+        BunqContext._api_context = None
+        BunqContext._user_context = None
+    return results
+
 def create_payment_request(
     user_id: int,
     monetary_account_id: int,
@@ -117,16 +308,19 @@ def create_payment_request(
     """
     context_filename = f"contexts/{user_id}.json"
     api_context = ApiContext.restore(context_filename)
-    BunqContext.load_api_context(api_context)
+    load_api_context(api_context)
 
     amount_obj = AmountObject(amount_value, amount_currency)
 
-    request = RequestInquiryApiObject.create(
+    request = call_with_retry(
+        "POST request-inquiry",
+        RequestInquiryApiObject.create,
         amount_obj,
         counterparty_alias,
         description,
         False,  # allow_bunqme
-        monetary_account_id
+        monetary_account_id,
+        custom_headers=idempotency_headers()
     )
     # Get the id of the newly created request
     request_id = request.value
@@ -135,40 +329,126 @@ def create_payment_request(
     BunqContext._user_context = None
     return request_id
 
+# Pending request indexes per (user id, monetary account id)
+_pending_request_indexes = {}
+
+
+def _pending_request_index(user_id: int, monetary_account_id: int):
+    """
+    Return the refreshed PendingRequestIndex of an account. Needs the owner's API context to be loaded.
+    """
+    index = _pending_request_indexes.get((user_id, monetary_account_id))
+    if index is None:
+        index = PendingRequestIndex(monetary_account_id)
+        _pending_request_indexes[(user_id, monetary_account_id)] = index
+    index.refresh()
+    return index
+
+
+def _respond_to_pending_requests(index, counterparty_iban: str, status: str, max_workers: int):
+    """
+    Responds to the indexed pending requests from a counterparty IBAN concurrently.
+    Needs the owner's API context to be loaded.
+    :return: List of ids of updated request objects.
+    """
+    monetary_account_id = index.monetary_account_id
+    request_ids = index.pop(counterparty_iban)
+
+    def update(request_id):
+        """
+        :return: True if the request was updated, False if it turned out to be
+                 settled already. Raises if it is still pending.
+        """
+        try:
+            call_with_retry(
+                "PUT request-response",
+                RequestResponseApiObject.update,
+                request_id,
+                monetary_account_id,
+                status=status,
+            )
+            return True
+        except Exception as e:
+            print(f"Error responding to payment request {request_id}: {e}")
+            request = call_with_retry(
+                "GET request-response",
+                RequestResponseApiObject.get,
+                request_id,
+                monetary_account_id,
+            ).value
+            if request.status == "PENDING":
+                raise
+            return False
+
+    # All updates use the same user's context, so they can share the loaded one
+    updated_request_ids = []
+    failed_request_ids = []
+    if request_ids:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(request_ids))) as pool:
+            futures = [pool.submit(update, request_id) for request_id in request_ids]
+            for request_id, future in zip(request_ids, futures):
+                try:
+                    if future.result():
+                        updated_request_ids.append(request_id)
+                except Exception:
+                    failed_request_ids.append(request_id)
+    # Still pending, so a later response can retry them
+    index.restore(counterparty_iban, failed_request_ids)
+    return updated_request_ids
+
+
 def respond_to_payment_request(
     user_id: int,
     monetary_account_id: int,
     counterparty_iban: str,
-    status: str
+    status: str,
+    max_workers: int = 4
 ):
     """
     Responds to all pending payment requests received from a specific counterparty IBAN.
+    The pending requests are looked up in an incrementally refreshed
+    PendingRequestIndex, and multiple matches are updated concurrently.
     :param user_id: The user id.
     :param monetary_account_id: The id of the monetary account.
     :param counterparty_iban: The IBAN alias of the counterparty who sent the request.
     :param status: The status to set ("ACCEPTED" or "REJECTED").
+    :param max_workers: Maximum number of concurrent updates.
     :return: List of ids of updated request objects.
     """
     context_filename = f"contexts/{user_id}.json"
     api_context = ApiContext.restore(context_filename)
-    BunqContext.load_api_context(api_context)
-    request_responses = RequestResponseApiObject.list(monetary_account_id).value
+    load_api_context(api_context)
 
-    updated_request_ids = []
+    try:
+        index = _pending_request_index(user_id, monetary_account_id)
+        return _respond_to_pending_requests(index, counterparty_iban.value, status, max_workers)
+    finally:
+        BunqContext._api_context = None
+        BunqContext._user_context = None
 
-    for request in request_responses:
-        sender = request.counterparty_alias.pointer
-        if sender and request.status == "PENDING" and sender.type_ == "IBAN" and sender.value == counterparty_iban.value:
-            RequestResponseApiObject.update(
-                request.id_,
-                monetary_account_id,
-                status=status,
-            )
-            updated_request_ids.append(request.id_)
 
-    BunqContext._api_context = None
-    BunqContext._user_context = None
-    return updated_request_ids
+def reject_pending_payment_requests(user_id: int, monetary_account_id: int, max_workers: int = 4):
+    """
+    Rejects all pending payment requests received on a monetary account, e.g.
+    the ones left over by an earlier deploy of a scenario.
+    :param user_id: The user id.
+    :param monetary_account_id: The id of the monetary account.
+    :param max_workers: Maximum number of concurrent updates.
+    :return: List of ids of rejected request objects.
+    """
+    context_filename = f"contexts/{user_id}.json"
+    api_context = ApiContext.restore(context_filename)
+    load_api_context(api_context)
+
+    rejected_request_ids = []
+    try:
+        index = _pending_request_index(user_id, monetary_account_id)
+        for counterparty_iban in list(index.pending_by_iban):
+            rejected_request_ids += _respond_to_pending_requests(index, counterparty_iban, "REJECTED", max_workers)
+    finally:
+        BunqContext._api_context = None
+        BunqContext._user_context = None
+    return rejected_request_ids
 
 def list_monetary_accounts_for_user(user_id: int):
     """
@@ -178,14 +458,37 @@ def list_monetary_accounts_for_user(user_id: int):
     """
     context_filename = f"contexts/{user_id}.json"
     api_context = ApiContext.restore(context_filename)
-    BunqContext.load_api_context(api_context)
+    load_api_context(api_context)
 
-    accounts = MonetaryAccountApiObject.list().value
+    pagination = Pagination()
+    pagination.count = ACCOUNT_PAGE_SIZE
+    response = call_with_retry("GET monetary-account", MonetaryAccountApiObject.list, params=pagination.url_params_count_only)
+    accounts = list(response.value)
+    while response.pagination.has_next_page_assured():
+        response = call_with_retry("GET monetary-account", MonetaryAccountApiObject.list, params=response.pagination.url_params_next_page)
+        accounts.extend(response.value)
 
     BunqContext._api_context = None
     BunqContext._user_context = None
     return accounts
 
+def list_payments(user_id: int, monetary_account_id: int):
+    """
+    Lists the most recent payments of a monetary account.
+    :param user_id: The user id.
+    :param monetary_account_id: The id of the monetary account.
+    :return: List of payments, newest first.
+    """
+    context_filename = f"contexts/{user_id}.json"
+    api_context = ApiContext.restore(context_filename)
+    load_api_context(api_context)
+
+    payments = call_with_retry("GET payment", PaymentApiObject.list, monetary_account_id).value
+
+    BunqContext._api_context = None
+    BunqContext._user_context = None
+    return payments
+
 def get_account(user_id: int, monetary_account_id: int):
     """
     Returns the details of a specific monetary account for the given user.
@@ -195,9 +498,9 @@ def get_account(user_id: int, monetary_account_id: int):
     """
     context_filename = f"contexts/{user_id}.json"
     api_context = ApiContext.restore(context_filename)
-    BunqContext.load_api_context(api_context)
+    load_api_context(api_context)
 
-    account = MonetaryAccountApiObject.get(monetary_account_id).value
+    account = call_with_retry("GET monetary-account", MonetaryAccountApiObject.get, monetary_account_id).value
 
     BunqContext._api_context = None
     BunqContext._user_context = None
@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+# File with the results of previous benchmark runs, newest last
+RESULTS_FILE = "benchmark_results.json"
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Entry points whose cold start is measured: name -> (working directory, code to run).
+# The history CLIs are imported without running main; the app script runs in
+# Streamlit's bare mode, which executes it top to bottom without a server.
+ENTRY_POINTS = {
+    "to_web": ("history", "import to_web"),
+    "main": ("history", "import main"),
+    "mock_transactions": ("history", "import mock_transactions"),
+    "interpret": (".", "import interpret"),
+    "streamlit_app": (".", "import runpy; runpy.run_path('streamlit_app.py')"),
+}
+
+
+def parse_importtime(stderr):
+    """
+    Parse the output of python -X importtime.
+
+    :return: List of (module, self seconds, cumulative seconds, nesting level).
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # Header line
+        module = parts[2][1:]
+        level = (len(module) - len(module.lstrip())) // 2
+        imports.append((module.strip(), int(parts[0]) / 1e6, int(parts[1]) / 1e6, level))
+    return imports
+
+
+def direct_imports(imports, entry_module=None, startup_modules=()):
+    """
+    Find the imports done directly by an entry point.
+
+    python -X importtime lists a module after the modules it imports, one
+    level deeper. For an entry module these are the entries one level below
+    it; for a script run with runpy they are the top-level imports that an
+    empty interpreter (startup_modules) doesn't do.
+
+    :param imports: Parsed output of parse_importtime.
+    :param entry_module: Name of the imported entry module, or None for a script.
+    :param startup_modules: Names of the modules imported by an empty interpreter.
+    :return: List of (module, self seconds, cumulative seconds, nesting level).
+    """
+    if entry_module is None:
+        return [entry for entry in imports if entry[3] == 0 and entry[0] not in startup_modules]
+
+    children = {}
+    for entry in imports:
+        module, _, _, level = entry
+        found = children.pop(level + 1, [])
+        for deeper in [key for key in children if key > level]:
+            del children[deeper]
+        if module == entry_module and level == 0:
+            return found
+        children.setdefault(level, []).append(entry)
+    return []
+
+
+def _startup_modules():
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"], capture_output=True, text=True)
+    return {module for module, _, _, _ in parse_importtime(process.stderr)}
+
+
+def measure_cold_start(name, runs=5, top=10):
+    """
+    Start a fresh interpreter for an entry point several times and time it.
+
+    :param name: Name of the entry point in ENTRY_POINTS.
+    :param runs: Number of cold starts; the median is reported.
+    :param top: Number of slowest direct imports of the entry point to report.
+    :return: Dict with the median and all wall-clock seconds, the slowest
+             direct imports of the last run, or the error if the entry point failed.
+    """
+    directory, code = ENTRY_POINTS[name]
+    entry_module = code.split()[1] if code.startswith("import ") and ";" not in code else None
+    timings = []
+    imports = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=os.path.join(ROOT, directory),
+            capture_output=True,
+            text=True,
+        )
+        elapsed = time.perf_counter() - start
+        if process.returncode != 0:
+            errors = [line for line in process.stderr.splitlines() if line and not line.startswith("import time:")]
+            return {"error": errors[-1] if errors else f"exit code {process.returncode}"}
+        timings.append(elapsed)
+        imports = parse_importtime(process.stderr)
+
+    startup_modules = _startup_modules() if entry_module is None else ()
+    entry_imports = direct_imports(imports, entry_module, startup_modules)
+    slowest = sorted(entry_imports, key=lambda entry: entry[2], reverse=True)[:top]
+    return {
+        "median_seconds": statistics.median(timings),
+        "seconds": timings,
+        "import_seconds": sum(entry[2] for entry in imports if entry[3] == 0),
+        "slowest_imports": [{"module": module, "cumulative_seconds": cumulative} for module, _, cumulative, _ in slowest],
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path=RESULTS_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def run_benchmarks(names=None, runs=5, top=10):
+    """
+    Measure the cold start of the given entry points (all if not given).
+
+    :return: Benchmark run record with date, commit, Python version and results.
+    """
+    names = names or list(ENTRY_POINTS)
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "cold_start": {name: measure_cold_start(name, runs, top) for name in names},
+    }
+
+
+def format_results(record, previous=None):
+    """
+    Format a benchmark run, with the change against the previous run where known.
+    """
+    lines = [f"Cold start ({record['date']}, commit {record['commit']}, Python {record['python']})"]
+    previous_results = (previous or {}).get("cold_start", {})
+    for name, result in record["cold_start"].items():
+        if "error" in result:
+            lines.append(f"  {name}: failed - {result['error']}")
+            continue
+        line = f"  {name}: {result['median_seconds'] * 1000:.0f} ms"
+        before = previous_results.get(name, {}).get("median_seconds")
+        if before:
+            line += f" ({(result['median_seconds'] - before) * 1000:+.0f} ms vs {previous['commit']})"
+        lines.append(line)
+        for entry in result["slowest_imports"]:
+            lines.append(f"      {entry['cumulative_seconds'] * 1000:8.1f} ms  {entry['module']}")
+    return "\n".join(lines)
+
+
+# Measure cold start of the entry points and keep the results for tracking
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure and track the cold start time of the entry points")
+    parser.add_argument("entry_points", nargs="*", help=f"Entry points to measure: {', '.join(ENTRY_POINTS)} (default: all)")
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts per entry point")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to show")
+    parser.add_argument("--results", default=RESULTS_FILE, help="File with the tracked results")
+    parser.add_argument("--no-save", action="store_true", help="Don't add this run to the results file")
+    args = parser.parse_args()
+    unknown = [name for name in args.entry_points if name not in ENTRY_POINTS]
+    if unknown:
+        parser.error(f"unknown entry points: {', '.join(unknown)}")
+
+    history = load_results(args.results)
+    record = run_benchmarks(args.entry_points, args.runs, args.top)
+    print(format_results(record, history[-1] if history else None))
+
+    if not args.no_save:
+        history.append(record)
+        with open(args.results, "w") as f:
+            json.dump(history, f, indent=2)
+        print(f"Results added to {args.results}")
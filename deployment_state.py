@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+# File with the sandbox users and accounts of earlier deploys, per scenario
+DEPLOYMENT_STATE_FILE = "deployments.json"
+
+# Directory with the saved API contexts of sandbox users, see api.create_user_and_save_context
+CONTEXTS_DIR = "contexts"
+
+
+def scenario_key(actions):
+    """
+    Key of a scenario: a hash of all its actions.
+
+    Scenarios that only share their users and accounts, like most generated
+    ones, get different keys, so they never deploy onto each other's
+    accounts. deploy() takes the key before optimising, so the optimiser
+    doesn't change it.
+    """
+    scenario = json.dumps(actions, sort_keys=True, default=str)
+    return hashlib.sha256(scenario.encode("utf-8")).hexdigest()
+
+
+class DeploymentState:
+    """
+    Sandbox users and accounts created for a scenario, kept between deploys
+    in DEPLOYMENT_STATE_FILE.
+
+    Users and accounts are stored by their UI ids under the scenario_key() of
+    the scenario. BunqInterpreter binds a re-deployed scenario to them instead
+    of creating new ones: a user is reused if its saved API context still
+    exists, an account if it is still listed as active for its user.
+    Reused accounts keep their balance; the requests still pending on them
+    are rejected by the interpreter.
+    Bindings are saved as they are made, so a deploy that fails halfway
+    doesn't lose the users it already created.
+    """
+
+    def __init__(self, key, path=DEPLOYMENT_STATE_FILE, users=None, accounts=None):
+        self.key = key
+        self.path = path
+        # UI user id (as string) -> bunq user id
+        self.users = users or {}
+        # UI account id (as string) -> {"id": bunq account id, "user_id": bunq user id, "ui_user_id": UI user id}
+        self.accounts = accounts or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, actions, path=DEPLOYMENT_STATE_FILE):
+        """
+        Load the users and accounts of earlier deploys of a scenario; an empty
+        state is returned if there are none.
+        """
+        key = scenario_key(actions)
+        saved = _read_deployments(path).get(key, {})
+        return cls(key, path, saved.get("users"), saved.get("accounts"))
+
+    def save(self):
+        with self._lock:
+            deployments = _read_deployments(self.path)
+            deployments[self.key] = {
+                "users": dict(self.users),
+                "accounts": {account_id: dict(account) for account_id, account in self.accounts.items()},
+                "updated": datetime.now().isoformat(timespec="seconds"),
+            }
+            # Write to a temporary file first, so an interrupted save keeps the old state
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, "w") as f:
+                json.dump(deployments, f, indent=2)
+            os.replace(temporary_path, self.path)
+
+    def user(self, user_id):
+        """
+        :return: The bunq id of the user bound to a UI user id, or None if
+                 there is none or its API context is gone.
+        """
+        user_id_bunq = self.users.get(str(user_id))
+        if user_id_bunq is None or not os.path.exists(os.path.join(CONTEXTS_DIR, f"{user_id_bunq}.json")):
+            return None
+        return user_id_bunq
+
+    def account(self, account_id):
+        """
+        :return: Tuple of (bunq account id, bunq user id) bound to a UI account id, or None.
+        """
+        account = self.accounts.get(str(account_id))
+        if account is None:
+            return None
+        return account["id"], account["user_id"]
+
+    def bind_user(self, user_id, user_id_bunq):
+        with self._lock:
+            self.users[str(user_id)] = user_id_bunq
+            # Accounts of a replaced user can't be reused
+            self.accounts = {
+                account_id: account for account_id, account in self.accounts.items()
+                if account["ui_user_id"] != str(user_id) or account["user_id"] == user_id_bunq
+            }
+        self.save()
+
+    def bind_account(self, account_id, account_id_bunq, user_id, user_id_bunq):
+        with self._lock:
+            self.accounts[str(account_id)] = {"id": account_id_bunq, "user_id": user_id_bunq, "ui_user_id": str(user_id)}
+        self.save()
+
+    def forget_account(self, account_id):
+        with self._lock:
+            self.accounts.pop(str(account_id), None)
+        self.save()
+
+    def clear(self):
+        with self._lock:
+            self.users.clear()
+            self.accounts.clear()
+        self.save()
+
+
+def _read_deployments(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error loading deployment state from {path}: {e}")
+        return {}
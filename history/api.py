@@ -1,9 +1,29 @@
-from bunq.sdk.context.bunq_context import BunqContext
 from bunq.sdk.context.api_context import ApiContext
 from bunq import ApiEnvironmentType
 import requests
 import os
-import time
+
+from resilience import RetryPolicy, call_with_retry, load_api_context
+
+
+def _post_sandbox_user(user_creation_url):
+    """
+    Request a new sandbox user, raising requests.HTTPError on an error status
+    so rate limits and server errors can be retried.
+    """
+    response = requests.post(
+        user_creation_url,
+        headers={
+            'Content-Type': 'application/json',
+            'Cache-Control': 'no-cache',
+            'User-Agent': 'bunq-python-sdk'
+        }
+    )
+    if response.status_code != 200:
+        print(f"Failed to create sandbox user: {response.status_code}")
+        print(f"Response: {response.text}")
+    response.raise_for_status()
+    return response
 
 
 def create_api_connection(environment, api_key, description, save_path):
@@ -15,7 +35,9 @@ def create_api_connection(environment, api_key, description, save_path):
     """
 
     # Create API context
-    api_context = ApiContext.create(
+    api_context = call_with_retry(
+        "POST session-server",
+        ApiContext.create,
         environment,
         api_key,
         description
@@ -26,21 +48,22 @@ def create_api_connection(environment, api_key, description, save_path):
     os.makedirs(dir_path, exist_ok=True)
     
     api_context.save(save_path) # Save API context
-    BunqContext.load_api_context(api_context) # Load API context
+    load_api_context(api_context) # Load API context
     
     return api_context
 
 
 def create_new_user(user_creation_url, path_to_save_api_context, description="New User", max_retries=3, retry_delay=5):
     """
-    Create a completely new sandbox user with retry logic for rate limiting.
+    Create a completely new sandbox user, retrying rate limits, server errors
+    and connection errors with exponential backoff (see resilience.py).
     
     Args:
         user_creation_url (str): URL to create a new sandbox user
         path_to_save_api_context (str): Path to save the API context
         description (str): Description for the user
-        max_retries (int): Maximum number of retry attempts on rate limit errors
-        retry_delay (int): Delay in seconds between retry attempts
+        max_retries (int): Maximum number of attempts
+        retry_delay (int): Backoff in seconds of the first retry; doubles on every retry
         
     Returns:
         dict: Information about the newly created user, including its API key
@@ -59,86 +82,58 @@ def create_new_user(user_creation_url, path_to_save_api_context, description="Ne
             print(f"Failed to load existing context file: {str(e)}")
             print("Will attempt to create a new user")
     
-    # Retry logic for API rate limits
-    for attempt in range(max_retries):
-        try:
-            # Make the API request to create a new sandbox user
-            response = requests.post(
-                user_creation_url,
-                headers={
-                    'Content-Type': 'application/json',
-                    'Cache-Control': 'no-cache',
-                    'User-Agent': 'bunq-python-sdk'
-                }
-            )
-            
-            # Handle rate limit errors (HTTP 429)
-            if response.status_code == 429:
-                wait_time = retry_delay * (attempt + 1)
-                print(f"Rate limit hit. Waiting {wait_time} seconds before retry... (Attempt {attempt+1}/{max_retries})")
-                print(f"Response: {response.text}")
-                
-                if attempt < max_retries - 1:
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    print("Maximum retry attempts reached.")
-                    return None
-            
-            # Check if request was successful
-            if response.status_code == 200:
-                # Parse the response
-                result = response.json()
-                
-                if 'Response' in result and len(result['Response']) > 0:
-                    # Extract API key from response
-                    api_key = result['Response'][0]['ApiKey']['api_key']
-                    
-                    print(f"Successfully created new sandbox user with API key: {api_key}")
-                    
-                    # Create a new API context for this user
-                    new_api_context = ApiContext.create(
-                        ApiEnvironmentType.SANDBOX,
-                        api_key,
-                        f"New User API - {description}"
-                    )
-                    
-                    # Make sure the directory exists
-                    directory = os.path.dirname(path_to_save_api_context)
-                    if directory and not os.path.exists(directory):
-                        os.makedirs(directory, exist_ok=True)
-                    
-                    # Save this API context to a separate file
-                    new_api_context.save(path_to_save_api_context)
-                    
-                    print(f"Saved new user API context to {path_to_save_api_context}")
-                    
-                    return {
-                        'api_key': api_key,
-                        'context_file_path': path_to_save_api_context,
-                        'api_context': new_api_context
-                    }
-                else:
-                    print("Failed to parse API key from response")
-                    print(f"Response: {result}")
-                    return None
-            else:
-                print(f"Failed to create sandbox user: {response.status_code}")
-                print(f"Response: {response.text}")
-                
-                # If it's not a rate limit error, don't retry
-                return None
-                
-        except Exception as e:
-            print(f"Error creating sandbox user: {str(e)}")
-            
-            # For network errors, retry
-            if "Connection" in str(e) and attempt < max_retries - 1:
-                wait_time = retry_delay * (attempt + 1)
-                print(f"Network error. Waiting {wait_time} seconds before retry... (Attempt {attempt+1}/{max_retries})")
-                time.sleep(wait_time)
-            else:
-                return None
-    
-    return None
+    # Rate limits, server errors and connection errors are retried with backoff
+    policy = RetryPolicy(max_attempts=max_retries, base_delay=retry_delay)
+    try:
+        response = call_with_retry(
+            "POST sandbox-user-person",
+            _post_sandbox_user,
+            user_creation_url,
+            policy=policy
+        )
+    except Exception as e:
+        print(f"Error creating sandbox user: {str(e)}")
+        return None
+
+    # Parse the response
+    result = response.json()
+
+    if 'Response' not in result or len(result['Response']) == 0:
+        print("Failed to parse API key from response")
+        print(f"Response: {result}")
+        return None
+
+    # Extract API key from response
+    api_key = result['Response'][0]['ApiKey']['api_key']
+
+    print(f"Successfully created new sandbox user with API key: {api_key}")
+
+    try:
+        # Create a new API context for this user
+        new_api_context = call_with_retry(
+            "POST session-server",
+            ApiContext.create,
+            ApiEnvironmentType.SANDBOX,
+            api_key,
+            f"New User API - {description}",
+            policy=policy
+        )
+    except Exception as e:
+        print(f"Error creating API context for new user: {str(e)}")
+        return None
+
+    # Make sure the directory exists
+    directory = os.path.dirname(path_to_save_api_context)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    # Save this API context to a separate file
+    new_api_context.save(path_to_save_api_context)
+
+    print(f"Saved new user API context to {path_to_save_api_context}")
 
+    return {
+        'api_key': api_key,
+        'context_file_path': path_to_save_api_context,
+        'api_context': new_api_context
+    }
@@ -0,0 +1,201 @@
+from bunq.sdk.context.api_context import ApiContext
+
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+import threading
+import atexit
+import os
+
+from resilience import call_with_retry
+
+
+class ContextPool:
+    """
+    Pool of API contexts for the main user and the agents in users/copy/.
+
+    Contexts are restored from disk on first use and then kept in memory.
+    A background thread watches session expiry and resets sessions shortly
+    before they lapse, so callers don't find out about an expired session
+    through a failed request. Contexts whose session changed are written back
+    to their files in batches rather than one by one.
+
+    Can be used as a context manager; leaving the block stops the refresher
+    and writes all pending changes.
+
+    Every process has its own pool. Pools of different processes may write
+    the same context file, so files are replaced atomically; a pool must not
+    be inherited through fork (the refresher thread doesn't survive it), so
+    worker processes are started with the spawn method, and a forked child
+    starts a new process-wide pool.
+    """
+
+    def __init__(self, refresh_margin: float = 300.0, check_interval: float = 30.0, flush_batch_size: int = 20):
+        """
+        Args:
+            refresh_margin: Seconds before expiry at which a session is refreshed
+            check_interval: Seconds between checks of the background refresher
+            flush_batch_size: Number of changed contexts that triggers a write-back
+        """
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.check_interval = check_interval
+        self.flush_batch_size = flush_batch_size
+
+        self._contexts: Dict[str, ApiContext] = {}
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "ContextPool":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._contexts)
+
+    def _expires_within(self, api_context: ApiContext, margin: timedelta) -> bool:
+        session_context = api_context.session_context
+        if session_context is None or session_context.expiry_time is None:
+            return True
+        return session_context.expiry_time - datetime.now() <= margin
+
+    def _refresh(self, context_file_path: str, api_context: ApiContext) -> None:
+        call_with_retry("POST session-server", api_context.reset_session)
+        with self._lock:
+            self._dirty.add(context_file_path)
+            should_flush = len(self._dirty) >= self.flush_batch_size
+        if should_flush:
+            self.flush()
+
+    def get(self, context_file_path: str) -> ApiContext:
+        """
+        Return the API context stored in a file, restoring it on first use.
+
+        Only blocks on a session call if the session has already expired,
+        which the background refresher normally prevents.
+
+        Args:
+            context_file_path: Path to the API context file
+
+        Returns:
+            ApiContext: The API context with an active session
+        """
+        with self._lock:
+            api_context = self._contexts.get(context_file_path)
+            if api_context is None:
+                api_context = ApiContext.restore(context_file_path)
+                self._contexts[context_file_path] = api_context
+
+        if self._expires_within(api_context, timedelta(0)):
+            self._refresh(context_file_path, api_context)
+
+        return api_context
+
+    def refresh_expiring(self) -> int:
+        """
+        Reset the sessions of all loaded contexts that expire within the margin.
+
+        Returns:
+            Number of refreshed sessions
+        """
+        with self._lock:
+            candidates = list(self._contexts.items())
+
+        refreshed = 0
+        for context_file_path, api_context in candidates:
+            if not self._expires_within(api_context, self.refresh_margin):
+                continue
+            try:
+                self._refresh(context_file_path, api_context)
+                refreshed += 1
+            except Exception as e:
+                print(f"Error refreshing session for {context_file_path}: {str(e)}")
+
+        return refreshed
+
+    def flush(self) -> int:
+        """
+        Write all contexts with a changed session back to their files.
+
+        Returns:
+            Number of written files
+        """
+        with self._lock:
+            dirty = [(path, self._contexts[path]) for path in self._dirty]
+            self._dirty.clear()
+
+        for context_file_path, api_context in dirty:
+            try:
+                # Write to a file of our own first, so another process never reads a partial one
+                temporary_path = f"{context_file_path}.{os.getpid()}.tmp"
+                api_context.save(temporary_path)
+                os.replace(temporary_path, context_file_path)
+            except Exception as e:
+                print(f"Error saving API context to {context_file_path}: {str(e)}")
+
+        return len(dirty)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.check_interval):
+            self.refresh_expiring()
+            self.flush()
+
+    def start(self) -> None:
+        """
+        Start the background session refresher.
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="context-pool-refresher", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """
+        Stop the background refresher and write all pending changes.
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+# Pool shared by the history modules; every process gets its own
+_default_pool: Optional[ContextPool] = None
+_default_pool_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # A forked child gets a copy of the pool without its refresher thread,
+    # possibly with a lock held by another thread; it starts a pool of its own
+    global _default_pool, _default_pool_lock
+    _default_pool = None
+    _default_pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_context_pool() -> ContextPool:
+    """
+    Return the process-wide context pool, starting it on first use.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ContextPool()
+            _default_pool.start()
+            atexit.register(_default_pool.close)
+    return _default_pool
+
+
+def get_context(context_file_path: str) -> ApiContext:
+    """
+    Shortcut for get_context_pool().get(context_file_path).
+    """
+    return get_context_pool().get(context_file_path)
@@ -0,0 +1,155 @@
+from itertools import groupby
+from typing import List, Dict, Any, Tuple
+
+from transaction_table import TransactionRecord, as_records
+
+
+# Key used for the main user in funding results, next to the agent IBANs
+MAIN_USER_KEY = 'main_user'
+
+
+def transaction_flow(transaction: TransactionRecord) -> Tuple[str, str, int]:
+    """
+    Determine how a transaction moves money when it is replayed.
+
+    Follows the same direction rules as replay_plan.compile_replay_plan:
+    negative payments go from the main user to the agent, positive payments
+    from the agent to the main user, and requests are made by the agent to
+    the main user, so an ACCEPTED request moves money from the main user to
+    the agent. Other requests move no money.
+
+    Returns:
+        Tuple of (payer key, payee key, cents); cents is 0 if no money moves
+    """
+    iban = transaction.counterparty_iban
+    cents = transaction.amount_cents
+
+    if transaction.type == 'PAYMENT':
+        if cents < 0:
+            return MAIN_USER_KEY, iban, -cents
+        return iban, MAIN_USER_KEY, cents
+
+    if transaction.status == 'ACCEPTED':
+        return MAIN_USER_KEY, iban, abs(cents)
+    return MAIN_USER_KEY, iban, 0
+
+
+def _simulate(flows: List[Tuple[str, str, int]], balances: Dict[str, int], needs: Dict[str, int]) -> None:
+    """
+    Apply flows to the running balances, raising the funding need of a payer
+    whenever its balance would drop below zero.
+    """
+    for payer, payee, cents in flows:
+        shortfall = cents - balances[payer]
+        if shortfall > 0:
+            needs[payer] += shortfall
+            balances[payer] += shortfall
+        balances[payer] -= cents
+        balances[payee] += cents
+
+
+def _reorder_group(flows: List[Tuple[str, str, int, TransactionRecord]], balances: Dict[str, int]) -> List[Tuple[str, str, int, TransactionRecord]]:
+    """
+    Order transactions that share a timestamp so that as few as possible need funding.
+
+    Greedily takes the first transaction the payer can already afford; if none
+    is affordable, the one with the smallest shortfall goes first.
+    """
+    remaining = list(flows)
+    balances = dict(balances)
+    ordered = []
+
+    while remaining:
+        best_index = 0
+        best_shortfall = None
+        for index, (payer, _, cents, _) in enumerate(remaining):
+            shortfall = max(0, cents - balances[payer])
+            if best_shortfall is None or shortfall < best_shortfall:
+                best_index, best_shortfall = index, shortfall
+            if shortfall == 0:
+                break
+
+        payer, payee, cents, transaction = remaining.pop(best_index)
+        balances[payer] = max(balances[payer], cents) - cents
+        balances[payee] += cents
+        ordered.append((payer, payee, cents, transaction))
+
+    return ordered
+
+
+def plan_funding(transactions: List[TransactionRecord], agents: List[Dict[str, Any]], reorder: bool = True, buffer_amount: float = 0.0) -> Dict[str, Any]:
+    """
+    Compute the tight initial funding every account needs for the replay to succeed.
+
+    The full multi-party balance flow is simulated in integer cents, including
+    the main user. An account needs funding only if its balance would go below
+    zero at some point; the amount needed is the deepest shortfall. Transactions
+    with the same creation timestamp have no defined order, so with reorder
+    they are arranged to minimise the total funding.
+
+    Args:
+        transactions: List of transaction records
+        agents: List of agent dictionaries with IBAN identifiers
+        reorder: If True, reorder transactions within equal timestamps
+        buffer_amount: Safety margin added only to accounts that need funding
+
+    Returns:
+        Dictionary with:
+        - required_balances: IBAN (or MAIN_USER_KEY) to required initial balance
+        - transactions: the transactions in replay order (pass to the replay)
+        - total_funding: sum of all required balances
+        - funding_requests: number of accounts that need funding
+    """
+    known_ibans = {agent['iban'] for agent in agents}
+    balances = {MAIN_USER_KEY: 0, **{iban: 0 for iban in known_ibans}}
+    needs = dict(balances)
+
+    # Only transactions with a known counterparty and a valid amount move money
+    transactions = as_records(transactions)
+    flows = []
+    for transaction in sorted(transactions, key=lambda x: x.created_us):
+        if transaction.counterparty_iban not in known_ibans or transaction.amount_cents is None:
+            continue
+        payer, payee, cents = transaction_flow(transaction)
+        flows.append((payer, payee, cents, transaction))
+
+    ordered = []
+    for _, group in groupby(flows, key=lambda flow: flow[3].created_us):
+        group = list(group)
+        if reorder and len(group) > 1:
+            group = _reorder_group(group, balances)
+        _simulate([flow[:3] for flow in group], balances, needs)
+        ordered.extend(group)
+
+    # Transactions that move no money keep their place in the replay
+    ordered_ids = {id(flow[3]) for flow in ordered}
+    replay_order = [flow[3] for flow in ordered]
+    replay_order.extend(t for t in transactions if id(t) not in ordered_ids)
+    replay_order.sort(key=lambda x: x.created_us)
+
+    required_balances = {
+        key: cents / 100 + buffer_amount if cents > 0 else 0.0
+        for key, cents in needs.items()
+    }
+
+    return {
+        'required_balances': required_balances,
+        'transactions': replay_order,
+        'total_funding': sum(required_balances.values()),
+        'funding_requests': sum(1 for balance in required_balances.values() if balance > 0)
+    }
+
+
+def print_funding_plan(funding: Dict[str, Any]) -> None:
+    """
+    Print a short summary of a funding plan.
+
+    Args:
+        funding: Funding plan as returned by plan_funding
+    """
+    print("\n=== FUNDING PLAN ===")
+    print(f"Accounts needing funding: {funding['funding_requests']} of {len(funding['required_balances'])}")
+    print(f"Total funding required: €{funding['total_funding']:.2f}")
+    main_user_balance = funding['required_balances'].get(MAIN_USER_KEY, 0.0)
+    if main_user_balance > 0:
+        print(f"Main user needs: €{main_user_balance:.2f}")
@@ -0,0 +1,62 @@
+from typing import Any, Optional
+import importlib
+import threading
+
+
+class LazyObject:
+    """
+    Stand-in for a module, or an attribute of a module, that is imported on first use.
+
+    Attribute access, calls and attribute assignment are passed on to the
+    real object, so a name bound with lazy_import() is used exactly like one
+    bound with a regular import. The import happens once, under a lock, so
+    the first use may come from any thread.
+    """
+
+    def __init__(self, module_name: str, attribute: Optional[str] = None):
+        object.__setattr__(self, '_module_name', module_name)
+        object.__setattr__(self, '_attribute', attribute)
+        object.__setattr__(self, '_target', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _resolve(self) -> Any:
+        target = self._target
+        if target is None:
+            with self._lock:
+                target = self._target
+                if target is None:
+                    target = importlib.import_module(self._module_name)
+                    if self._attribute is not None:
+                        target = getattr(target, self._attribute)
+                    object.__setattr__(self, '_target', target)
+        return target
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._resolve(), name, value)
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        name = self._module_name if self._attribute is None else f"{self._module_name}.{self._attribute}"
+        state = "loaded" if self._target is not None else "not loaded"
+        return f"<lazy {name} ({state})>"
+
+
+def lazy_import(module_name: str, attribute: Optional[str] = None) -> LazyObject:
+    """
+    Bind a module, or one of its attributes, without importing it yet.
+
+    `BunqContext = lazy_import("bunq.sdk.context.bunq_context", "BunqContext")`
+    replaces `from bunq.sdk.context.bunq_context import BunqContext`; the bunq
+    SDK is then only loaded when BunqContext is first used. Use it for heavy
+    modules that some code paths of a command never need.
+
+    Args:
+        module_name: Absolute name of the module
+        attribute: Name of the attribute to bind; the module itself if not given
+    """
+    return LazyObject(module_name, attribute)
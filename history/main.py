@@ -1,16 +1,12 @@
 from bunq.sdk.context.bunq_context import BunqContext
-from bunq.sdk.context.api_context import ApiContext
 
-import shutil
 import os
 
-from mock_transactions import generate_mock_transactions
 from api import create_new_user
 from parse_user import (
     get_user_transactions, 
     extract_transaction_agents, 
     create_agent_users,
-    calculate_agent_initial_balances,
     print_agent_balance_requirements,
     request_initial_balances,
     print_iban_user_mapping,
@@ -18,7 +14,33 @@ from parse_user import (
     print_replay_results
 )
 
+from funding import plan_funding, print_funding_plan
+from pair_store import IbanUserStore, PAIR_STORE_FILENAME
+from context_pool import get_context
+from resilience import load_api_context
 from parser import transactions_to_visualizer_format
+from lazy_import import lazy_import
+
+# Only loaded when mock transactions are requested
+generate_mock_history = lazy_import("mock_transactions", "generate_mock_history")
+
+def ask_number(prompt, convert, default=None):
+    """
+    Ask for a number until the answer can be converted; an empty answer gives the default.
+
+    Args:
+        prompt: Question to show
+        convert: int or float
+        default: Value for an empty answer
+    """
+    while True:
+        answer = input(prompt).strip()
+        if not answer:
+            return default
+        try:
+            return convert(answer)
+        except ValueError:
+            print(f"'{answer}' is not a valid number, please try again")
 
 def main():
     # Try to load main user, or create it if no main file exists
@@ -31,13 +53,13 @@ def main():
         api_context = new_user['api_context']
     else:
         try:
-            api_context = ApiContext.restore(main_user_path)
+            api_context = get_context(main_user_path)
         except Exception as e:
             print(f"Error loading main user API context: {str(e)}")
             print("Try deleting the main_user.conf file and running again.")
             return
             
-    BunqContext.load_api_context(api_context)
+    load_api_context(api_context)
 
     # Get user context and print his balance
     user_context = BunqContext.user_context()
@@ -60,15 +82,21 @@ def main():
     # Ask if user want to create mock transactions
     make_mock_transactions = input(">> Do you want to make mock transactions? (y/n): ").strip()
     if make_mock_transactions == "y":
-        generate_mock_transactions()
+        mock_count = ask_number(">> Number of mock transactions (empty for 30): ", int, 30)
+        mock_seed = ask_number(">> Seed for the mock history (empty for random): ", int)
+        generate_mock_history(api_context, count=mock_count, seed=mock_seed)
     
     # Get transactions of the main user and agents he interacted with
     transactions = get_user_transactions()
     agents = extract_transaction_agents(transactions)
 
-    # Calculate minimum initial balances for each agent
-    required_balances = calculate_agent_initial_balances(transactions, agents)
+    # Calculate tight initial balances for each agent and the main user,
+    # reordering transactions with equal timestamps to need less funding
+    funding = plan_funding(transactions, agents)
+    required_balances = funding['required_balances']
+    transactions = funding['transactions']
     print_agent_balance_requirements(required_balances)
+    print_funding_plan(funding)
     
     # Ask user if they want to create agent users (proceed)
     create_agents = input(">> Do you want to create agent users for each IBAN? (y/n): ").strip()
@@ -82,12 +110,14 @@ def main():
     # Print the mapping
     print_iban_user_mapping(iban_to_user_map, required_balances)
         
-    # Create a backup of the pair file
-    pair_file = "users/copy/iban_user_pairs.json"
-    if os.path.exists(pair_file) and not os.path.exists(f"{pair_file}.bak"):
+    # Create a backup of the IBAN-user store
+    pair_store_path = f"users/copy/{PAIR_STORE_FILENAME}"
+    if os.path.exists(pair_store_path) and not os.path.exists(f"{pair_store_path}.bak"):
         try:
-            shutil.copy2(pair_file, f"{pair_file}.bak")
-            print(f"Created backup of pair file: {pair_file}.bak")
+            store = IbanUserStore(pair_store_path)
+            store.backup(f"{pair_store_path}.bak")
+            store.close()
+            print(f"Created backup of IBAN-user store: {pair_store_path}.bak")
         except Exception as e:
             print(f"Failed to create backup: {str(e)}")
     
@@ -95,16 +125,29 @@ def main():
     request_balances = input(">> Do you want to request initial balances from Sugar Daddy? (y/n): ").strip()
     if request_balances == "y":
         # Make the requests and print the results
-        request_initial_balances(iban_to_user_map, required_balances, "sugardaddy@bunq.com")
+        request_initial_balances(iban_to_user_map, required_balances, "sugardaddy@bunq.com", main_user_path)
     
+    # Ask user if they want to see which transactions can be replayed first
+    dry_run = input(">> Do you want to dry run the replay first? (y/n): ").strip()
+    if dry_run == "y":
+        replay_transactions_chronologically(transactions, iban_to_user_map, main_user_path, dry_run=True)
+
     # Ask user if they want to replay transactions chronologically
     replay_transactions = input(">> Do you want to replay transactions? (y/n): ").strip()
     if replay_transactions != "y":
         print("Exiting...")
         return
 
+    # Ask for a speed factor to reproduce the original timing (empty = as fast as possible)
+    replay_speed = ask_number(">> Replay speed factor for original timing, e.g. 60 (empty for no timing): ", float)
+
+    # Untimed replays can be sharded over several processes
+    replay_processes = 1
+    if not replay_speed:
+        replay_processes = ask_number(">> Number of replay processes (empty for 1): ", int, 1)
+
     # Replay the transactions and print the results
-    replay_results = replay_transactions_chronologically(transactions, iban_to_user_map, main_user_path)
+    replay_results = replay_transactions_chronologically(transactions, iban_to_user_map, main_user_path, speed=replay_speed, processes=replay_processes)
     print_replay_results(replay_results)
 
 if __name__ == "__main__":
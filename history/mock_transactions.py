@@ -1,81 +1,334 @@
 from bunq.sdk.context.bunq_context import BunqContext
 from bunq.sdk.model.generated.endpoint import PaymentApiObject, RequestInquiryApiObject
 from bunq.sdk.model.generated.object_ import AmountObject, PointerObject
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional
+import argparse
+import json
+import math
+import os
 import random
-import time
-from datetime import datetime
 
-def generate_mock_transactions(api_context=None):
+from api import create_new_user
+from context_pool import get_context
+from replay_clock import ReplayClock, BUNQ_DATETIME_FORMAT
+from replay_plan import format_cents
+from resilience import call_with_retry, idempotency_headers, load_api_context
+from transaction_table import created_to_micros
+
+
+SANDBOX_USER_URL = "https://public-api.sandbox.bunq.com/v1/sandbox-user-person"
+
+# Sandbox account that accepts every request up to MAX_SUGAR_DADDY_CENTS; funds the history
+SUGAR_DADDY = {"type": "EMAIL", "value": "sugardaddy@bunq.com", "name": "Sugar Daddy"}
+MAX_SUGAR_DADDY_CENTS = 50000
+
+# File in the counterparty directory listing the provisioned counterparties
+COUNTERPARTY_FILENAME = "counterparties.json"
+
+REQUEST_DESCRIPTIONS = [
+    "Dinner split",
+    "Concert tickets",
+    "Shared groceries",
+    "Taxi ride",
+    "Birthday present"
+]
+
+PAYMENT_DESCRIPTIONS = [
+    "Rent payment",
+    "Utility bills",
+    "Grocery shopping",
+    "Phone bill",
+    "Internet service",
+    "Streaming subscription"
+]
+
+
+def provision_counterparties(count: int, output_dir: str = "users/mock/") -> List[Dict[str, Any]]:
     """
-    Generate different mock transactions including:
-    - Requests from sugar daddy
-    - Payments to sugar daddy
-    - Payments to other hardcoded entities
-    
+    Make sure there are sandbox users to act as counterparties of the mock history.
+
+    Counterparties provisioned by earlier runs are reused from the list in
+    output_dir, so only the missing ones are created. Creating a user loads
+    its API context, so the caller has to load its own context again afterwards.
+
     Args:
-        api_context: The BunqContext API context to use for API calls
+        count: Number of counterparties needed
+        output_dir: Directory for the counterparties' API contexts
+
+    Returns:
+        List of counterparties as IBAN alias dictionaries (type, value, name)
     """
-    print("Starting mock transaction generation...")
-    
-    # Load context
-    if api_context:
-        BunqContext.load_api_context(api_context)
-    
-    # Entities, first being sugar daddy
-    entities = [
-        {"type": "EMAIL", "value": "sugardaddy@bunq.com", "name": "Sugar Daddy"},
-        {"type": "EMAIL", "value": "test+51be74e9-09a9-4633-be79-0037b15082f8@bunq.com", "name": "Guy next door"},
-    ]
-    
-    # Transaction descriptions
-    request_descriptions = [
-        "Monthly allowance",
-        "Weekly spending money",
-        "Emergency funds",
-        "Shopping spree"
-    ]
-    
-    payment_descriptions = [
-        "Rent payment",
-        "Utility bills",
-        "Grocery shopping",
-        "Phone bill",
-        "Internet service",
-        "Streaming subscription"
-    ]
-    
-    # Requests from sugar daddy
-    sugar_daddy_amounts = ["30.00", "100.00", "50.00", "25.00", "45.00"]
-    for i in range(15):
-        index = i % (len(sugar_daddy_amounts) - 1)
-        RequestInquiryApiObject.create(
-            AmountObject(sugar_daddy_amounts[index], "EUR"),
-            PointerObject("EMAIL", "sugardaddy@bunq.com"),
-            request_descriptions[index],
-            allow_bunqme=False
+    os.makedirs(output_dir, exist_ok=True)
+    list_path = os.path.join(output_dir, COUNTERPARTY_FILENAME)
+
+    counterparties = []
+    if os.path.exists(list_path):
+        with open(list_path, "r") as f:
+            counterparties = json.load(f)
+    print(f"Loaded {len(counterparties)} existing mock counterparties from {list_path}")
+
+    for i in range(len(counterparties), count):
+        name = f"Mock Counterparty {i+1}"
+        new_user = create_new_user(SANDBOX_USER_URL, os.path.join(output_dir, f"counterparty_{i+1}.conf"), name)
+        if new_user is None:
+            print(f"Failed to create {name}, continuing with {len(counterparties)} counterparties")
+            break
+
+        load_api_context(get_context(new_user['context_file_path']))
+        iban = None
+        for alias in BunqContext.user_context().primary_monetary_account.alias:
+            if alias.type_ == 'IBAN':
+                iban = alias.value
+                break
+        if iban is None:
+            print(f"No IBAN found for {name}, continuing with {len(counterparties)} counterparties")
+            break
+
+        counterparties.append({
+            'type': 'IBAN',
+            'value': iban,
+            'name': name,
+            'context_file_path': new_user['context_file_path']
+        })
+        # Write after every user, so an interrupted run loses nothing
+        with open(list_path, "w") as f:
+            json.dump(counterparties, f, indent=2)
+        print(f"Created {name} with IBAN {iban}")
+
+    return counterparties[:count]
+
+
+def plan_mock_history(
+    count: int,
+    counterparties: List[Dict[str, Any]],
+    seed: Optional[int] = None,
+    request_share: float = 0.3,
+    amount_median: float = 5.0,
+    amount_sigma: float = 1.0,
+    mean_interval: float = 60.0,
+    counterparty_skew: float = 1.0
+) -> List[Dict[str, Any]]:
+    """
+    Plan a mock transaction history; the same seed always gives the same plan.
+
+    Amounts follow a log-normal distribution, the time between transactions
+    an exponential one, and counterparty k (1-based) is picked with a weight
+    of 1 / k ** counterparty_skew, so a few counterparties dominate the
+    history like in a real account. Sugar daddy requests covering all
+    payments are put in front of the history.
+
+    Args:
+        count: Number of payments and requests to the counterparties
+        counterparties: Counterparty aliases (see provision_counterparties)
+        seed: Seed of the random generator
+        request_share: Share of requests among the transactions, between 0 and 1
+        amount_median: Median amount in EUR
+        amount_sigma: Spread of the amounts (sigma of the log-normal distribution)
+        mean_interval: Mean time between two transactions in seconds
+        counterparty_skew: 0 picks all counterparties equally often
+
+    Returns:
+        List of planned transactions, oldest first, each with kind ('payment',
+        'request' or 'funding'), counterparty, amount, description, created
+        and created_us (created in microseconds since the epoch)
+    """
+    if not counterparties:
+        raise ValueError("The mock history needs at least one counterparty")
+
+    rng = random.Random(seed)
+    weights = [1 / (k + 1) ** counterparty_skew for k in range(len(counterparties))]
+    mu = math.log(amount_median)
+
+    transactions = []
+    offset = 0.0
+    paid_cents = 0
+    for i in range(count):
+        offset += rng.expovariate(1 / mean_interval) if mean_interval > 0 else 0.0
+        kind = 'request' if rng.random() < request_share else 'payment'
+        cents = max(1, round(rng.lognormvariate(mu, amount_sigma) * 100))
+        descriptions = REQUEST_DESCRIPTIONS if kind == 'request' else PAYMENT_DESCRIPTIONS
+        transactions.append({
+            'kind': kind,
+            'counterparty': rng.choices(counterparties, weights)[0],
+            'cents': cents,
+            'description': f"{rng.choice(descriptions)} #{i+1}",
+            'offset': offset
+        })
+        if kind == 'payment':
+            paid_cents += cents
+
+    # Fund all payments up front, in requests the sugar daddy accepts
+    funding = []
+    while paid_cents > 0:
+        cents = min(paid_cents, MAX_SUGAR_DADDY_CENTS)
+        funding.append({
+            'kind': 'funding',
+            'counterparty': SUGAR_DADDY,
+            'cents': cents,
+            'description': f"Mock history funding #{len(funding)+1}",
+            'offset': 0.0
+        })
+        paid_cents -= cents
+
+    # Timestamps relative to now, so the plan can go through a ReplayClock
+    origin = datetime.now()
+    planned = funding + transactions
+    for index, transaction in enumerate(planned):
+        transaction['index'] = index
+        transaction['amount'] = format_cents(transaction.pop('cents'))
+        transaction['created'] = (origin + timedelta(seconds=transaction.pop('offset'))).strftime(BUNQ_DATETIME_FORMAT)
+        transaction['created_us'] = created_to_micros(transaction['created'])
+
+    return planned
+
+
+def _send(transaction: Dict[str, Any]) -> int:
+    counterparty = transaction['counterparty']
+    alias = PointerObject(counterparty['type'], counterparty['value'], counterparty['name'])
+    amount = AmountObject(transaction['amount'], "EUR")
+
+    if transaction['kind'] == 'payment':
+        return call_with_retry(
+            "POST payment",
+            PaymentApiObject.create,
+            amount=amount,
+            counterparty_alias=alias,
+            description=transaction['description'],
+            custom_headers=idempotency_headers()
         ).value
-        print(f"Created request {i+1}/{15} from sugar daddy for €{sugar_daddy_amounts[index]}")
 
-    # Payments to other entities
-    payment_amounts = ["0.03", "0.25", "1.00", "1.42", "2.00"]
-    for i in range(15):
+    return call_with_retry(
+        "POST request-inquiry",
+        RequestInquiryApiObject.create,
+        amount,
+        alias,
+        transaction['description'],
+        allow_bunqme=False,
+        custom_headers=idempotency_headers()
+    ).value
+
+
+def emit_mock_history(planned: List[Dict[str, Any]], workers: int = 4, speed: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Send planned transactions from the loaded user with a pool of worker threads.
+
+    All workers share the loaded API context and the process-wide rate limit
+    governor, so the pool runs as fast as the sandbox limits allow. The
+    funding requests are sent and finished first, so the payments find
+    their money on the account.
+
+    Args:
+        planned: Planned transactions (see plan_mock_history)
+        workers: Number of concurrent API calls
+        speed: Speed factor to reproduce the planned timing; None sends as fast as possible
+
+    Returns:
+        Dictionary with 'success' and 'failed' lists
+    """
+    results = {'success': [], 'failed': []}
+
+    def send(transaction):
         try:
-            entity = random.choice(entities)
-            amount = random.choice(payment_amounts)
-            description = random.choice(payment_descriptions)
-            
-            # Make a payment
-            PaymentApiObject.create(
-                amount=AmountObject(amount, "EUR"),
-                counterparty_alias=PointerObject(entity["type"], entity["value"]),
-                description=f"{description} to {entity['name']} - {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-            ).value
-            
-            print(f"Created payment {i+1}/{15}: €{amount} to {entity['name']} - {description}")
-            
-            # Add small delay between payments
-            time.sleep(0.5)
+            object_id = _send(transaction)
+            results['success'].append({'index': transaction['index'], 'kind': transaction['kind'], 'id': object_id})
         except Exception as e:
-            print(f"Error creating payment {i+1}: {str(e)}")
-    
-    print("All transactions have been committed to the network!:)")
+            results['failed'].append({'index': transaction['index'], 'kind': transaction['kind'], 'reason': str(e)})
+        done = len(results['success']) + len(results['failed'])
+        if done % 100 == 0 or done == len(planned):
+            print(f"Sent {done}/{len(planned)} mock transactions ({len(results['failed'])} failed)")
+
+    funding = [t for t in planned if t['kind'] == 'funding']
+    history = [t for t in planned if t['kind'] != 'funding']
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(send, funding))
+
+        if speed:
+            clock = ReplayClock(speed)
+            clock.schedule(history, key=lambda t: t['created_us'])
+            for transaction, _ in clock.replay():
+                pool.submit(send, transaction)
+        else:
+            list(pool.map(send, history))
+
+    return results
+
+
+def generate_mock_history(
+    api_context=None,
+    count: int = 30,
+    counterparty_count: int = 3,
+    seed: Optional[int] = None,
+    workers: int = 4,
+    speed: Optional[float] = None,
+    counterparty_dir: str = "users/mock/",
+    **distribution
+) -> Dict[str, Any]:
+    """
+    Provision counterparties, plan a seeded mock history and send it from the main user.
+
+    Args:
+        api_context: API context of the main user; the loaded one is used if not given
+        count: Number of payments and requests to the counterparties
+        counterparty_count: Number of sandbox counterparties
+        seed: Seed of the random generator
+        workers: Number of concurrent API calls
+        speed: Speed factor to reproduce the planned timing; None sends as fast as possible
+        counterparty_dir: Directory for the counterparties' API contexts
+        **distribution: request_share, amount_median, amount_sigma, mean_interval
+            and counterparty_skew (see plan_mock_history)
+
+    Returns:
+        Dictionary with 'success' and 'failed' lists
+    """
+    print("Starting mock transaction generation...")
+    if api_context is None:
+        api_context = BunqContext.api_context()
+
+    counterparties = provision_counterparties(counterparty_count, counterparty_dir)
+
+    # Provisioning loads the counterparties' contexts
+    load_api_context(api_context)
+
+    planned = plan_mock_history(count, counterparties, seed=seed, **distribution)
+    print(f"Planned {len(planned)} mock transactions (seed: {seed})")
+
+    results = emit_mock_history(planned, workers=workers, speed=speed)
+    print(f"Mock history done: {len(results['success'])} sent, {len(results['failed'])} failed")
+    return results
+
+
+# Generate a mock history from the command line, e.g. for batch jobs
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a seeded mock transaction history for a sandbox user")
+    parser.add_argument("context", help="API context file of the user to generate the history for")
+    parser.add_argument("--count", type=int, default=30, help="Number of payments and requests")
+    parser.add_argument("--counterparties", type=int, default=3, help="Number of sandbox counterparties")
+    parser.add_argument("--seed", type=int, help="Seed of the random generator")
+    parser.add_argument("--workers", type=int, default=4, help="Number of concurrent API calls")
+    parser.add_argument("--speed", type=float, help="Speed factor for the planned timing (default: as fast as possible)")
+    parser.add_argument("--request-share", type=float, default=0.3, help="Share of requests among the transactions")
+    parser.add_argument("--amount-median", type=float, default=5.0, help="Median amount in EUR")
+    parser.add_argument("--amount-sigma", type=float, default=1.0, help="Spread of the log-normal amounts")
+    parser.add_argument("--mean-interval", type=float, default=60.0, help="Mean seconds between transactions")
+    parser.add_argument("--counterparty-skew", type=float, default=1.0, help="0 for equally used counterparties")
+    parser.add_argument("--counterparty-dir", default="users/mock/", help="Directory for the counterparties")
+    args = parser.parse_args()
+
+    generate_mock_history(
+        get_context(args.context),
+        count=args.count,
+        counterparty_count=args.counterparties,
+        seed=args.seed,
+        workers=args.workers,
+        speed=args.speed,
+        counterparty_dir=args.counterparty_dir,
+        request_share=args.request_share,
+        amount_median=args.amount_median,
+        amount_sigma=args.amount_sigma,
+        mean_interval=args.mean_interval,
+        counterparty_skew=args.counterparty_skew
+    )
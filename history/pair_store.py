@@ -0,0 +1,211 @@
+from typing import Dict, Any, Optional
+import sqlite3
+import json
+import os
+
+
+# File names of the store and of the JSON pair file it replaces, inside the agent directory
+PAIR_STORE_FILENAME = "iban_user_pairs.db"
+LEGACY_PAIR_FILENAME = "iban_user_pairs.json"
+
+# Agent statistics kept from the original agent dict (transaction ids are not stored)
+AGENT_SUMMARY_FIELDS = ('transaction_count', 'total_amount', 'first_transaction', 'last_transaction')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS iban_user (
+    iban TEXT PRIMARY KEY,
+    copy_iban TEXT,
+    user_id INTEGER,
+    api_key TEXT,
+    context_file_path TEXT NOT NULL,
+    is_main_user INTEGER NOT NULL DEFAULT 0,
+    transaction_count INTEGER,
+    total_amount REAL,
+    first_transaction TEXT,
+    last_transaction TEXT
+);
+CREATE INDEX IF NOT EXISTS iban_user_copy_iban ON iban_user (copy_iban);
+CREATE INDEX IF NOT EXISTS iban_user_user_id ON iban_user (user_id);
+"""
+
+_COLUMNS = ('iban', 'copy_iban', 'user_id', 'api_key', 'context_file_path', 'is_main_user') + AGENT_SUMMARY_FIELDS
+
+
+class IbanUserStore:
+    """
+    SQLite store mapping original IBANs to the sandbox users that replay them.
+
+    Replaces the iban_user_pairs.json file, which had to be rewritten completely
+    after every new user. Rows are indexed on original IBAN, copy IBAN and user
+    id, and each insert or update is a small transaction. Entries are returned
+    in the same shape as the old pair file entries.
+
+    Can be used as a context manager; all changes made inside the block are
+    committed together.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(_SCHEMA)
+        self._batch_depth = 0
+
+    @classmethod
+    def for_directory(cls, output_dir: str) -> "IbanUserStore":
+        """
+        Open the store of an agent directory, importing the legacy pair file
+        the first time if there is one.
+        """
+        store = cls(os.path.join(output_dir, PAIR_STORE_FILENAME))
+        legacy_path = os.path.join(output_dir, LEGACY_PAIR_FILENAME)
+        if len(store) == 0 and os.path.exists(legacy_path):
+            imported = store.import_pair_file(legacy_path)
+            print(f"Imported {imported} IBAN-user mappings from {legacy_path}")
+        return store
+
+    def __enter__(self) -> "IbanUserStore":
+        self._batch_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            if exc_type is None:
+                self._connection.commit()
+            else:
+                self._connection.rollback()
+
+    def _commit(self) -> None:
+        # Inside a with block the commit happens when the block ends
+        if self._batch_depth == 0:
+            self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM iban_user").fetchone()[0]
+
+    def __contains__(self, iban: str) -> bool:
+        return self._connection.execute("SELECT 1 FROM iban_user WHERE iban = ?", (iban,)).fetchone() is not None
+
+    @staticmethod
+    def _to_entry(row: sqlite3.Row) -> Dict[str, Any]:
+        """
+        Convert a row into the dictionary shape of the old pair file.
+        """
+        entry = {
+            'api_key': row['api_key'],
+            'context_file_path': row['context_file_path'] or None,
+            'iban': row['iban'],
+            'copy_iban': row['copy_iban'],
+            'user_id': row['user_id'],
+            'is_main_user': bool(row['is_main_user'])
+        }
+        if row['transaction_count'] is not None:
+            entry['original_agent'] = {'iban': row['iban'], **{field: row[field] for field in AGENT_SUMMARY_FIELDS}}
+        return entry
+
+    def _find_one(self, column: str, value: Any) -> Optional[Dict[str, Any]]:
+        row = self._connection.execute(f"SELECT * FROM iban_user WHERE {column} = ?", (value,)).fetchone()
+        return self._to_entry(row) if row else None
+
+    def get(self, iban: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a user by original IBAN.
+        """
+        return self._find_one('iban', iban)
+
+    def find_by_copy_iban(self, copy_iban: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a user by the IBAN of its sandbox copy.
+        """
+        return self._find_one('copy_iban', copy_iban)
+
+    def find_by_user_id(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Look up a user by sandbox user id.
+        """
+        return self._find_one('user_id', user_id)
+
+    def put(self, iban: str, user_info: Dict[str, Any]) -> None:
+        """
+        Insert or replace the user for an original IBAN.
+
+        Args:
+            iban: Original IBAN
+            user_info: Entry in the shape of the old pair file; of the
+                       'original_agent' dict only the summary statistics are kept
+        """
+        agent = user_info.get('original_agent') or {}
+        values = (
+            iban,
+            user_info.get('copy_iban'),
+            user_info.get('user_id'),
+            user_info.get('api_key'),
+            # Older pair files have entries without a context file
+            user_info.get('context_file_path') or '',
+            int(bool(user_info.get('is_main_user', False))),
+        ) + tuple(agent.get(field) for field in AGENT_SUMMARY_FIELDS)
+
+        self._connection.execute(
+            f"INSERT OR REPLACE INTO iban_user ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+            values
+        )
+        self._commit()
+
+    def set_copy_iban(self, iban: str, copy_iban: str) -> None:
+        """
+        Update the copy IBAN of an existing entry.
+        """
+        self._connection.execute("UPDATE iban_user SET copy_iban = ? WHERE iban = ?", (copy_iban, iban))
+        self._commit()
+
+    def delete(self, iban: str) -> None:
+        """
+        Remove the entry for an original IBAN.
+        """
+        self._connection.execute("DELETE FROM iban_user WHERE iban = ?", (iban,))
+        self._commit()
+
+    def as_map(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Return all entries as a dictionary mapping IBANs to user information,
+        as the old pair file did.
+        """
+        rows = self._connection.execute("SELECT * FROM iban_user ORDER BY rowid")
+        return {row['iban']: self._to_entry(row) for row in rows}
+
+    def import_pair_file(self, pair_file_path: str) -> int:
+        """
+        Import an existing iban_user_pairs.json file in one transaction.
+
+        Args:
+            pair_file_path: Path to the JSON pair file
+
+        Returns:
+            Number of imported entries
+        """
+        with open(pair_file_path, 'r') as f:
+            iban_to_user_map = json.load(f)
+
+        with self:
+            for iban, user_info in iban_to_user_map.items():
+                self.put(iban, user_info)
+
+        return len(iban_to_user_map)
+
+    def backup(self, backup_path: str) -> None:
+        """
+        Write a consistent copy of the store to another file.
+        """
+        destination = sqlite3.connect(backup_path)
+        try:
+            self._connection.backup(destination)
+        finally:
+            destination.close()
@@ -1,152 +1,214 @@
-from bunq.sdk.model.generated.endpoint import PaymentApiObject, RequestInquiryApiObject
-from bunq.sdk.model.generated.object_ import AmountObject, PointerObject
-from bunq.sdk.context.bunq_context import BunqContext
-from bunq.sdk.context.api_context import ApiContext
-from bunq import Pagination
-
-from typing import List, Dict, Any
-import json
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Optional
 import os
 
-from api import create_new_user
+from lazy_import import lazy_import
+from pair_store import IbanUserStore, PAIR_STORE_FILENAME, LEGACY_PAIR_FILENAME
+from funding import MAIN_USER_KEY
+from transaction_table import TransactionRecord, TransactionTable, aggregate_counterparties, micros_to_created, amount_to_cents, as_records
+
+# The bunq SDK, requests and the replay machinery are loaded on first use,
+# so commands that only work on exported transactions start fast
+PaymentApiObject = lazy_import("bunq.sdk.model.generated.endpoint", "PaymentApiObject")
+RequestInquiryApiObject = lazy_import("bunq.sdk.model.generated.endpoint", "RequestInquiryApiObject")
+MonetaryAccountApiObject = lazy_import("bunq.sdk.model.generated.endpoint", "MonetaryAccountApiObject")
+AmountObject = lazy_import("bunq.sdk.model.generated.object_", "AmountObject")
+PointerObject = lazy_import("bunq.sdk.model.generated.object_", "PointerObject")
+BunqContext = lazy_import("bunq.sdk.context.bunq_context", "BunqContext")
+Pagination = lazy_import("bunq", "Pagination")
+
+create_new_user = lazy_import("api", "create_new_user")
+compile_replay_plan = lazy_import("replay_plan", "compile_replay_plan")
+print_replay_plan = lazy_import("replay_plan", "print_replay_plan")
+execute_replay_plan = lazy_import("replay_plan", "execute_replay_plan")
+resolve_context_path = lazy_import("replay_plan", "resolve_context_path")
+get_context = lazy_import("context_pool", "get_context")
+call_with_retry = lazy_import("resilience", "call_with_retry")
+idempotency_headers = lazy_import("resilience", "idempotency_headers")
+load_api_context = lazy_import("resilience", "load_api_context")
+
+
+def list_monetary_account_ids() -> List[int]:
+    """
+    List the ids of all monetary accounts (bank, savings, joint, ...) of the current user.
+    
+    Returns:
+        List of monetary account ids
+    """
+    account_ids = []
+    
+    pagination = Pagination()
+    pagination.count = 200
+    
+    account_response = call_with_retry("GET monetary-account", MonetaryAccountApiObject.list, params=pagination.url_params_count_only)
+    while True:
+        for account in account_response.value:
+            account_ids.append(account.get_referenced_object().id_)
+        
+        if not account_response.pagination.has_next_page_assured():
+            break
+        account_response = call_with_retry("GET monetary-account", MonetaryAccountApiObject.list, params=account_response.pagination.url_params_next_page)
+    
+    return account_ids
 
 
-def get_user_transactions() -> List[Dict[str, Any]]:
+def _amount_cents_or_none(value: Any, kind: str, object_id: Any) -> Optional[int]:
+    """
+    Convert an API amount into cents, or report it and return None if it can't be parsed.
+    Records without an amount are skipped (and reported) by the table and the replay plan.
     """
-    Collect all transactions (payments and requests) for the current user.
+    try:
+        return amount_to_cents(value)
+    except ValueError as e:
+        print(f"Invalid amount in {kind} {object_id}: {str(e)}")
+        return None
+
+
+def _payment_to_transaction(payment, monetary_account_id: int) -> TransactionRecord:
+    return TransactionRecord(
+        type='PAYMENT',
+        id=payment.id_,
+        created=payment.created,
+        updated=payment.updated,
+        amount_cents=_amount_cents_or_none(payment.amount.value, 'payment', payment.id_),
+        currency=payment.amount.currency,
+        description=payment.description,
+        counterparty_iban=payment.counterparty_alias.label_monetary_account._iban,
+        monetary_account_id=monetary_account_id
+    )
+
+
+def _request_to_transaction(request, monetary_account_id: int) -> TransactionRecord:
+    return TransactionRecord(
+        type='REQUEST',
+        id=request.id_,
+        created=request.created,
+        updated=request.updated,
+        amount_cents=_amount_cents_or_none(request.amount_inquired.value, 'request', request.id_),
+        currency=request.amount_inquired.currency,
+        description=request.description,
+        status=request.status,
+        counterparty_iban=request.counterparty_alias.label_monetary_account._iban,
+        monetary_account_id=monetary_account_id
+    )
+
+
+def _fetch_account_objects(endpoint: str, api_object, to_transaction, monetary_account_id: int) -> List[TransactionRecord]:
+    """
+    Fetch all pages of payments or requests of one monetary account.
+    
+    Args:
+        api_object: PaymentApiObject or RequestInquiryApiObject
+        to_transaction: Function converting one API object into a transaction record
+        monetary_account_id: Id of the monetary account to fetch from
     
     Returns:
-        List of dictionaries containing transaction details
+        List of transaction records tagged with the monetary account id
     """
-    # Initialize result list
     transactions = []
     
     # Set up pagination
     pagination = Pagination()
     pagination.count = 200
     
-    try:
-        # Get payments
-        payment_response = PaymentApiObject.list(params=pagination.url_params_count_only)
-        payments = payment_response.value
-        pagination_info = payment_response.pagination
+    response = call_with_retry(endpoint, api_object.list, monetary_account_id=monetary_account_id, params=pagination.url_params_count_only)
+    while True:
+        # Process current page
+        for item in response.value:
+            transactions.append(to_transaction(item, monetary_account_id))
         
-        # Process payments
-        while True:
-            # Process current page
-            for payment in payments:
-                transaction = {
-                    'type': 'PAYMENT',
-                    'id': payment.id_,
-                    'created': payment.created,
-                    'updated': payment.updated,
-                    'amount': payment.amount.value,
-                    'currency': payment.amount.currency,
-                    'description': payment.description,
-                    'counterparty_iban': payment.counterparty_alias.label_monetary_account._iban
-                }
-                transactions.append(transaction)
+        # Check if there are more pages
+        if not response.pagination.has_next_page_assured():
+            break
             
-            # Check if there are more pages
-            if not pagination_info.has_next_page_assured():
-                break
-                
-            # Fetch next page
-            payment_response = PaymentApiObject.list(params=pagination_info.url_params_next_page)
-            payments = payment_response.value
-            pagination_info = payment_response.pagination
-                
-    except Exception as e:
-        print(f"Error fetching payments: {str(e)}")
+        # Fetch next page
+        response = call_with_retry(endpoint, api_object.list, monetary_account_id=monetary_account_id, params=response.pagination.url_params_next_page)
     
-    # Reset pagination for requests
-    pagination = Pagination()
-    pagination.count = 200
+    return transactions
+
+
+def get_user_transactions(max_workers: int = 3) -> List[TransactionRecord]:
+    """
+    Collect all transactions (payments and requests) for the current user,
+    across all of the user's monetary accounts.
+    
+    The payments and requests of every account are fetched concurrently with
+    a bounded thread pool. Each transaction is tagged with the id of the
+    monetary account it belongs to.
+    
+    Args:
+        max_workers: Maximum number of concurrent fetches
+    
+    Returns:
+        List of transaction records (see transaction_table.TransactionRecord)
+    """
+    # Initialize result list
+    transactions = []
     
     try:
-        # Get requests
-        request_response = RequestInquiryApiObject.list(params=pagination.url_params_count_only)
-        requests = request_response.value
-        pagination_info = request_response.pagination
-        
-        # Process requests
-        while True:
-            # Process current page
-            for request in requests:
-                transaction = {
-                    'type': 'REQUEST',
-                    'id': request.id_,
-                    'created': request.created,
-                    'updated': request.updated,
-                    'amount': request.amount_inquired.value,
-                    'currency': request.amount_inquired.currency,
-                    'description': request.description,
-                    'status': request.status,
-                    'counterparty_iban': request.counterparty_alias.label_monetary_account._iban
-                }
-                transactions.append(transaction)
-            
-            # Check if there are more pages
-            if not pagination_info.has_next_page_assured():
-                break
-                
-            # Fetch next page
-            request_response = RequestInquiryApiObject.list(params=pagination_info.url_params_next_page)
-            requests = request_response.value
-            pagination_info = request_response.pagination
-                
+        account_ids = list_monetary_account_ids()
     except Exception as e:
-        print(f"Error fetching requests: {str(e)}")
+        # Fall back to the primary account only
+        print(f"Error listing monetary accounts: {str(e)}")
+        account_ids = [BunqContext.user_context().primary_monetary_account.id_]
+    print(f"Fetching transactions of {len(account_ids)} monetary accounts")
+    
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for account_id in account_ids:
+            jobs[pool.submit(_fetch_account_objects, "GET payment", PaymentApiObject, _payment_to_transaction, account_id)] = ('payments', account_id)
+            jobs[pool.submit(_fetch_account_objects, "GET request-inquiry", RequestInquiryApiObject, _request_to_transaction, account_id)] = ('requests', account_id)
+        
+        for future in as_completed(jobs):
+            kind, account_id = jobs[future]
+            try:
+                transactions.extend(future.result())
+            except Exception as e:
+                print(f"Error fetching {kind} of account {account_id}: {str(e)}")
     
     # Sort transactions by creation date (newest first)
-    transactions.sort(key=lambda x: x['created'], reverse=True)
+    transactions.sort(key=lambda x: x.created_us, reverse=True)
     
     return transactions
 
 
-def extract_transaction_agents(transactions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def extract_transaction_agents(transactions: List[TransactionRecord]) -> List[Dict[str, Any]]:
     """
     Extract unique agents (counterparties) with whom the main user has interacted.
     Focuses exclusively on IBAN identifiers.
-    Does not give guarantees on the order of the agents.
+    
+    The statistics are computed in a single pass over a columnar transaction
+    table (see transaction_table.aggregate_counterparties). Agents are sorted
+    by transaction count, most active first.
     
     Args:
-        transactions: List of transaction dictionaries
+        transactions: List of transaction records
     
     Returns:
         List of dictionaries containing agent details
     """
-    # Track unique agents by IBAN
-    agents_by_iban = {}
+    table = TransactionTable.from_transactions(transactions)
+    stats = aggregate_counterparties(table)
+    
+    if stats['skipped']:
+        print(f"Skipped {stats['skipped']} transactions with no IBAN")
+    if table.invalid_amounts:
+        print(f"Skipped {len(table.invalid_amounts)} transactions with an invalid amount: {table.invalid_amounts}")
+    
+    agents_list = []
+    for index, iban in enumerate(table.ibans):
+        agents_list.append({
+            'iban': iban,
+            'transaction_count': stats['count'][index],
+            'transaction_ids': stats['transaction_ids'][index],
+            'total_amount': stats['signed_total'][index] / 100,
+            'absolute_amount': stats['absolute_total'][index] / 100,
+            'payment_count': stats['payments'][index],
+            'request_count': stats['requests'][index],
+            'first_transaction': micros_to_created(stats['first'][index]),
+            'last_transaction': micros_to_created(stats['last'][index])
+        })
     
-    # Process all transactions
-    for transaction in transactions:
-        iban = transaction.get('counterparty_iban')
-        
-        # Skip if no IBAN
-        if not iban:
-            print(f"Skipping transaction with no IBAN: {transaction}")
-            continue
-            
-        # Track by IBAN
-        if iban not in agents_by_iban:
-            agents_by_iban[iban] = {
-                'iban': iban,
-                'transaction_count': 1,
-                'transaction_ids': [transaction['id']],
-                'total_amount': float(transaction['amount']),
-                'first_transaction': transaction['created'],
-                'last_transaction': transaction['created']
-            }
-        # Add agent to list
-        else:
-            agents_by_iban[iban]['transaction_count'] += 1
-            agents_by_iban[iban]['transaction_ids'].append(transaction['id'])
-            agents_by_iban[iban]['total_amount'] += float(transaction['amount'])
-    
-    # Convert to list and sort by transaction count
-    agents_list = list(agents_by_iban.values())
     agents_list.sort(key=lambda x: x['transaction_count'], reverse=True)
     
     return agents_list
@@ -157,8 +219,9 @@ def create_agent_users(agents: List[Dict[str, Any]], main_user_iban: str, output
     Create new users for each identified agent (based on IBAN) and 
     store their API contexts in the provided directory.
     
-    Uses a pair file to track IBAN-to-user map to avoid creating
-    duplicate users for the same IBAN.
+    Uses the IBAN-user store (see pair_store.IbanUserStore) to track the
+    IBAN-to-user map and avoid creating duplicate users for the same IBAN.
+    An existing iban_user_pairs.json file is imported on first use.
     
     Args:
         agents: List of dictionaries containing agent details
@@ -171,36 +234,25 @@ def create_agent_users(agents: List[Dict[str, Any]], main_user_iban: str, output
     os.makedirs(output_dir, exist_ok=True)
 
     # Initialize constants
-    pair_file_path = f"{output_dir}/iban_user_pairs.json"
     sandbox_user_url = "https://public-api.sandbox.bunq.com/v1/sandbox-user-person"
     
-    # Map of new users to original IBANs
-    iban_to_user_map = {}
-
-    # Check if pair file exists
-    if os.path.exists(pair_file_path):
-        try:
-            with open(pair_file_path, 'r') as f:
-                iban_to_user_map = json.load(f)
-                print(f"Loaded {len(iban_to_user_map)} existing IBAN-user mappings from pair file")
-        except Exception as e:
-            print(f"Error loading pair file: {str(e)}")
-            # Continue with empty mapping if file can't be read
+    store = IbanUserStore.for_directory(output_dir)
+    print(f"Loaded {len(store)} existing IBAN-user mappings from {store.path}")
     
-    # Create a new user for each agent that's not already in the pair file
+    # Create a new user for each agent that's not already in the store
     for i, agent in enumerate(agents):
         print(f"Processing agent {i+1} of {len(agents)}")
         iban = agent['iban']
         
         # Skip if already in the mapping
-        if iban in iban_to_user_map:
-            context_file_path = iban_to_user_map[iban].get('context_file_path')
+        existing = store.get(iban)
+        if existing:
+            context_file_path = existing.get('context_file_path')
             if context_file_path and os.path.exists(context_file_path):
-                iban_to_user_map[iban]['original_agent'] = agent
                 continue
             else:
-                # Remove from map since file is missing
-                iban_to_user_map.pop(iban, None)
+                # Remove from store since file is missing
+                store.delete(iban)
             
         # Create filename with IBAN
         safe_iban = iban.replace(" ", "").replace(".", "_")
@@ -222,8 +274,8 @@ def create_agent_users(agents: List[Dict[str, Any]], main_user_iban: str, output
             
             if new_user:
                 # Load the API context to get the IBAN of the new account
-                api_context = ApiContext.restore(new_user['context_file_path'])
-                BunqContext.load_api_context(api_context)
+                api_context = get_context(new_user['context_file_path'])
+                load_api_context(api_context)
                 
                 # Get the user's monetary account to extract their IBAN
                 user_context = BunqContext.user_context()
@@ -238,36 +290,30 @@ def create_agent_users(agents: List[Dict[str, Any]], main_user_iban: str, output
                 
                 is_main_user = (iban == main_user_iban)
                 
-                # Store mapping from IBAN to new user
-                iban_to_user_map[iban] = {
+                # Store mapping from IBAN to new user (one small transaction per user)
+                store.put(iban, {
                     'api_key': new_user['api_key'],
                     'context_file_path': new_user['context_file_path'],
                     'iban': iban,
                     'copy_iban': new_user_iban,  # Store the new user's actual IBAN
+                    'user_id': user_context.user_id,
                     'is_main_user': is_main_user,
                     'original_agent': agent
-                }
+                })
                 print(f"Successfully created user for IBAN {iban} (New account IBAN: {new_user_iban})")
-                
-                # Save the updated pair file after each successful creation
-                try:
-                    with open(pair_file_path, 'w') as f:
-                        json.dump(iban_to_user_map, f, indent=2)
-                except Exception as e:
-                    print(f"Error saving pair file: {str(e)}")
             else:
                 print(f"Failed to create user for IBAN {iban}")
                 
         except Exception as e:
             print(f"Error creating user for IBAN {iban}: {str(e)}")
     
-    # Save the final pair file
-    try:
-        with open(pair_file_path, 'w') as f:
-            json.dump(iban_to_user_map, f, indent=2)
-        print(f"Saved IBAN-user mappings to {pair_file_path}")
-    except Exception as e:
-        print(f"Error saving pair file: {str(e)}")
+    iban_to_user_map = store.as_map()
+    store.close()
+    
+    # Keep the full agent details in memory for the callers
+    for agent in agents:
+        if agent['iban'] in iban_to_user_map:
+            iban_to_user_map[agent['iban']]['original_agent'] = agent
     
     # Print summary
     print(f"\nTotal of {len(iban_to_user_map)} agent users available")
@@ -275,78 +321,19 @@ def create_agent_users(agents: List[Dict[str, Any]], main_user_iban: str, output
     return iban_to_user_map
 
 
-def calculate_agent_initial_balances(transactions: List[Dict[str, Any]], agents: List[Dict[str, Any]], buffer_amount: float = 1000.0) -> Dict[str, float]:
-    """
-    Calculate the minimum initial balance each agent needs to have
-    to successfully execute all their transactions chronologically.
-    
-    The algorithm works by:
-    1. Sorting all transactions by date (oldest first)
-    2. Simulating the flow of money for each agent
-    3. Tracking the lowest balance point for each agent
-    4. The minimum initial balance is the absolute value of the lowest negative balance
-       (or 0 if the balance never goes negative)
-    5. Adding a buffer amount to ensure there are no insufficient funds issues
-    
-    Args:
-        transactions: List of transaction dictionaries
-        agents: List of agent dictionaries with IBAN identifiers
-        buffer_amount: Extra amount to add as a safety margin (default: 100.0)
-    
-    Returns:
-        Dictionary mapping each IBAN to its required minimum initial balance
-    """
-    # Create maps of: IBAN to agent info, IBAN to agent balances, IBAN to agent min balances
-    iban_to_agent = {agent['iban']: agent for agent in agents}
-    agent_balances = {agent['iban']: 0.0 for agent in agents}
-    agent_min_balances = {agent['iban']: 0.0 for agent in agents}
-    
-    # Sort transactions by date
-    sorted_transactions = sorted(transactions, key=lambda x: x['created'])
-    
-    # Process transactions
-    for transaction in sorted_transactions:
-        iban = transaction.get('counterparty_iban')
-        if not iban or iban not in iban_to_agent:
-            continue
-            
-        amount = float(transaction['amount'])
-        transaction_type = transaction['type']
-        
-        # Calculate balance
-        if transaction_type == 'PAYMENT':
-            agent_balances[iban] += amount
-        elif transaction_type == 'REQUEST' and transaction.get('status') == 'ACCEPTED':
-            agent_balances[iban] -= amount
-            
-            # Update minimum balance if this creates a new low point
-            if agent_balances[iban] < agent_min_balances[iban]:
-                agent_min_balances[iban] = agent_balances[iban]
-    
-    # Calculate required initial balance for each agent
-    required_initial_balances = {}
-    for iban, min_balance in agent_min_balances.items():
-        if min_balance < 0:
-            # Add buffer amount to ensure sufficient funds
-            required_initial_balances[iban] = abs(min_balance) + buffer_amount
-        else:
-            # Even for positive balance agents, add a small buffer to avoid issues
-            required_initial_balances[iban] = buffer_amount
-    
-    print(f"Added buffer amount of €{buffer_amount:.2f} to all agent initial balances for safety")
-            
-    return required_initial_balances
-
-
-def request_initial_balances(iban_to_user_map: Dict[str, Dict[str, Any]], required_balances: Dict[str, float], sugar_daddy_email: str = "sugardaddy@bunq.com") -> Dict[str, Any]:
+def request_initial_balances(iban_to_user_map: Dict[str, Dict[str, Any]], required_balances: Dict[str, float], sugar_daddy_email: str = "sugardaddy@bunq.com", main_user_path: Optional[str] = None) -> Dict[str, Any]:
     """
     Makes payment requests from each agent account to the sugar daddy account
     for their required initial balance.
     
+    If a main user path is given and the required balances contain an entry for
+    the main user (see funding.MAIN_USER_KEY), the main user is funded as well.
+    
     Args:
         iban_to_user_map: Dictionary mapping IBANs to user information
         required_balances: Dictionary mapping IBANs to required initial balances
         sugar_daddy_email: Email of the sugar daddy account to request money from
+        main_user_path: Optional path to the main user's API context file
         
     Returns:
         Dictionary with results of the request operations
@@ -362,8 +349,13 @@ def request_initial_balances(iban_to_user_map: Dict[str, Dict[str, Any]], requir
     if BunqContext.api_context():
         original_api_context = BunqContext.api_context()
     
+    # Accounts to fund: every agent, plus the main user if requested
+    accounts_to_fund = dict(iban_to_user_map)
+    if main_user_path and MAIN_USER_KEY in required_balances:
+        accounts_to_fund[MAIN_USER_KEY] = {'context_file_path': main_user_path}
+    
     # Process each agent
-    for iban, user_info in iban_to_user_map.items():
+    for iban, user_info in accounts_to_fund.items():
         # Skip if no initial balance required
         if iban not in required_balances or required_balances[iban] <= 0:
             results['skipped'].append({
@@ -383,19 +375,22 @@ def request_initial_balances(iban_to_user_map: Dict[str, Dict[str, Any]], requir
             
         try:
             # Load the agent's API context
-            api_context = ApiContext.restore(context_path)
-            BunqContext.load_api_context(api_context)
+            api_context = get_context(context_path)
+            load_api_context(api_context)
             
             # Format the amount with 2 decimal places
             amount = f"{required_balances[iban]:.2f}"
             description = f"Initial balance request for agent with IBAN: {iban}"
             
             # Create a payment request to sugar daddy
-            request = RequestInquiryApiObject.create(
+            request = call_with_retry(
+                "POST request-inquiry",
+                RequestInquiryApiObject.create,
                 amount_inquired=AmountObject(amount, "EUR"),
                 counterparty_alias=PointerObject("EMAIL", sugar_daddy_email, "Sugar Daddy"),
                 description=description,
-                allow_bunqme=True  # Allow bunq.me payment link
+                allow_bunqme=True,  # Allow bunq.me payment link
+                custom_headers=idempotency_headers()
             )
             
             if request and hasattr(request, 'value'):
@@ -421,7 +416,7 @@ def request_initial_balances(iban_to_user_map: Dict[str, Dict[str, Any]], requir
             
     # Restore original API context if there was one
     if original_api_context:
-        BunqContext.load_api_context(original_api_context)
+        load_api_context(original_api_context)
             
     # Print summary
     print("\n=== INITIAL BALANCE REQUESTS SUMMARY ===")
@@ -432,15 +427,16 @@ def request_initial_balances(iban_to_user_map: Dict[str, Dict[str, Any]], requir
     return results
 
 
-def print_transaction_summary(transactions: List[Dict[str, Any]]) -> None:
+def print_transaction_summary(transactions: List[TransactionRecord]) -> None:
     """
     Print a summary of the transactions.
     
     Args:
-        transactions: List of transaction dictionaries
+        transactions: List of transaction records
     """
-    payment_count = sum(1 for t in transactions if t['type'] == 'PAYMENT')
-    request_count = sum(1 for t in transactions if t['type'] == 'REQUEST')
+    transactions = as_records(transactions)
+    payment_count = sum(1 for t in transactions if t.type == 'PAYMENT')
+    request_count = sum(1 for t in transactions if t.type == 'REQUEST')
     
     print(f"\n=== TRANSACTION SUMMARY ===")
     print(f"Total transactions: {len(transactions)}")
@@ -450,10 +446,10 @@ def print_transaction_summary(transactions: List[Dict[str, Any]]) -> None:
     
     print("Recent transactions:")
     for i, transaction in enumerate(transactions[:5]):
-        if transaction['type'] == 'PAYMENT':
-            print(f"{i+1}. PAYMENT: {transaction['amount']} {transaction['currency']} - {transaction['description']}")
+        if transaction.type == 'PAYMENT':
+            print(f"{i+1}. PAYMENT: {transaction.amount} {transaction.currency} - {transaction.description}")
         else:
-            print(f"{i+1}. REQUEST: {transaction['amount']} {transaction['currency']} - {transaction['description']} ({transaction['status']})")
+            print(f"{i+1}. REQUEST: {transaction.amount} {transaction.currency} - {transaction.description} ({transaction.status})")
 
 
 def print_agent_balance_requirements(required_balances: Dict[str, float]) -> None:
@@ -499,7 +495,8 @@ def print_agents_summary(agents: List[Dict[str, Any]]) -> None:
     for i, agent in enumerate(agents[:5]):
         print(f"{i+1}. IBAN: {agent['iban']}")
         print(f"   Transactions: {agent['transaction_count']}")
-        print(f"   Total amount: {agent['total_amount']:.2f}")
+        print(f"   Total amount: {agent['total_amount']:.2f} (absolute: {agent['absolute_amount']:.2f})")
+        print(f"   Payments / requests: {agent['payment_count']} / {agent['request_count']}")
         print(f"   First transaction: {agent['first_transaction']}")
         print(f"   Last transaction: {agent['last_transaction']}")
         print("")
@@ -520,7 +517,7 @@ def print_iban_user_mapping(iban_to_user_map: Dict[str, Dict[str, Any]], require
     for iban, user_info in iban_to_user_map.items():
         # Check if this is a new or existing path
         context_path = user_info['context_file_path']
-        is_new = not os.path.exists(f"users/copy/iban_user_pairs.json.bak") and os.path.exists(context_path)
+        is_new = not os.path.exists(f"users/copy/{PAIR_STORE_FILENAME}.bak") and os.path.exists(context_path)
         
         if is_new:
             new_users_count += 1
@@ -555,8 +552,8 @@ def get_iban_from_context_file(context_file_path: str) -> str:
     """
     try:
         # Load the API context
-        api_context = ApiContext.restore(context_file_path)
-        BunqContext.load_api_context(api_context)
+        api_context = get_context(context_file_path)
+        load_api_context(api_context)
         
         # Get the user's monetary account
         user_context = BunqContext.user_context()
@@ -589,30 +586,30 @@ def get_iban_from_context_file(context_file_path: str) -> str:
 
 def update_agent_copy_ibans(output_dir: str = "users/copy/") -> Dict[str, Dict[str, Any]]:
     """
-    Update the copy_iban field for all agent accounts in the iban_user_pairs.json file.
+    Update the copy_iban field for all agent accounts in the IBAN-user store.
     This is useful when the copy_iban field is missing or showing as 'Unknown'.
     
     Args:
-        output_dir: Directory containing the agent API contexts and pair file
+        output_dir: Directory containing the agent API contexts and the store
         
     Returns:
         Updated iban_to_user_map dictionary
     """
-    # Path to the pair file
-    pair_file_path = f"{output_dir}/iban_user_pairs.json"
+    store_path = os.path.join(output_dir, PAIR_STORE_FILENAME)
+    legacy_path = os.path.join(output_dir, LEGACY_PAIR_FILENAME)
     
-    # Check if pair file exists
-    if not os.path.exists(pair_file_path):
-        print(f"Pair file not found at {pair_file_path}")
+    # Check if there is anything to update
+    if not os.path.exists(store_path) and not os.path.exists(legacy_path):
+        print(f"IBAN-user store not found at {store_path}")
         return {}
         
     # Load existing mappings
     try:
-        with open(pair_file_path, 'r') as f:
-            iban_to_user_map = json.load(f)
-            print(f"Loaded {len(iban_to_user_map)} user mappings from pair file")
+        store = IbanUserStore.for_directory(output_dir)
+        iban_to_user_map = store.as_map()
+        print(f"Loaded {len(iban_to_user_map)} user mappings from {store.path}")
     except Exception as e:
-        print(f"Error loading pair file: {str(e)}")
+        print(f"Error loading IBAN-user store: {str(e)}")
         return {}
     
     # Save the original API context if there was one
@@ -621,7 +618,7 @@ def update_agent_copy_ibans(output_dir: str = "users/copy/") -> Dict[str, Dict[s
         original_api_context = BunqContext.api_context()
     
     # Track updated entries
-    updated_count = 0
+    updated = {}
     
     # Update each mapping that doesn't have a copy_iban or has it set to Unknown
     for iban, user_info in iban_to_user_map.items():
@@ -630,63 +627,76 @@ def update_agent_copy_ibans(output_dir: str = "users/copy/") -> Dict[str, Dict[s
             continue
             
         # Get context file path - fix potential path issues
-        context_path = user_info.get('context_file_path')
-        if context_path and not os.path.exists(context_path):
-            # Try prepending "v2/" if not found
-            alt_path = f"v2/{context_path}"
-            if os.path.exists(alt_path):
-                context_path = alt_path
-                print(f"Found context file at alternate path: {alt_path}")
-        
-        if not context_path or not os.path.exists(context_path):
-            print(f"Context file not found for IBAN {iban}: {context_path}")
+        context_path = resolve_context_path(user_info.get('context_file_path'))
+        if not context_path:
+            print(f"Context file not found for IBAN {iban}: {user_info.get('context_file_path')}")
             continue
             
         # Get IBAN from context file - using improved function
         copy_iban = get_iban_from_context_file(context_path)
         if copy_iban:
             user_info['copy_iban'] = copy_iban
-            updated_count += 1
+            updated[iban] = copy_iban
             print(f"Updated copy IBAN for {iban}: {copy_iban}")
         else:
             print(f"Could not find IBAN in context file for {iban}")
     
     # Restore original API context if there was one
     if original_api_context:
-        BunqContext.load_api_context(original_api_context)
+        load_api_context(original_api_context)
     
-    # Save the updated pair file
-    if updated_count > 0:
+    # Write all updates in one transaction
+    if updated:
         try:
-            with open(pair_file_path, 'w') as f:
-                json.dump(iban_to_user_map, f, indent=2)
-            print(f"Saved {updated_count} updated IBAN mappings to {pair_file_path}")
+            with store:
+                for iban, copy_iban in updated.items():
+                    store.set_copy_iban(iban, copy_iban)
+            print(f"Saved {len(updated)} updated IBAN mappings to {store.path}")
         except Exception as e:
-            print(f"Error saving pair file: {str(e)}")
+            print(f"Error saving IBAN-user store: {str(e)}")
     else:
         print("No IBAN mappings were updated")
     
+    store.close()
+    
     return iban_to_user_map
 
 
-def replay_transactions_chronologically(transactions: List[Dict[str, Any]], iban_to_user_map: Dict[str, Dict[str, Any]], main_user_path: str) -> Dict[str, Any]:
+def replay_transactions_chronologically(transactions: List[TransactionRecord], iban_to_user_map: Dict[str, Dict[str, Any]], main_user_path: str, speed: Optional[float] = None, processes: int = 1, dry_run: bool = False) -> Dict[str, Any]:
     """
     Replay all transactions between users (including the main user) in chronological order.
     
     The function:
-    1. Sorts all transactions by date (oldest first)
-    2. For each transaction, logs in as the appropriate user (sender)
-    3. Creates the payment/request to the appropriate recipient
-    4. Maintains a log of all operations
+    1. Compiles the transactions into a replay plan (see replay_plan.compile_replay_plan),
+       which sorts them by date and decides sender and recipient for each one
+    2. Reports every transaction that can't be replayed before anything is sent
+    3. For each step, logs in as the sender and creates the payment/request
+    4. Settles every replayed request with its original status on the main
+       user's side, concurrently with the replay (see responder.py)
+    5. Maintains a log of all operations
+    
+    When a speed factor is given, the original time between transactions is
+    reproduced, scaled by that factor (1 = real time, 60 = one hour per minute),
+    and the lag between the scheduled and the actual send time is reported.
+    
+    With more than one process the agents are sharded over a process pool
+    (see sharding.replay_sharded). Timed replays always run in one process.
     
     Args:
-        transactions: List of transaction dictionaries
+        transactions: List of transaction records
         iban_to_user_map: Dictionary mapping IBANs to user information
         main_user_path: Path to the main user's API context file
+        speed: Optional time compression factor for the replay clock
+        processes: Number of worker processes to shard the replay over
+        dry_run: If True, only compile and report the plan without sending anything
         
     Returns:
         Dictionary with results of the replay operations
     """
+    if processes > 1 and not speed and not dry_run:
+        from sharding import replay_sharded
+        return replay_sharded(transactions, iban_to_user_map, main_user_path, processes)
+    
     results = {
         'success': [],
         'failed': [],
@@ -699,210 +709,37 @@ def replay_transactions_chronologically(transactions: List[Dict[str, Any]], iban
     print(f"Total agent mappings available: {len(iban_to_user_map)}")
     print(f"Main user path: {main_user_path}")
     
-    # Create a reverse mapping from copy_iban to original iban for easier lookups
-    copy_iban_to_original = {}
-    for original_iban, user_info in iban_to_user_map.items():
-        copy_iban = user_info.get('copy_iban')
-        if copy_iban:
-            copy_iban_to_original[copy_iban] = original_iban
-    
     print(f"Original IBAN to Copy IBAN mappings:")
     for original_iban, user_info in iban_to_user_map.items():
         print(f"  {original_iban} → {user_info.get('copy_iban', 'Unknown')}")
     
-    # Get the main user API context
-    try:
-        main_api_context = ApiContext.restore(main_user_path)
-        
-        # Retrieve main user's IBAN using the improved function
-        main_user_copy_iban = get_iban_from_context_file(main_user_path)
-        
-        if not main_user_copy_iban:
-            print("ERROR: Could not find IBAN for main user copy")
-            return results
-        
-        print(f"Main user copy IBAN: {main_user_copy_iban}")
-    except Exception as e:
-        print(f"Error loading main user API context: {str(e)}")
+    # Retrieve main user's IBAN using the improved function
+    main_user_copy_iban = get_iban_from_context_file(main_user_path)
+    if not main_user_copy_iban:
+        print("ERROR: Could not find IBAN for main user copy")
         return results
+    print(f"Main user copy IBAN: {main_user_copy_iban}")
     
-    # Save current API context if any
-    original_api_context = None
-    if BunqContext.api_context():
-        original_api_context = BunqContext.api_context()
+    # Decide everything up front and report what will be skipped
+    plan = compile_replay_plan(transactions, iban_to_user_map, main_user_path, main_user_copy_iban)
+    print_replay_plan(plan)
     
-    # Sort transactions by date (oldest first)
-    sorted_transactions = sorted(transactions, key=lambda x: x['created'])
-    
-    # Process each transaction
-    for i, transaction in enumerate(sorted_transactions):
-        transaction_type = transaction.get('type')
-        original_iban = transaction.get('counterparty_iban')
-        transaction_id = transaction.get('id')
-        amount_str = transaction.get('amount')
-        currency = transaction.get('currency', 'EUR')
-        description = transaction.get('description', 'Replayed transaction')
-        
-        # Skip if no IBAN (can't identify counterparty)
-        if not original_iban:
-            results['skipped'].append({
-                'transaction_id': transaction_id,
-                'reason': 'No counterparty IBAN found'
-            })
-            continue
-            
-        # Verify this original IBAN is in our map
-        if original_iban not in iban_to_user_map:
-            results['skipped'].append({
-                'transaction_id': transaction_id,
-                'reason': f'Original IBAN {original_iban} not found in user map'
-            })
-            continue
-        
-        # Get the copy IBAN for this counterparty
-        agent_copy_iban = iban_to_user_map[original_iban].get('copy_iban')
-        if not agent_copy_iban:
-            results['skipped'].append({
-                'transaction_id': transaction_id,
-                'reason': f'Copy IBAN for {original_iban} not available'
-            })
-            continue
-            
-        # Get the context file for this agent - handle path issues
-        agent_context_path = iban_to_user_map[original_iban].get('context_file_path')
-        if agent_context_path and not os.path.exists(agent_context_path):
-            # Try prepending "v2/" if not found
-            alt_path = f"v2/{agent_context_path}"
-            if os.path.exists(alt_path):
-                agent_context_path = alt_path
-                print(f"Found context file at alternate path: {alt_path}")
-                
-        if not agent_context_path or not os.path.exists(agent_context_path):
-            results['skipped'].append({
-                'transaction_id': transaction_id,
-                'reason': f'Context file for {original_iban} not found: {agent_context_path}'
-            })
-            continue
-            
-        try:
-            # Parse the amount to determine direction
-            try:
-                # Convert amount to float to check sign
-                amount_value = float(amount_str)
-                is_negative = amount_value < 0
-                # Get absolute amount for the API call (API always requires positive)
-                formatted_amount = f"{abs(amount_value):.2f}"
-            except (ValueError, TypeError):
-                # If conversion fails, log and skip
-                results['skipped'].append({
-                    'transaction_id': transaction_id,
-                    'reason': f'Invalid amount format: {amount_str}'
-                })
-                print(f"[{i+1}/{len(sorted_transactions)}] Skipping transaction with invalid amount: {amount_str}")
-                continue
-                
-            # Determine transaction direction and setup sender/recipient accordingly
-            if transaction_type == 'PAYMENT':
-                if is_negative:
-                    # Money going OUT from main account (negative amount)
-                    # Main user sends money to agent
-                    print(f"Payment: Main user → Agent {original_iban}")
-                    sender_context = main_api_context
-                    recipient_iban = agent_copy_iban
-                    recipient_type = "IBAN"
-                    sender_name = "Main User"
-                    recipient_name = f"Agent {original_iban[-4:]}"
-                else:
-                    # Money coming IN to main account (positive amount)
-                    # Agent sends money to main user
-                    print(f"Payment: Agent {original_iban} → Main user")
-                    sender_context = ApiContext.restore(agent_context_path)
-                    recipient_iban = main_user_copy_iban
-                    recipient_type = "IBAN"
-                    sender_name = f"Agent {original_iban[-4:]}"
-                    recipient_name = "Main User"
-            else:  # REQUEST
-                # Agent requests money from main user
-                print(f"Request: Agent {original_iban} → Main user")
-                sender_context = ApiContext.restore(agent_context_path)
-                recipient_iban = main_user_copy_iban
-                recipient_type = "IBAN"
-                sender_name = f"Agent {original_iban[-4:]}"
-                recipient_name = "Main User"
-            
-            # Load the sender's context
-            BunqContext.load_api_context(sender_context)
-            
-            # Create the transaction
-            if transaction_type == 'PAYMENT':
-                # Create a payment with display_name parameter
-                response = PaymentApiObject.create(
-                    amount=AmountObject(formatted_amount, currency),
-                    counterparty_alias=PointerObject(recipient_type, recipient_iban, recipient_name),
-                    description=f"Replay: {description}"
-                )
-                
-                if response and hasattr(response, 'value'):
-                    results['success'].append({
-                        'original_id': transaction_id,
-                        'new_id': response.value,
-                        'type': 'PAYMENT',
-                        'amount': formatted_amount,
-                        'description': description,
-                        'from': sender_name,
-                        'to': recipient_name,
-                        'original_amount': amount_str
-                    })
-                    print(f"[{i+1}/{len(sorted_transactions)}] Successfully replayed payment of {formatted_amount} {currency} from {sender_name} to {recipient_name}")
-                else:
-                    raise Exception("Payment creation failed - no ID returned")
-                    
-            elif transaction_type == 'REQUEST':
-                # Create a request with display_name parameter
-                response = RequestInquiryApiObject.create(
-                    amount_inquired=AmountObject(formatted_amount, currency),
-                    counterparty_alias=PointerObject(recipient_type, recipient_iban, recipient_name),
-                    description=f"Replay: {description}",
-                    allow_bunqme=True
-                )
-                
-                if response and hasattr(response, 'value'):
-                    results['success'].append({
-                        'original_id': transaction_id,
-                        'new_id': response.value,
-                        'type': 'REQUEST',
-                        'amount': formatted_amount,
-                        'description': description,
-                        'from': sender_name,
-                        'to': recipient_name,
-                        'original_amount': amount_str
-                    })
-                    print(f"[{i+1}/{len(sorted_transactions)}] Successfully replayed request of {formatted_amount} {currency} from {sender_name} to {recipient_name}")
-                else:
-                    raise Exception("Request creation failed - no ID returned")
-            
-            # Add a small delay to avoid rate limiting
-            time.sleep(0.5)
-                
-        except Exception as e:
-            results['failed'].append({
-                'transaction_id': transaction_id,
-                'reason': str(e),
-                'type': transaction_type,
-                'iban': original_iban,
-                'amount': amount_str
-            })
-            print(f"[{i+1}/{len(sorted_transactions)}] Error replaying {transaction_type} for IBAN {original_iban}: {str(e)}")
+    if dry_run:
+        results['skipped'] = plan['skipped']
+        return results
     
-    # Restore original API context if there was one
-    if original_api_context:
-        BunqContext.load_api_context(original_api_context)
+    results = execute_replay_plan(plan, speed=speed)
             
     # Print summary
     print("\n=== TRANSACTION REPLAY SUMMARY ===")
     print(f"Successful replays: {len(results['success'])}")
     print(f"Failed replays: {len(results['failed'])}")
     print(f"Skipped transactions: {len(results['skipped'])}")
+    if 'settled' in results:
+        print(f"Settled requests: {len(results['settled'])} (unsettled: {len(results['unsettled'])})")
+    
+    if results.get('lag') and results['lag']['count']:
+        print(f"Send lag: mean {results['lag']['mean']:.3f}s, p95 {results['lag']['p95']:.3f}s, max {results['lag']['max']:.3f}s")
     
     return results
 
@@ -935,6 +772,13 @@ def print_replay_results(results: Dict[str, Any]) -> None:
             print(f"  Reason: {txn['reason']}")
             print()
     
+    if results.get('unsettled'):
+        print("\nUNSETTLED REQUESTS:")
+        for txn in results['unsettled']:
+            print(f"Transaction ID: {txn['transaction_id']}")
+            print(f"  Reason: {txn['reason']}")
+            print()
+    
     if results['skipped']:
         print("\nSKIPPED TRANSACTIONS:")
         for txn in results['skipped']:
@@ -1,33 +1,84 @@
 from typing import List, Dict, Any
 import json
+import os
+import sys
 import time
 from datetime import datetime
 
-def to_visualizer_format(transactions: List[Dict[str, Any]], agents: List[Dict[str, Any]], sugar_mode: bool = False) -> List[Dict[str, Any]]:
+from transaction_table import TransactionRecord, as_records
+from funding import MAIN_USER_KEY, transaction_flow
+
+# The scenario optimiser of the UI lives in the repository root. Appended, so
+# the history modules (e.g. history/api.py) keep precedence over the root ones.
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.append(ROOT_DIR)
+
+from scenario_optimizer import action_accounts
+
+
+# User index and account id of the main user in generated scenarios
+MAIN_USER_ID = 0
+MAIN_ACCOUNT_ID = "0"
+
+
+def build_account_namespace(agents: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Give the main user and every agent its own user index and account id.
+
+    The main user always gets user 0 and account "0"; agents follow in the
+    order of the agents list, so agent i gets user i + 1 and account "i + 1".
+
+    Args:
+        agents: List of agent dictionaries with IBAN identifiers
+
+    Returns:
+        Dictionary mapping MAIN_USER_KEY and every agent IBAN to a dict with
+        'user_id' and 'account_id'
+    """
+    namespace = {MAIN_USER_KEY: {'user_id': MAIN_USER_ID, 'account_id': MAIN_ACCOUNT_ID}}
+    for agent in agents:
+        if agent['iban'] not in namespace:
+            user_id = len(namespace)
+            namespace[agent['iban']] = {'user_id': user_id, 'account_id': str(user_id)}
+    return namespace
+
+
+def to_visualizer_format(transactions: List[TransactionRecord], agents: List[Dict[str, Any]], sugar_mode: bool = False) -> List[Dict[str, Any]]:
     """
     Convert transactions and agents into a format suitable for visualization.
+
+    The main user and every agent get their own user and account (see
+    build_account_namespace), and each transaction is sent from the account
+    that paid or requested it in the original history, following the same
+    direction rules as the replay (funding.transaction_flow). Transactions
+    with a counterparty that isn't one of the agents are left out.
     
     Args:
-        transactions: List of transaction dictionaries
+        transactions: List of transaction records
         agents: List of agent dictionaries
         sugar_mode: If True, enables sugar daddy mode where certain transactions 
                    will be requested from the central authority
     """
     visualization_data = []
+    namespace = build_account_namespace(agents)
     
-    # Create User actions for all agents
-    for idx, agent in enumerate(agents):
+    # Create User actions for the main user and all agents
+    for idx, account in enumerate(namespace.values()):
+        user_id = account['user_id']
+        account_id = account['account_id']
+
         # Create user person action
         visualization_data.append({
             "action_type": "CreateUserPerson",
-            "user_id": idx
+            "user_id": user_id
         })
         
         # Create monetary account action
         visualization_data.append({
             "action_type": "CreateMonetaryAccount",
-            "user_id": idx,
-            "account_id": "0",
+            "user_id": user_id,
+            "account_id": account_id,
             "currency": "EUR",
             "daily_limit_value": 5000.0
         })
@@ -35,8 +86,8 @@ def to_visualizer_format(transactions: List[Dict[str, Any]], agents: List[Dict[s
         # Get account overview action
         visualization_data.append({
             "action_type": "GetAccountOverview",
-            "account_id": "0",
-            "monetary_account_id": "0"
+            "account_id": account_id,
+            "monetary_account_id": account_id
         })
         
         # If sugar mode is enabled, request initial funds from sugar daddy
@@ -47,9 +98,9 @@ def to_visualizer_format(transactions: List[Dict[str, Any]], agents: List[Dict[s
             # Add sugar daddy request
             visualization_data.append({
                 "action_type": "RequestPayment",
-                "user_id": idx,
-                "account_id": "0",
-                "monetary_account_id": "0",
+                "user_id": user_id,
+                "account_id": account_id,
+                "monetary_account_id": account_id,
                 "amount_value": request_amount,
                 "amount_currency": "EUR",
                 "counterparty_account_id": "sugardaddy",  # Special identifier for sugar daddy
@@ -59,82 +110,140 @@ def to_visualizer_format(transactions: List[Dict[str, Any]], agents: List[Dict[s
             })
     
     # Process all transactions
-    for transaction in transactions:
-        if transaction['type'] == 'PAYMENT':
-            user_id = 0  # Default user
-            counterparty_id = "1"  # Default counterparty
+    for transaction in as_records(transactions):
+        if transaction.counterparty_iban not in namespace or transaction.amount_cents is None:
+            continue
+
+        payer, payee, _ = transaction_flow(transaction)
+        amount_value = abs(transaction.amount_cents) / 100
+
+        if transaction.type == 'PAYMENT':
+            sender = namespace[payer]
+            recipient = namespace[payee]
             
             visualization_data.append({
                 "action_type": "MakePayment",
-                "user_id": user_id,
-                "account_id": "0",
-                "monetary_account_id": "0",
-                "amount_value": float(transaction['amount']),
-                "amount_currency": transaction['currency'],
-                "counterparty_iban": transaction.get('counterparty_iban', "NL00BUNQ0000000000"),
-                "counterparty_account_id": counterparty_id
+                "user_id": sender['user_id'],
+                "account_id": sender['account_id'],
+                "monetary_account_id": sender['account_id'],
+                "amount_value": amount_value,
+                "amount_currency": transaction.currency,
+                "counterparty_iban": transaction.counterparty_iban,
+                "counterparty_account_id": recipient['account_id']
             })
             
-            # Add a ListPayments action
-            visualization_data.append({
-                "action_type": "ListPayments",
-                "user_id": user_id,
-                "account_id": "0",
-                "monetary_account_id": "0"
-            })
-            
-        elif transaction['type'] == 'REQUEST':
-            user_id = 0  # Default user
-            counterparty_id = "1"  # Default counterparty
+        elif transaction.type == 'REQUEST':
+            # The payee asks the payer for the money
+            requester = namespace[payee]
+            responder = namespace[payer]
             
             # Get expiry timestamp (1 week from now)
             expiry_timestamp = int(time.time()) + 604800
             
             # Get transaction ID - RequestPayment needs an integer request_response_id
-            request_id = int(transaction.get('id', 0))
+            request_id = int(transaction.id or 0)
             
             # If sugar mode is enabled and amount is above threshold, request from sugar daddy instead
-            target_counterparty_id = counterparty_id
-            if sugar_mode and float(transaction['amount']) > 100.0:
+            target_counterparty_id = responder['account_id']
+            if sugar_mode and abs(transaction.amount_cents) > 10000:
                 target_counterparty_id = "sugardaddy"
             
             visualization_data.append({
                 "action_type": "RequestPayment",
-                "user_id": user_id,
-                "account_id": "0",
-                "monetary_account_id": "0",
-                "amount_value": float(transaction['amount']),
-                "amount_currency": transaction['currency'],
-                "counterparty_iban": transaction.get('counterparty_iban', "NL00BUNQ0000000000"),
+                "user_id": requester['user_id'],
+                "account_id": requester['account_id'],
+                "monetary_account_id": requester['account_id'],
+                "amount_value": amount_value,
+                "amount_currency": transaction.currency,
+                "counterparty_iban": transaction.counterparty_iban,
                 "counterparty_account_id": target_counterparty_id,
                 "expiry_date": expiry_timestamp,
                 "request_response_id": request_id  # Integer for RequestPayment
             })
             
-            # Add a response if status is available
-            if 'status' in transaction:
-                status = "ACCEPTED" if transaction['status'] == "ACCEPTED" else "REJECTED"
+            # Add a response if status is available (sugar daddy answers by itself)
+            if transaction.status and target_counterparty_id != "sugardaddy":
+                status = "ACCEPTED" if transaction.status == "ACCEPTED" else "REJECTED"
                 visualization_data.append({
                     "action_type": "RespondToPaymentRequest",
-                    "user_id": user_id,
-                    "account_id": "0",
-                    "monetary_account_id": "0",
-                    "request_response_id": int(transaction['id']),  # Integer for request_response_id
+                    "user_id": responder['user_id'],
+                    "account_id": responder['account_id'],
+                    "monetary_account_id": responder['account_id'],
+                    "request_response_id": int(transaction.id),  # Integer for request_response_id
                     "status": status,
-                    "counterparty_account_id": counterparty_id  # String for counterparty_account_id
+                    "counterparty_account_id": requester['account_id']  # String for counterparty_account_id
                 })
     
     return visualization_data
 
-def transactions_to_visualizer_format(transactions: List[Dict[str, Any]], agents: List[Dict[str, Any]], sugar_mode: bool = False) -> str:
+# Actions that change the state of the accounts they name
+WRITE_ACTIONS = {"CreateUserPerson", "CreateMonetaryAccount", "MakePayment", "RequestPayment", "RespondToPaymentRequest"}
+
+
+def optimize_actions(actions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Remove redundant read-only actions from a generated action list.
+
+    - A GetAccountOverview is dropped if its account hasn't changed since the
+      previous overview of that account.
+    - Overviews are deferred until an action touches one of the pending
+      accounts (or a Sleep or unknown action comes up), so they end up in
+      consecutive blocks with at most one overview per account, which the
+      interpreter runs as one batch.
+
+    Args:
+        actions: List of actions as generated by to_visualizer_format
+
+    Returns:
+        New list of actions
+    """
+    optimized = []
+    pending = {}
+    changed = set()
+
+    def flush():
+        optimized.extend(pending.values())
+        pending.clear()
+
+    for action in actions:
+        action_type = action.get("action_type")
+
+        if action_type == "GetAccountOverview":
+            account_id = action.get("account_id")
+            # Unchanged since the last overview, or already waiting to be sent
+            if account_id not in changed or account_id in pending:
+                continue
+            changed.discard(account_id)
+            pending[account_id] = dict(action)
+            continue
+
+        if action_type in WRITE_ACTIONS:
+            touched = action_accounts(action)
+            if touched & pending.keys():
+                flush()
+            changed |= touched
+        else:
+            # Sleeps and unknown actions keep their place relative to all reads
+            flush()
+
+        optimized.append(action)
+
+    flush()
+    return optimized
+
+
+def transactions_to_visualizer_format(transactions: List[TransactionRecord], agents: List[Dict[str, Any]], sugar_mode: bool = False, optimize: bool = True) -> str:
     """
     Convert transactions and agents into a string format suitable for visualization.
     
     Args:
-        transactions: List of transaction dictionaries
+        transactions: List of transaction records
         agents: List of agent dictionaries
         sugar_mode: If True, enables sugar daddy mode where certain transactions 
                    will be requested from the central authority
+        optimize: If True, remove redundant read-only actions (see optimize_actions)
     """
     visualization_data = to_visualizer_format(transactions, agents, sugar_mode)
-    return json.dumps(visualization_data, indent=2) 
\ No newline at end of file
+    if optimize:
+        visualization_data = optimize_actions(visualization_data)
+    return json.dumps(visualization_data, indent=2)
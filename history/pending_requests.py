@@ -0,0 +1,116 @@
+from bunq.sdk.model.generated.endpoint import RequestResponseApiObject
+from bunq import Pagination
+
+from collections import deque
+from typing import Dict, List, Optional
+
+from resilience import call_with_retry
+
+
+class PendingRequestIndex:
+    """
+    Index of the PENDING request-responses of a monetary account, keyed by the
+    IBAN of the counterparty that sent the request and the amount, oldest first.
+
+    The first refresh pages through all request-responses of the account;
+    later refreshes only fetch the ones newer than the newest seen so far.
+    The bunq API has no server-side status filter for request-responses, so
+    statuses are filtered while indexing. Ids leave the index when they are
+    taken or popped; callers put back the ones they couldn't respond to.
+
+    Used by the root api.py and by the replay's RequestResponder. Needs the
+    API context of the account's owner to be loaded.
+    """
+
+    PAGE_SIZE = 200
+
+    def __init__(self, monetary_account_id: Optional[int] = None):
+        """
+        Args:
+            monetary_account_id: Account to index; None for the primary account
+        """
+        self.monetary_account_id = monetary_account_id
+        # Counterparty IBAN -> amount -> request-response ids, oldest first
+        self.pending_by_iban: Dict[str, Dict[str, deque]] = {}
+        # Amount of every indexed request-response, so ids can be put back by IBAN only
+        self.amounts: Dict[int, str] = {}
+        self.newest_id = None
+
+    def _list(self, params: Dict[str, str]):
+        return call_with_retry(
+            "GET request-response",
+            RequestResponseApiObject.list,
+            self.monetary_account_id,
+            params=params
+        )
+
+    def _add(self, counterparty_iban: str, amount: str, request_response_id: int) -> None:
+        self.amounts[request_response_id] = amount
+        self.pending_by_iban.setdefault(counterparty_iban, {}).setdefault(amount, deque()).append(request_response_id)
+
+    def _add_page(self, request_responses) -> None:
+        # Pages come newest first; keep every key's ids oldest first
+        for response in reversed(request_responses):
+            if self.newest_id is None or response.id_ > self.newest_id:
+                self.newest_id = response.id_
+            sender = response.counterparty_alias.pointer if response.counterparty_alias else None
+            if response.status != 'PENDING' or not sender or sender.type_ != 'IBAN':
+                continue
+            self._add(sender.value, response.amount_inquired.value, response.id_)
+
+    def refresh(self) -> None:
+        """
+        Fetch the request-responses that arrived since the last refresh.
+        """
+        pagination = Pagination()
+        pagination.count = self.PAGE_SIZE
+
+        if self.newest_id is None:
+            # First load: page from newest to oldest, then index oldest first
+            pages = []
+            response = self._list(pagination.url_params_count_only)
+            pages.append(response.value)
+            while response.pagination.has_next_page_assured():
+                response = self._list(response.pagination.url_params_next_page)
+                pages.append(response.value)
+            for page in reversed(pages):
+                self._add_page(page)
+        else:
+            # Later loads: only what is newer than the newest known request
+            pagination.newer_id = self.newest_id
+            response = self._list(pagination.url_params_previous_page)
+            self._add_page(response.value)
+            while response.value and response.pagination.has_previous_page():
+                response = self._list(response.pagination.url_params_previous_page)
+                self._add_page(response.value)
+
+    def take(self, counterparty_iban: str, amount: str) -> Optional[int]:
+        """
+        Remove and return the oldest pending request-response from a counterparty
+        IBAN for an amount, or None if there is none.
+        """
+        by_amount = self.pending_by_iban.get(counterparty_iban)
+        ids = by_amount.get(amount) if by_amount else None
+        if not ids:
+            return None
+        request_response_id = ids.popleft()
+        if not ids:
+            del by_amount[amount]
+            if not by_amount:
+                del self.pending_by_iban[counterparty_iban]
+        return request_response_id
+
+    def pop(self, counterparty_iban: str) -> List[int]:
+        """
+        Remove and return the ids of all pending request-responses from a
+        counterparty IBAN, oldest first.
+        """
+        by_amount = self.pending_by_iban.pop(counterparty_iban, {})
+        return sorted(request_response_id for ids in by_amount.values() for request_response_id in ids)
+
+    def restore(self, counterparty_iban: str, request_response_ids: List[int]) -> None:
+        """
+        Put back the ids of pending request-responses that couldn't be responded to.
+        """
+        for request_response_id in sorted(request_response_ids):
+            self._add(counterparty_iban, self.amounts[request_response_id], request_response_id)
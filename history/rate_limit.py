@@ -0,0 +1,175 @@
+from typing import Dict, Optional, Tuple
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; buckets are then shared between threads only
+    fcntl = None
+
+
+# Requests allowed per period in seconds, per endpoint class, as documented by bunq
+RATE_LIMITS: Dict[str, Tuple[int, float]] = {
+    'GET': (3, 3.0),
+    'POST': (5, 3.0),
+    'PUT': (2, 3.0),
+    'session': (1, 30.0),
+}
+
+# Resources whose calls count against the session creation limit
+SESSION_RESOURCES = {'session-server'}
+
+# Directory with the shared bucket files of all processes on this host
+DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(), 'bunq_sandman_rate_limit')
+
+# Bucket state: tokens, time of the last update, time until which the class is blocked
+_STATE = struct.Struct('<ddd')
+
+
+def endpoint_class(endpoint: str) -> str:
+    """
+    Map an endpoint name ("<METHOD> <resource>") to its rate limit class.
+    """
+    method, _, resource = endpoint.partition(' ')
+    if resource in SESSION_RESOURCES:
+        return 'session'
+    if method in RATE_LIMITS:
+        return method
+    # DELETE and other writes share the PUT limit
+    return 'PUT'
+
+
+def _reserve(state: Tuple[float, float, float], capacity: int, rate: float, now: float) -> Tuple[Tuple[float, float, float], float]:
+    """
+    Take one token from a bucket state, going into debt if the bucket is empty.
+
+    Returns:
+        Tuple of (new state, seconds the caller has to wait before sending)
+    """
+    tokens, updated, blocked_until = state
+    tokens = min(capacity, tokens + (now - updated) * rate) - 1
+    wait = max(-tokens / rate if tokens < 0 else 0.0, blocked_until - now)
+    return (tokens, now, blocked_until), wait
+
+
+class TokenBucket:
+    """
+    Token bucket for one endpoint class, shared by the threads of this process.
+
+    A caller that finds the bucket empty still takes a token (the bucket goes
+    into debt) and is told how long to wait, so waiting callers are served in
+    the order they arrived.
+    """
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self._state = (float(capacity), time.time(), 0.0)
+        self._lock = threading.Lock()
+
+    def _update(self, change):
+        with self._lock:
+            self._state, result = change(self._state)
+        return result
+
+    def reserve(self) -> float:
+        """
+        Take a token and return the number of seconds to wait before sending.
+        """
+        return self._update(lambda state: _reserve(state, self.capacity, self.rate, time.time()))
+
+    def block(self, seconds: float) -> None:
+        """
+        Hold back all callers for the given number of seconds, e.g. after a 429.
+        """
+        until = time.time() + seconds
+        self._update(lambda state: ((state[0], state[1], max(state[2], until)), None))
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    Token bucket whose state lives in a small file, so that all processes on
+    the host share it. Every update holds an exclusive lock on the file.
+    """
+
+    def __init__(self, capacity: int, period: float, path: str):
+        super().__init__(capacity, period)
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _update(self, change):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = os.pread(fd, _STATE.size, 0)
+                state = _STATE.unpack(data) if len(data) == _STATE.size else (float(self.capacity), time.time(), 0.0)
+                state, result = change(state)
+                os.pwrite(fd, _STATE.pack(*state), 0)
+            finally:
+                os.close(fd)  # Also releases the lock
+        return result
+
+
+class RateLimitGovernor:
+    """
+    Paces sandbox API calls so they stay within the bunq rate limits.
+
+    Each endpoint class (GET, POST, PUT, session creation) has its own token
+    bucket. With shared=True the buckets are kept in files under state_dir
+    and locked on every use, so worker threads and concurrent processes on
+    the same host draw from the same budget.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, float]] = None, state_dir: str = DEFAULT_STATE_DIR, shared: bool = True):
+        """
+        Args:
+            limits: Requests per period for every endpoint class; RATE_LIMITS if not given
+            state_dir: Directory of the shared bucket files
+            shared: If True (and file locks are available), share the buckets between processes
+        """
+        limits = limits or RATE_LIMITS
+        if shared and fcntl is not None:
+            self.buckets = {
+                name: FileTokenBucket(capacity, period, os.path.join(state_dir, f"{name}.bucket"))
+                for name, (capacity, period) in limits.items()
+            }
+        else:
+            self.buckets = {name: TokenBucket(capacity, period) for name, (capacity, period) in limits.items()}
+
+    def acquire(self, endpoint: str) -> float:
+        """
+        Wait until a call to the endpoint may be sent.
+
+        Returns:
+            Number of seconds waited
+        """
+        wait = self.buckets[endpoint_class(endpoint)].reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def block(self, endpoint: str, seconds: float) -> None:
+        """
+        Hold back all calls of the endpoint's class, e.g. after the server answered 429.
+        """
+        self.buckets[endpoint_class(endpoint)].block(seconds)
+
+
+# Governor shared by all API calls of this process
+_governor: Optional[RateLimitGovernor] = None
+_governor_lock = threading.Lock()
+
+
+def get_governor() -> RateLimitGovernor:
+    """
+    Return the process-wide rate limit governor, creating it on first use.
+    """
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = RateLimitGovernor()
+        return _governor
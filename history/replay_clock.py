@@ -0,0 +1,110 @@
+from typing import Dict, Any, Iterable, Iterator, Tuple, Optional, Callable
+import heapq
+import time
+
+
+# Format of the 'created' and 'updated' fields returned by the bunq API
+BUNQ_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+class ReplayClock:
+    """
+    Scheduler that reproduces the original inter-arrival timing of transactions.
+
+    Transactions of all agents are pushed into one priority queue keyed by their
+    due time. The due time is the original offset from the first transaction
+    divided by the speed factor, so a speed of 60 replays one hour of history in
+    one minute. The lag between the scheduled and the actual send time is recorded
+    so the fidelity of the replay can be reported afterwards.
+    """
+
+    def __init__(self, speed: float = 1.0):
+        if speed <= 0:
+            raise ValueError(f"Replay speed must be positive, got {speed}")
+        self.speed = speed
+        self._queue = []
+        self._sequence = 0
+        self._start = None
+        self.lags = []
+
+    def schedule(self, transactions: Iterable[Any], key: Callable[[Any], int] = lambda t: t.created_us) -> None:
+        """
+        Add transactions to the queue, relative to the oldest one given.
+
+        Args:
+            transactions: Transactions (or any items) to schedule
+            key: Function returning the creation time of an item in integer
+                 microseconds since the epoch, as in TransactionRecord.created_us
+        """
+        transactions = list(transactions)
+        if not transactions:
+            return
+
+        timestamps = [key(t) for t in transactions]
+        origin = min(timestamps)
+
+        for transaction, timestamp in zip(transactions, timestamps):
+            offset = (timestamp - origin) / 1_000_000 / self.speed
+            # The sequence number keeps equal offsets in insertion order
+            heapq.heappush(self._queue, (offset, self._sequence, transaction))
+            self._sequence += 1
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def replay(self) -> Iterator[Tuple[Dict[str, Any], float]]:
+        """
+        Yield transactions when they are due, sleeping in between.
+
+        The clock starts on the first call. Transactions that are already
+        overdue (because sending the previous one took longer than the gap)
+        are yielded immediately.
+
+        Yields:
+            Tuples of (transaction, scheduled wall-clock time)
+        """
+        if self._start is None:
+            self._start = time.monotonic()
+
+        while self._queue:
+            offset, _, transaction = heapq.heappop(self._queue)
+            scheduled_at = self._start + offset
+
+            wait_time = scheduled_at - time.monotonic()
+            if wait_time > 0:
+                time.sleep(wait_time)
+
+            yield transaction, scheduled_at
+
+    def record(self, scheduled_at: float) -> float:
+        """
+        Record the lag between the scheduled time and now.
+
+        Args:
+            scheduled_at: Scheduled wall-clock time as yielded by replay()
+
+        Returns:
+            The lag in seconds
+        """
+        lag = max(0.0, time.monotonic() - scheduled_at)
+        self.lags.append(lag)
+        return lag
+
+    def lag_summary(self) -> Dict[str, Optional[float]]:
+        """
+        Summarise the recorded lags.
+
+        Returns:
+            Dictionary with count, mean, p50, p95 and max lag in seconds
+        """
+        if not self.lags:
+            return {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'max': None}
+
+        ordered = sorted(self.lags)
+        return {
+            'count': len(ordered),
+            'mean': sum(ordered) / len(ordered),
+            'p50': ordered[int(0.50 * (len(ordered) - 1))],
+            'p95': ordered[int(0.95 * (len(ordered) - 1))],
+            'max': ordered[-1]
+        }
@@ -0,0 +1,364 @@
+from bunq.sdk.model.generated.endpoint import PaymentApiObject, RequestInquiryApiObject
+from bunq.sdk.model.generated.object_ import AmountObject, PointerObject
+from bunq.sdk.context.bunq_context import BunqContext
+
+from typing import List, Dict, Any, Optional
+import json
+import os
+
+from replay_clock import ReplayClock
+from context_pool import get_context
+from transaction_table import TransactionRecord, as_records, created_to_micros
+from resilience import call_with_retry, idempotency_headers, load_api_context
+from responder import RequestResponder, settle_status
+
+
+# Step type codes used in the compiled plan
+STEP_PAYMENT = 0
+STEP_REQUEST = 1
+STEP_TYPE_NAMES = {STEP_PAYMENT: 'PAYMENT', STEP_REQUEST: 'REQUEST'}
+
+# Index of the main user in the plan's account table
+MAIN_USER_INDEX = 0
+
+
+def resolve_context_path(context_path: Optional[str]) -> Optional[str]:
+    """
+    Find the context file on disk, falling back to the 'v2/' prefixed location.
+
+    Returns:
+        The existing path, or None if the file can't be found
+    """
+    if not context_path:
+        return None
+    if os.path.exists(context_path):
+        return context_path
+    alt_path = f"v2/{context_path}"
+    if os.path.exists(alt_path):
+        return alt_path
+    return None
+
+
+def format_cents(cents: int) -> str:
+    """
+    Format positive integer cents as an API amount string, e.g. 1234 -> '12.34'.
+    """
+    return f"{cents // 100}.{cents % 100:02d}"
+
+
+def compile_replay_plan(transactions: List[TransactionRecord], iban_to_user_map: Dict[str, Dict[str, Any]], main_user_path: str, main_user_copy_iban: str) -> Dict[str, Any]:
+    """
+    Compile transactions into a compact, serialisable replay plan.
+
+    All decisions that used to be taken while sending (sender, recipient,
+    direction, amount, context file) are taken here, so every skip is known
+    before anything is sent. The plan contains:
+    - accounts: table of sandbox users; index 0 is the main user
+    - steps: one [sender idx, recipient idx, cents, type] row per transaction,
+      oldest first
+    - meta: per step [transaction id, created (microseconds since the epoch),
+      description, currency, original amount, original status]
+    - skipped: transactions that can't be replayed, with the reason
+
+    Args:
+        transactions: List of transaction records
+        iban_to_user_map: Dictionary mapping IBANs to user information
+        main_user_path: Path to the main user's API context file
+        main_user_copy_iban: IBAN of the main user's sandbox copy
+
+    Returns:
+        Dictionary with the replay plan
+    """
+    plan = {
+        'version': 3,
+        'accounts': [{
+            'name': 'Main User',
+            'original_iban': None,
+            'copy_iban': main_user_copy_iban,
+            'context_file_path': main_user_path
+        }],
+        'steps': [],
+        'meta': [],
+        'skipped': []
+    }
+
+    # Original IBAN to account index, filled lazily so unused agents stay out of the plan
+    account_index = {}
+
+    for transaction in sorted(as_records(transactions), key=lambda x: x.created_us):
+        transaction_type = transaction.type
+        original_iban = transaction.counterparty_iban
+        transaction_id = transaction.id
+
+        # Skip if no IBAN (can't identify counterparty)
+        if not original_iban:
+            plan['skipped'].append({
+                'transaction_id': transaction_id,
+                'reason': 'No counterparty IBAN found'
+            })
+            continue
+
+        # Verify this original IBAN is in our map
+        if original_iban not in iban_to_user_map:
+            plan['skipped'].append({
+                'transaction_id': transaction_id,
+                'reason': f'Original IBAN {original_iban} not found in user map'
+            })
+            continue
+
+        if original_iban not in account_index:
+            user_info = iban_to_user_map[original_iban]
+
+            # Get the copy IBAN for this counterparty
+            if not user_info.get('copy_iban'):
+                plan['skipped'].append({
+                    'transaction_id': transaction_id,
+                    'reason': f'Copy IBAN for {original_iban} not available'
+                })
+                continue
+
+            # Get the context file for this agent - handle path issues
+            context_path = resolve_context_path(user_info.get('context_file_path'))
+            if not context_path:
+                plan['skipped'].append({
+                    'transaction_id': transaction_id,
+                    'reason': f"Context file for {original_iban} not found: {user_info.get('context_file_path')}"
+                })
+                continue
+
+            account_index[original_iban] = len(plan['accounts'])
+            plan['accounts'].append({
+                'name': f"Agent {original_iban[-4:]}",
+                'original_iban': original_iban,
+                'copy_iban': user_info['copy_iban'],
+                'context_file_path': context_path
+            })
+
+        cents = transaction.amount_cents
+        if cents is None:
+            plan['skipped'].append({
+                'transaction_id': transaction_id,
+                'reason': 'Invalid amount format'
+            })
+            continue
+
+        agent = account_index[original_iban]
+        if transaction_type == 'PAYMENT' and cents < 0:
+            # Money going OUT from main account: main user sends money to agent
+            step = [MAIN_USER_INDEX, agent, -cents, STEP_PAYMENT]
+        elif transaction_type == 'PAYMENT':
+            # Money coming IN to main account: agent sends money to main user
+            step = [agent, MAIN_USER_INDEX, cents, STEP_PAYMENT]
+        else:
+            # Agent requests money from main user
+            step = [agent, MAIN_USER_INDEX, abs(cents), STEP_REQUEST]
+
+        plan['steps'].append(step)
+        plan['meta'].append([
+            transaction_id,
+            transaction.created_us,
+            transaction.description or 'Replayed transaction',
+            transaction.currency,
+            transaction.amount,
+            transaction.status
+        ])
+
+    return plan
+
+
+def print_replay_plan(plan: Dict[str, Any]) -> None:
+    """
+    Print a dry-run report of a replay plan, including every skipped transaction.
+
+    Args:
+        plan: Replay plan as returned by compile_replay_plan
+    """
+    payments = sum(1 for step in plan['steps'] if step[3] == STEP_PAYMENT)
+
+    print("\n=== REPLAY PLAN ===")
+    print(f"Accounts involved: {len(plan['accounts'])}")
+    print(f"Steps to replay: {len(plan['steps'])} ({payments} payments, {len(plan['steps']) - payments} requests)")
+    print(f"Transactions skipped: {len(plan['skipped'])}")
+    for skipped in plan['skipped']:
+        print(f"  {skipped['transaction_id']}: {skipped['reason']}")
+
+
+def save_replay_plan(plan: Dict[str, Any], path: str) -> None:
+    """
+    Save a replay plan as compact JSON.
+    """
+    with open(path, 'w') as f:
+        json.dump(plan, f, separators=(',', ':'))
+
+
+def load_replay_plan(path: str) -> Dict[str, Any]:
+    """
+    Load a replay plan saved with save_replay_plan.
+
+    Plans before version 3 store the creation times as strings; they are
+    converted to microseconds here, once.
+    """
+    with open(path, 'r') as f:
+        plan = json.load(f)
+    if plan.get('version', 1) < 3:
+        for meta in plan['meta']:
+            meta[1] = created_to_micros(meta[1])
+        plan['version'] = 3
+    return plan
+
+
+def slice_replay_plan(plan: Dict[str, Any], step_indexes: List[int]) -> Dict[str, Any]:
+    """
+    Return a plan with only the given steps, e.g. one shard's part of a segment.
+
+    The slice keeps the full account table, so its steps stay valid, and has
+    no skips; those are reported once for the whole plan.
+    """
+    return {
+        'version': plan.get('version'),
+        'accounts': plan['accounts'],
+        'steps': [plan['steps'][i] for i in step_indexes],
+        'meta': [plan['meta'][i] for i in step_indexes],
+        'skipped': []
+    }
+
+
+def execute_replay_plan(plan: Dict[str, Any], speed: Optional[float] = None, settle_requests: bool = True, responder=None) -> Dict[str, Any]:
+    """
+    Send the steps of a compiled replay plan, oldest first.
+
+    Skips recorded in the plan are copied into the results; no per-row parsing
+    or file checks happen here.
+
+    With settle_requests, every replayed request whose original was accepted
+    or rejected is handed to a RequestResponder, which applies that status on
+    the main user's side while the replay continues. The outcomes are added
+    to the results as 'settled' and 'unsettled'. A responder that is passed
+    in is used instead and left open, so one responder can serve several plans.
+
+    Args:
+        plan: Replay plan as returned by compile_replay_plan
+        speed: Optional time compression factor for the replay clock
+        settle_requests: If True, settle replayed requests with their original status
+        responder: Optional running RequestResponder (or any object with its submit())
+
+    Returns:
+        Dictionary with results of the replay operations
+    """
+    results = {
+        'success': [],
+        'failed': [],
+        'skipped': list(plan['skipped'])
+    }
+
+    accounts = plan['accounts']
+    steps = plan['steps']
+    meta = plan['meta']
+
+    # Save current API context if any
+    original_api_context = None
+    if BunqContext.api_context():
+        original_api_context = BunqContext.api_context()
+
+    # Plans of version 1 carry no original status
+    def original_status(step_index):
+        return meta[step_index][5] if len(meta[step_index]) > 5 else None
+
+    own_responder = False
+    if responder is None and settle_requests and any(
+            step[3] == STEP_REQUEST and settle_status(original_status(i)) for i, step in enumerate(steps)):
+        responder = RequestResponder(accounts[MAIN_USER_INDEX]['context_file_path'])
+        responder.start()
+        own_responder = True
+
+    # Either follow the original timing or replay as fast as possible
+    clock = None
+    if speed:
+        clock = ReplayClock(speed)
+        clock.schedule(range(len(steps)), key=lambda i: meta[i][1])
+        replay_stream = clock.replay()
+        print(f"Replaying with original timing at {speed}x speed")
+    else:
+        replay_stream = ((i, None) for i in range(len(steps)))
+
+    for i, (step_index, scheduled_at) in enumerate(replay_stream):
+        sender, recipient, cents, step_type = steps[step_index]
+        transaction_id, _, description, currency, original_amount = meta[step_index][:5]
+        sender_name = accounts[sender]['name']
+        recipient_name = accounts[recipient]['name']
+        type_name = STEP_TYPE_NAMES[step_type]
+        formatted_amount = format_cents(cents)
+
+        try:
+            # Load the sender's context
+            load_api_context(get_context(accounts[sender]['context_file_path']))
+
+            # Lag between the scheduled and the actual send time
+            lag = clock.record(scheduled_at) if clock else None
+
+            # Every retry of this step is sent with the same client request id
+            counterparty = PointerObject("IBAN", accounts[recipient]['copy_iban'], recipient_name)
+            if step_type == STEP_PAYMENT:
+                response = call_with_retry(
+                    "POST payment",
+                    PaymentApiObject.create,
+                    amount=AmountObject(formatted_amount, currency),
+                    counterparty_alias=counterparty,
+                    description=f"Replay: {description}",
+                    custom_headers=idempotency_headers()
+                )
+            else:
+                response = call_with_retry(
+                    "POST request-inquiry",
+                    RequestInquiryApiObject.create,
+                    amount_inquired=AmountObject(formatted_amount, currency),
+                    counterparty_alias=counterparty,
+                    description=f"Replay: {description}",
+                    allow_bunqme=True,
+                    custom_headers=idempotency_headers()
+                )
+
+            if not (response and hasattr(response, 'value')):
+                raise Exception(f"{type_name.capitalize()} creation failed - no ID returned")
+
+            results['success'].append({
+                'original_id': transaction_id,
+                'new_id': response.value,
+                'type': type_name,
+                'amount': formatted_amount,
+                'description': description,
+                'from': sender_name,
+                'to': recipient_name,
+                'original_amount': original_amount,
+                'lag': lag
+            })
+            print(f"[{i+1}/{len(steps)}] Successfully replayed {type_name.lower()} of {formatted_amount} {currency} from {sender_name} to {recipient_name}")
+
+            # Let the main user accept or reject the request as in the original history
+            status = settle_status(original_status(step_index))
+            if responder and step_type == STEP_REQUEST and status:
+                responder.submit(transaction_id, accounts[sender]['copy_iban'], formatted_amount, status)
+
+        except Exception as e:
+            agent = accounts[sender] if sender != MAIN_USER_INDEX else accounts[recipient]
+            results['failed'].append({
+                'transaction_id': transaction_id,
+                'reason': str(e),
+                'type': type_name,
+                'iban': agent['original_iban'],
+                'amount': original_amount
+            })
+            print(f"[{i+1}/{len(steps)}] Error replaying {type_name} for IBAN {agent['original_iban']}: {str(e)}")
+
+    if own_responder:
+        print(f"Waiting for {responder.submitted} requests to be settled...")
+        results.update(responder.close())
+
+    # Restore original API context if there was one
+    if original_api_context:
+        load_api_context(original_api_context)
+
+    if clock:
+        results['lag'] = clock.lag_summary()
+
+    return results
@@ -0,0 +1,275 @@
+from bunq.sdk.exception.api_exception import ApiException
+from bunq.sdk.context.bunq_context import BunqContext
+
+from typing import Any, Callable, Dict, Optional
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+from rate_limit import get_governor
+
+
+# Header with the client's id of a request. bunq requires it to be unique and
+# rejects a request that reuses one, so a retry with the same id can't execute
+# a payment twice, but fails if an earlier attempt reached the server
+CLIENT_REQUEST_ID_HEADER = "X-Bunq-Client-Request-Id"
+
+# HTTP status codes that are worth retrying
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an endpoint whose circuit breaker is open.
+    """
+
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(f"Circuit for {endpoint} is open, retry in {retry_in:.1f}s")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter.
+
+    The delay before retry n (starting at 0) is a random value between 0 and
+    min(max_delay, base_delay * 2 ** n). A Retry-After given by the server is
+    used as the lower bound.
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0):
+        """
+        Args:
+            max_attempts: Total number of attempts, including the first one
+            base_delay: Backoff of the first retry in seconds
+            max_delay: Upper bound of the backoff in seconds
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            return max(backoff, retry_after)
+        return backoff
+
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker.
+
+    After failure_threshold consecutive transient failures the circuit opens
+    and calls fail fast with CircuitOpenError. Once reset_timeout seconds have
+    passed a single trial call is let through (half-open); it closes the
+    circuit on success and opens it again on failure.
+    """
+
+    def __init__(self, endpoint: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def before_call(self) -> None:
+        """
+        Check whether a call may go through.
+
+        Raises:
+            CircuitOpenError: If the circuit is open
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self._trial_running:
+                raise CircuitOpenError(self.endpoint, max(remaining, 0.0))
+            self._trial_running = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"Circuit for {self.endpoint} opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+# Circuit breakers shared by all callers in this process, one per endpoint
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def get_circuit_breaker(endpoint: str) -> CircuitBreaker:
+    """
+    Return the circuit breaker of an endpoint, creating it on first use.
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(endpoint)
+            _breakers[endpoint] = breaker
+        return breaker
+
+
+def transient_error_info(error: Exception) -> tuple:
+    """
+    Classify an exception raised by an API call.
+
+    Returns:
+        Tuple of (is transient, Retry-After in seconds or None)
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True, None
+
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status_code = error.response.status_code
+        retry_after = error.response.headers.get("Retry-After")
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        return status_code in TRANSIENT_STATUS_CODES, retry_after
+
+    if isinstance(error, ApiException):
+        return error.response_code in TRANSIENT_STATUS_CODES, None
+
+    return False, None
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code
+    if isinstance(error, ApiException):
+        return error.response_code
+    return None
+
+
+def call_with_retry(endpoint: str, func: Callable, *args, policy: RetryPolicy = None, **kwargs) -> Any:
+    """
+    Call a sandbox API function with retries and a per-endpoint circuit breaker.
+
+    Every attempt first waits for the rate limit governor (rate_limit.py).
+    Rate limits (429), server errors (5xx) and connection errors are retried
+    with exponential backoff and jitter, honouring Retry-After where the
+    response has one; after a 429 the governor holds back all calls of the
+    same class for the backoff. Other errors are raised right away and don't
+    count against the circuit.
+
+    Args:
+        endpoint: Name of the endpoint, as "<METHOD> <resource>", e.g. "POST payment"
+        func: Function doing the API call
+        *args, **kwargs: Arguments for func
+        policy: Retry policy; DEFAULT_RETRY_POLICY if not given
+
+    Returns:
+        The return value of func
+
+    Raises:
+        CircuitOpenError: If the endpoint's circuit is open
+        Exception: The last error if all attempts failed or the error isn't transient
+    """
+    policy = policy or DEFAULT_RETRY_POLICY
+    breaker = get_circuit_breaker(endpoint)
+    governor = get_governor()
+
+    for attempt in range(policy.max_attempts):
+        breaker.before_call()
+        governor.acquire(endpoint)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            transient, retry_after = transient_error_info(e)
+            if not transient:
+                # The endpoint answered, so it counts as healthy
+                breaker.record_success()
+                if attempt > 0 and CLIENT_REQUEST_ID_HEADER in (kwargs.get('custom_headers') or {}):
+                    print(f"{endpoint} was rejected on a retry; an earlier attempt may have been executed, check before sending it again")
+                raise
+            breaker.record_failure()
+            if attempt == policy.max_attempts - 1:
+                raise
+            delay = policy.delay(attempt, retry_after)
+            if _status_code(e) == 429:
+                governor.block(endpoint, delay)
+            print(f"{endpoint} failed ({str(e)}), retrying in {delay:.1f}s (attempt {attempt + 1}/{policy.max_attempts})")
+            time.sleep(delay)
+            continue
+
+        breaker.record_success()
+        return result
+
+
+# User contexts loaded in this process: user id -> (session token, user context)
+_user_contexts: Dict[int, tuple] = {}
+_user_contexts_lock = threading.Lock()
+
+
+def load_api_context(api_context) -> None:
+    """
+    Load an API context into BunqContext, with retries.
+
+    An expired session is reset first as a separate "POST session-server"
+    call, so it is paced by the session limit; otherwise the SDK would reset
+    it inside the load, charged to "GET user".
+
+    Loading fetches the user and its primary account ("GET user"). The result
+    is kept per user for as long as its session lasts, so loading the same
+    user again, e.g. on every step of a replay, costs no API call.
+    """
+    if not api_context.is_session_active():
+        call_with_retry("POST session-server", api_context.reset_session)
+
+    session_context = api_context.session_context
+    with _user_contexts_lock:
+        cached = _user_contexts.get(session_context.user_id)
+    if cached is not None and cached[0] == session_context.token:
+        BunqContext._api_context = api_context
+        BunqContext._user_context = cached[1]
+        return
+
+    call_with_retry("GET user", BunqContext.load_api_context, api_context)
+    with _user_contexts_lock:
+        _user_contexts[session_context.user_id] = (session_context.token, BunqContext._user_context)
+
+
+def new_idempotency_key() -> str:
+    """
+    Create a client request id to reuse on every attempt of one logical request.
+    """
+    return str(uuid.uuid4())
+
+
+def idempotency_headers(key: Optional[str] = None) -> Dict[str, str]:
+    """
+    Return custom headers that fix the client request id of a creating call.
+
+    Pass the result as custom_headers to the bunq SDK create methods; since
+    call_with_retry passes the same arguments on every attempt, all retries
+    of a payment carry the same id. This doesn't make retries idempotent:
+    bunq rejects a reused id, so a retry after an attempt that did reach the
+    server fails instead of paying twice, and call_with_retry warns about it.
+    """
+    return {CLIENT_REQUEST_ID_HEADER: key or new_idempotency_key()}
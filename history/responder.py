@@ -0,0 +1,197 @@
+from bunq.sdk.model.generated.endpoint import RequestResponseApiObject
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
+import multiprocessing
+import queue
+import time
+
+from context_pool import get_context, get_context_pool
+from resilience import call_with_retry, load_api_context
+from pending_requests import PendingRequestIndex
+
+
+# Seconds between two looks for request-responses that haven't arrived yet
+POLL_INTERVAL = 1.0
+
+# Number of concurrent request-response updates
+UPDATE_WORKERS = 4
+
+
+def settle_status(original_status: Optional[str]) -> Optional[str]:
+    """
+    Map the status of an original request to the response that reproduces it.
+
+    Returns:
+        'ACCEPTED' or 'REJECTED', or None if the request should stay pending
+    """
+    if original_status == 'ACCEPTED':
+        return 'ACCEPTED'
+    if original_status in ('REJECTED', 'REVOKED', 'EXPIRED'):
+        return 'REJECTED'
+    return None
+
+
+def _respond(request_response_id: int, status: str) -> int:
+    call_with_retry(
+        "PUT request-response",
+        RequestResponseApiObject.update,
+        request_response_id,
+        status=status
+    )
+    return request_response_id
+
+
+def _run_responder(main_context_path: str, jobs, results, lookup_timeout: float) -> None:
+    """
+    Responder process: settle the replayed requests on the main user's account.
+
+    Jobs are (transaction id, requester IBAN, amount, status) tuples; None
+    means no more jobs will come. Every outcome is put on the results queue,
+    followed by None once all jobs are handled.
+    """
+    waiting = []
+    stopping = False
+
+    try:
+        load_api_context(get_context(main_context_path))
+        index = PendingRequestIndex()
+    except Exception as e:
+        # Without the main user nothing can be settled; report every job
+        index = None
+        startup_error = str(e)
+
+    with ThreadPoolExecutor(max_workers=UPDATE_WORKERS) as pool:
+        while not (stopping and not waiting):
+            # Collect new jobs; only block while there is nothing to look up
+            try:
+                job = jobs.get(timeout=None if not waiting else 0)
+                while True:
+                    if job is None:
+                        stopping = True
+                    else:
+                        waiting.append((job, time.monotonic() + lookup_timeout))
+                    job = jobs.get_nowait()
+            except queue.Empty:
+                pass
+
+            if not waiting:
+                continue
+
+            if index is None:
+                for (transaction_id, _, _, _), _ in waiting:
+                    results.put({'transaction_id': transaction_id, 'reason': f"Main user context not available: {startup_error}"})
+                waiting = []
+                continue
+
+            try:
+                index.refresh()
+            except Exception as e:
+                print(f"Error listing request-responses: {str(e)}")
+
+            updates = []
+            still_waiting = []
+            for (transaction_id, requester_iban, amount, status), deadline in waiting:
+                request_response_id = index.take(requester_iban, amount)
+                if request_response_id is not None:
+                    updates.append((transaction_id, status, pool.submit(_respond, request_response_id, status)))
+                elif time.monotonic() > deadline:
+                    results.put({'transaction_id': transaction_id, 'reason': 'No pending request-response found on the main account'})
+                else:
+                    still_waiting.append(((transaction_id, requester_iban, amount, status), deadline))
+            waiting = still_waiting
+
+            for transaction_id, status, future in updates:
+                try:
+                    results.put({'transaction_id': transaction_id, 'request_response_id': future.result(), 'status': status})
+                except Exception as e:
+                    results.put({'transaction_id': transaction_id, 'reason': str(e)})
+
+            if waiting and not updates:
+                time.sleep(POLL_INTERVAL)
+
+    # Child processes skip atexit handlers, so write refreshed sessions now
+    get_context_pool().flush()
+    results.put(None)
+
+
+class RequestResponder:
+    """
+    Settles replayed requests on the main user's side while the replay runs.
+
+    The replay hands every request it created to submit(); a separate process
+    (the bunq SDK keeps one global API context per process) logs in as the
+    main user, finds the matching pending request-response by requester IBAN
+    and amount, and accepts or rejects it as in the original history.
+    Requests are settled while later transactions are still being sent.
+
+    Can be used as a context manager; close() waits for all submitted requests.
+    """
+
+    def __init__(self, main_context_path: str, lookup_timeout: float = 60.0):
+        """
+        Args:
+            main_context_path: Path to the main user's API context file
+            lookup_timeout: Seconds to wait for a request-response to show up
+        """
+        self.main_context_path = main_context_path
+        self.lookup_timeout = lookup_timeout
+
+        mp_context = multiprocessing.get_context('spawn')
+        self._jobs = mp_context.Queue()
+        self._results = mp_context.Queue()
+        self._process = mp_context.Process(
+            target=_run_responder,
+            args=(main_context_path, self._jobs, self._results, lookup_timeout),
+            name="request-responder",
+            daemon=True
+        )
+        self.submitted = 0
+
+    def __enter__(self) -> "RequestResponder":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def start(self) -> None:
+        self._process.start()
+
+    def submit(self, transaction_id: Any, requester_iban: str, amount: str, status: str) -> None:
+        """
+        Queue a replayed request for settlement.
+
+        Args:
+            transaction_id: Id of the original transaction, used in the results
+            requester_iban: Copy IBAN of the agent that sent the request
+            amount: Requested amount as an API amount string, e.g. '12.34'
+            status: 'ACCEPTED' or 'REJECTED' (see settle_status)
+        """
+        self._jobs.put((transaction_id, requester_iban, amount, status))
+        self.submitted += 1
+
+    def close(self) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Wait until all submitted requests are settled or given up on.
+
+        Returns:
+            Dictionary with 'settled' and 'unsettled' lists
+        """
+        results = {'settled': [], 'unsettled': []}
+        if not self._process.is_alive() and self._process.exitcode is None:
+            return results
+
+        self._jobs.put(None)
+        while True:
+            try:
+                outcome = self._results.get(timeout=self.lookup_timeout + 30)
+            except queue.Empty:
+                print("Request responder stopped answering")
+                break
+            if outcome is None:
+                break
+            results['unsettled' if 'reason' in outcome else 'settled'].append(outcome)
+
+        self._process.join(timeout=5)
+        return results
@@ -0,0 +1,255 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional
+import multiprocessing
+import os
+
+from transaction_table import TransactionRecord, as_records
+from replay_plan import (
+    MAIN_USER_INDEX,
+    STEP_PAYMENT,
+    STEP_REQUEST,
+    compile_replay_plan,
+    print_replay_plan,
+    slice_replay_plan,
+)
+from responder import RequestResponder, settle_status
+
+
+def find_agent_components(transactions: List[TransactionRecord], iban_to_user_map: Dict[str, Dict[str, Any]]) -> List[List[str]]:
+    """
+    Group original IBANs into connected components of the transaction graph.
+
+    The main user takes part in every transaction, so it is treated as a shared
+    account and not used to join components. Two IBANs end up in the same
+    component when they are replayed through the same sandbox user (same
+    context file or copy IBAN), because they then share a balance.
+
+    Args:
+        transactions: List of transaction records
+        iban_to_user_map: Dictionary mapping IBANs to user information
+
+    Returns:
+        List of components, each a list of original IBANs
+    """
+    parent = {}
+
+    def find(iban):
+        while parent[iban] != iban:
+            parent[iban] = parent[parent[iban]]
+            iban = parent[iban]
+        return iban
+
+    def union(a, b):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+
+    # Every IBAN that occurs in the history and can be replayed is a node
+    for transaction in transactions:
+        iban = transaction.counterparty_iban
+        if iban and iban in iban_to_user_map:
+            parent.setdefault(iban, iban)
+
+    # Join IBANs that are backed by the same sandbox user
+    owner_to_iban = {}
+    for iban in parent:
+        user_info = iban_to_user_map[iban]
+        for owner in (user_info.get('context_file_path'), user_info.get('copy_iban')):
+            if not owner:
+                continue
+            if owner in owner_to_iban:
+                union(owner_to_iban[owner], iban)
+            else:
+                owner_to_iban[owner] = iban
+
+    components = {}
+    for iban in parent:
+        components.setdefault(find(iban), []).append(iban)
+
+    return list(components.values())
+
+
+def partition_into_shards(transactions: List[TransactionRecord], components: List[List[str]], shard_count: int) -> List[set]:
+    """
+    Distribute components over shards so that each shard replays a similar
+    number of transactions (largest component first into the lightest shard).
+
+    Args:
+        transactions: List of transaction records
+        components: Connected components as returned by find_agent_components
+        shard_count: Number of shards to create
+
+    Returns:
+        List of sets of original IBANs, one set per shard
+    """
+    counts = {}
+    for transaction in transactions:
+        iban = transaction.counterparty_iban
+        counts[iban] = counts.get(iban, 0) + 1
+
+    weighted = sorted(components, key=lambda c: sum(counts.get(iban, 0) for iban in c), reverse=True)
+
+    shards = [set() for _ in range(max(1, shard_count))]
+    loads = [0] * len(shards)
+    for component in weighted:
+        lightest = loads.index(min(loads))
+        shards[lightest].update(component)
+        loads[lightest] += sum(counts.get(iban, 0) for iban in component)
+
+    return [shard for shard in shards if shard]
+
+
+def is_shared_account_debit(step: List[Any], original_status: Optional[str]) -> bool:
+    """
+    Check if a plan step takes money out of the main user's account: a
+    payment from the main user to an agent, or a request that the main user
+    accepts and therefore settles.
+
+    Such steps depend on everything the main user received before them,
+    across all shards, so they act as ordering barriers.
+
+    Args:
+        step: [sender idx, recipient idx, cents, type] row of a replay plan
+        original_status: Status of the original transaction
+    """
+    sender, _, _, step_type = step
+    if step_type == STEP_PAYMENT:
+        return sender == MAIN_USER_INDEX
+    return settle_status(original_status) == 'ACCEPTED'
+
+
+class _SettlementCollector:
+    """
+    Stands in for a RequestResponder in a worker: collects the replayed
+    requests so the parent can hand them to its single responder.
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, transaction_id: Any, requester_iban: str, amount: str, status: str) -> None:
+        self.jobs.append((transaction_id, requester_iban, amount, status))
+
+
+def _replay_shard(plan: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Worker entry point: send the steps of one plan slice in this process.
+    Each worker process keeps its own context pool (see context_pool).
+
+    Returns:
+        Results of the slice, with the requests to settle under 'settle'
+    """
+    from replay_plan import execute_replay_plan
+    collector = _SettlementCollector()
+    results = execute_replay_plan(plan, responder=collector)
+    results['settle'] = collector.jobs
+    return results
+
+
+def replay_sharded(transactions: List[TransactionRecord], iban_to_user_map: Dict[str, Dict[str, Any]], main_user_path: str, processes: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Replay transactions across a pool of processes, one shard per process.
+
+    The history is compiled into one replay plan up front, in this process.
+    Its steps are cut into segments at every step that takes money out of
+    the main user (a shared account debit). Within a segment the shards'
+    slices of the plan are sent in parallel; a segment only starts once the
+    previous one finished, so the main user has received all earlier funds
+    before it pays anything out.
+
+    A single RequestResponder settles the replayed requests of all workers
+    while later segments are sent.
+
+    Args:
+        transactions: List of transaction records
+        iban_to_user_map: Dictionary mapping IBANs to user information
+        main_user_path: Path to the main user's API context file
+        processes: Number of worker processes (default: CPU count)
+
+    Returns:
+        Dictionary with merged results of the replay operations
+    """
+    from parse_user import get_iban_from_context_file
+
+    processes = processes or os.cpu_count() or 1
+    transactions = as_records(transactions)
+
+    results = {
+        'success': [],
+        'failed': [],
+        'skipped': [],
+        'settled': [],
+        'unsettled': []
+    }
+
+    main_user_copy_iban = get_iban_from_context_file(main_user_path)
+    if not main_user_copy_iban:
+        print("ERROR: Could not find IBAN for main user copy")
+        return results
+
+    plan = compile_replay_plan(transactions, iban_to_user_map, main_user_path, main_user_copy_iban)
+    print_replay_plan(plan)
+    results['skipped'] = list(plan['skipped'])
+
+    components = find_agent_components(transactions, iban_to_user_map)
+    shards = partition_into_shards(transactions, components, processes)
+    shard_of_iban = {iban: index for index, shard in enumerate(shards) for iban in shard}
+
+    print(f"\n=== SHARDED REPLAY INFO ===")
+    print(f"Components: {len(components)}, shards: {len(shards)}, processes: {processes}")
+
+    def original_status(step_index):
+        return plan['meta'][step_index][5]
+
+    # Cut the plan into segments at shared account debits; consecutive
+    # debits form one barrier segment that is sent in order by one worker
+    segments = []
+    current = [[] for _ in range(max(1, len(shards)))]
+    barrier = None
+    for step_index, step in enumerate(plan['steps']):
+        if is_shared_account_debit(step, original_status(step_index)):
+            if any(current):
+                segments.append(current)
+                current = [[] for _ in range(max(1, len(shards)))]
+            if barrier is None:
+                barrier = []
+                segments.append([barrier])
+            barrier.append(step_index)
+        else:
+            barrier = None
+            sender, recipient = step[0], step[1]
+            agent = plan['accounts'][sender if sender != MAIN_USER_INDEX else recipient]
+            current[shard_of_iban.get(agent['original_iban'], 0)].append(step_index)
+    segments.append(current)
+
+    responder = None
+    if any(step[3] == STEP_REQUEST and settle_status(original_status(i)) for i, step in enumerate(plan['steps'])):
+        responder = RequestResponder(plan['accounts'][MAIN_USER_INDEX]['context_file_path'])
+        responder.start()
+
+    # Fresh worker processes, so none inherits this process's context pool (see context_pool)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for segment in segments:
+            futures = [
+                pool.submit(_replay_shard, slice_replay_plan(plan, step_indexes))
+                for step_indexes in segment if step_indexes
+            ]
+            for future in futures:
+                shard_results = future.result()
+                for job in shard_results.pop('settle'):
+                    if responder:
+                        responder.submit(*job)
+                for key in ('success', 'failed'):
+                    results[key].extend(shard_results[key])
+
+    if responder:
+        print(f"Waiting for {responder.submitted} requests to be settled...")
+        results.update(responder.close())
+
+    print("\n=== SHARDED REPLAY SUMMARY ===")
+    print(f"Successful replays: {len(results['success'])}")
+    print(f"Failed replays: {len(results['failed'])}")
+    print(f"Skipped transactions: {len(results['skipped'])}")
+    print(f"Settled requests: {len(results['settled'])} (unsettled: {len(results['unsettled'])})")
+
+    return results
@@ -1,6 +1,3 @@
-from bunq.sdk.context.api_environment_type import ApiEnvironmentType
-from bunq.sdk.context.bunq_context import BunqContext
-from bunq.sdk.context.api_context import ApiContext
 import argparse
 
 from parse_user import (
@@ -9,23 +6,44 @@ from parse_user import (
 )
 
 from parser import transactions_to_visualizer_format
+from transaction_file import write_transaction_file, read_transaction_file
+from lazy_import import lazy_import
 
-def to_web(api_key, sugar_mode=False):
-    
-    api_context = ApiContext.create(
-        ApiEnvironmentType.SANDBOX,
-        api_key,
-        "bunq api"
-    )
-    BunqContext.load_api_context(api_context)
+# Only needed when transactions are fetched from the API, not with --input
+ApiEnvironmentType = lazy_import("bunq.sdk.context.api_environment_type", "ApiEnvironmentType")
+ApiContext = lazy_import("bunq.sdk.context.api_context", "ApiContext")
+call_with_retry = lazy_import("resilience", "call_with_retry")
+load_api_context = lazy_import("resilience", "load_api_context")
+
+def to_web(api_key, sugar_mode=False, export_path=None, input_path=None, optimize=True):
     
-    # Get transactions of the main user and agents he interacted with
-    transactions = get_user_transactions()
+    if input_path:
+        # Load a previous export instead of calling the API
+        transactions = read_transaction_file(input_path)
+        print(f"Loaded {len(transactions)} transactions from {input_path}")
+    else:
+        api_context = call_with_retry(
+            "POST session-server",
+            ApiContext.create,
+            ApiEnvironmentType.SANDBOX,
+            api_key,
+            "bunq api"
+        )
+        load_api_context(api_context)
+
+        # Get transactions of the main user and agents he interacted with
+        transactions = get_user_transactions()
+
+    # Keep the raw transactions so later runs don't need the API
+    if export_path:
+        exported = write_transaction_file(export_path, transactions)
+        print(f"Exported {exported} transactions to {export_path}")
+
     agents = extract_transaction_agents(transactions)
     print(f"Found {len(transactions)} transactions and {len(agents)} agents")
 
     # Generate data with or without sugar mode enabled
-    re = transactions_to_visualizer_format(transactions, agents, sugar_mode=sugar_mode)
+    re = transactions_to_visualizer_format(transactions, agents, sugar_mode=sugar_mode, optimize=optimize)
     
     if sugar_mode:
         print(f"Data converted to visualizer format with sugar daddy mode ENABLED")
@@ -43,10 +61,19 @@ def to_web(api_key, sugar_mode=False):
 # run from key provided as cmd arg
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Convert Bunq transactions to visualizer format')
-    parser.add_argument('api_key', help='Bunq API key')
+    parser.add_argument('api_key', nargs='?', help='Bunq API key (not needed with --input)')
     parser.add_argument('-sugar', '--sugar', action='store_true', 
                         help='Enable sugar daddy mode to request money from central authority')
     
+    parser.add_argument('--no-optimize', action='store_true',
+                        help='Keep redundant read-only actions (ListPayments, repeated overviews)')
+    parser.add_argument('--export', metavar='PATH',
+                        help='Also export the raw transactions to a columnar binary file')
+    parser.add_argument('--input', metavar='PATH',
+                        help='Read transactions from an export instead of the API')
+    
     args = parser.parse_args()
-    to_web(args.api_key, sugar_mode=args.sugar)
+    if not args.api_key and not args.input:
+        parser.error('an API key is required unless --input is given')
+    to_web(args.api_key, sugar_mode=args.sugar, export_path=args.export, input_path=args.input, optimize=not args.no_optimize)
 
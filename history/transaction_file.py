@@ -0,0 +1,269 @@
+from array import array
+from typing import List, Dict, Any, Iterable, Optional
+import json
+import mmap
+import os
+import struct
+import sys
+
+from transaction_table import (
+    TransactionRecord, TYPE_CODES, TYPE_NAMES, NO_COUNTERPARTY, DEFAULT_CURRENCY,
+    as_records, created_to_micros, micros_to_created
+)
+
+
+# File signature and format version of transaction exports
+MAGIC = b'BQTX'
+FORMAT_VERSION = 1
+
+# Value stored in optional integer columns when the field is missing
+NO_VALUE = -1
+
+# Magic, format version and header length, followed by the JSON header
+_PREAMBLE = struct.Struct('<4sHI')
+
+# Columns are aligned so they can be mapped as typed memoryviews
+_ALIGNMENT = 8
+
+# Column name and array typecode, in file order
+_COLUMNS = (
+    ('ids', 'q'),
+    ('types', 'b'),
+    ('created', 'q'),
+    ('updated', 'q'),
+    ('amounts', 'q'),
+    ('counterparty', 'i'),
+    ('currency', 'i'),
+    ('status', 'i'),
+    ('monetary_account_ids', 'q'),
+    ('description_offsets', 'q'),
+    ('description_data', 'B'),
+)
+
+
+class _Dictionary:
+    """
+    Dictionary encoding of a string column: values are replaced by their index.
+    """
+
+    def __init__(self):
+        self.values: List[str] = []
+        self._index: Dict[str, int] = {}
+
+    def encode(self, value: Optional[str]) -> int:
+        if value is None:
+            return NO_VALUE
+        index = self._index.get(value)
+        if index is None:
+            index = len(self.values)
+            self._index[value] = index
+            self.values.append(value)
+        return index
+
+
+def write_transaction_file(path: str, transactions: Iterable[Any]) -> int:
+    """
+    Export transactions to a compact columnar binary file.
+
+    Every field is stored as its own contiguous typed column: ids, types,
+    timestamps in microseconds and amounts in cents as integers, IBANs,
+    currencies and statuses dictionary encoded, and descriptions as one
+    UTF-8 blob with an offsets column. Transactions without a valid amount
+    are left out. The file is written next to the target and then moved in
+    place, so readers never see a half-written export.
+
+    Args:
+        path: Path of the export file
+        transactions: Transaction records (or old-style dictionaries)
+
+    Returns:
+        Number of exported transactions
+    """
+    columns = {name: array(typecode) for name, typecode in _COLUMNS}
+    ibans = _Dictionary()
+    currencies = _Dictionary()
+    statuses = _Dictionary()
+    columns['description_offsets'].append(0)
+    skipped = 0
+
+    for transaction in as_records(transactions):
+        if transaction.amount_cents is None:
+            skipped += 1
+            continue
+
+        columns['ids'].append(int(transaction.id))
+        columns['types'].append(TYPE_CODES[transaction.type])
+        columns['created'].append(transaction.created_us)
+        columns['updated'].append(
+            created_to_micros(transaction.updated) if transaction.updated else NO_VALUE
+        )
+        columns['amounts'].append(transaction.amount_cents)
+        counterparty = ibans.encode(transaction.counterparty_iban or None)
+        columns['counterparty'].append(NO_COUNTERPARTY if counterparty == NO_VALUE else counterparty)
+        columns['currency'].append(currencies.encode(transaction.currency))
+        columns['status'].append(statuses.encode(transaction.status))
+        monetary_account_id = transaction.monetary_account_id
+        columns['monetary_account_ids'].append(NO_VALUE if monetary_account_id is None else int(monetary_account_id))
+        columns['description_data'].frombytes((transaction.description or '').encode('utf-8'))
+        columns['description_offsets'].append(len(columns['description_data']))
+
+    if skipped:
+        print(f"Left {skipped} transactions with an invalid amount out of the export")
+
+    # Lay out the columns after the header, each starting on an aligned offset
+    layout = {}
+    offset = 0
+    for name, typecode in _COLUMNS:
+        nbytes = len(columns[name]) * columns[name].itemsize
+        layout[name] = [typecode, offset, nbytes]
+        offset += nbytes + (-nbytes % _ALIGNMENT)
+
+    header = {
+        'rows': len(columns['ids']),
+        'byteorder': sys.byteorder,
+        'ibans': ibans.values,
+        'currencies': currencies.values,
+        'statuses': statuses.values,
+        'columns': layout
+    }
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    data_start = _PREAMBLE.size + len(header_bytes)
+    data_start += -data_start % _ALIGNMENT
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, _ in _COLUMNS:
+            f.seek(data_start + layout[name][1])
+            columns[name].tofile(f)
+        f.truncate(data_start + offset)
+    os.replace(temp_path, path)
+
+    return header['rows']
+
+
+class TransactionFile:
+    """
+    Memory-mapped reader for files written by write_transaction_file.
+
+    Columns are exposed as typed memoryviews over the mapped file, so opening
+    an export costs no parsing and only the pages that are read get loaded.
+    The attribute names match TransactionTable (ids, types, created, amounts,
+    counterparty, ibans), so aggregate_counterparties can run on a file directly.
+
+    Can be used as a context manager; the mapping is closed when the block ends.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Path of the export file
+
+        Raises:
+            ValueError: If the file is not a transaction export of a known version
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_length = _PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a transaction export (version {FORMAT_VERSION})")
+
+        header = json.loads(self._mmap[_PREAMBLE.size:_PREAMBLE.size + header_length])
+        data_start = _PREAMBLE.size + header_length
+        data_start += -data_start % _ALIGNMENT
+
+        self.rows = header['rows']
+        self.ibans: List[str] = header['ibans']
+        self.currencies: List[str] = header['currencies']
+        self.statuses: List[str] = header['statuses']
+
+        self._views = []
+        view = memoryview(self._mmap)
+        self._views.append(view)
+        for name, (typecode, offset, nbytes) in header['columns'].items():
+            column = view[data_start + offset:data_start + offset + nbytes]
+            if header['byteorder'] == sys.byteorder:
+                column = column.cast(typecode)
+                self._views.append(column)
+            else:
+                # Exported on a machine with the other byte order: copy and swap
+                column = array(typecode, column.tobytes())
+                column.byteswap()
+            setattr(self, name, column)
+
+    def __enter__(self) -> "TransactionFile":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def close(self) -> None:
+        """
+        Release the column views and close the mapping.
+        """
+        for view in reversed(getattr(self, '_views', [])):
+            view.release()
+        self._views = []
+        if not self._mmap.closed:
+            self._mmap.close()
+        self._file.close()
+
+    def description(self, index: int) -> str:
+        """
+        Return the description of one transaction.
+        """
+        start = self.description_offsets[index]
+        end = self.description_offsets[index + 1]
+        return bytes(self.description_data[start:end]).decode('utf-8')
+
+    def record(self, index: int) -> TransactionRecord:
+        """
+        Rebuild the transaction record at a row index.
+        A missing currency is read back as DEFAULT_CURRENCY, like in TransactionRecord.from_dict.
+        """
+        created_us = self.created[index]
+        updated_us = self.updated[index]
+        counterparty = self.counterparty[index]
+        status = self.status[index]
+        currency = self.currency[index]
+        monetary_account_id = self.monetary_account_ids[index]
+        return TransactionRecord(
+            type=TYPE_NAMES[self.types[index]],
+            id=self.ids[index],
+            created=micros_to_created(created_us),
+            created_us=created_us,
+            amount_cents=self.amounts[index],
+            currency=DEFAULT_CURRENCY if currency == NO_VALUE else self.currencies[currency],
+            description=self.description(index),
+            counterparty_iban=None if counterparty == NO_COUNTERPARTY else self.ibans[counterparty],
+            status=None if status == NO_VALUE else self.statuses[status],
+            updated=None if updated_us == NO_VALUE else micros_to_created(updated_us),
+            monetary_account_id=None if monetary_account_id == NO_VALUE else monetary_account_id
+        )
+
+    def records(self) -> List[TransactionRecord]:
+        """
+        Rebuild all transaction records, in file order.
+        """
+        return [self.record(index) for index in range(self.rows)]
+
+
+def read_transaction_file(path: str) -> List[TransactionRecord]:
+    """
+    Load all transactions of an export as TransactionRecords.
+
+    Args:
+        path: Path of the export file
+
+    Returns:
+        List of transaction records
+    """
+    with TransactionFile(path) as transaction_file:
+        return transaction_file.records()
@@ -0,0 +1,276 @@
+from array import array
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import List, Dict, Any, Iterable, Optional
+
+
+# Transaction type codes used in the 'type' column
+TYPE_PAYMENT = 0
+TYPE_REQUEST = 1
+TYPE_CODES = {'PAYMENT': TYPE_PAYMENT, 'REQUEST': TYPE_REQUEST}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# Value of the 'counterparty' column for transactions without an IBAN
+NO_COUNTERPARTY = -1
+
+# Currency of transactions that don't state one
+DEFAULT_CURRENCY = 'EUR'
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def created_to_micros(created: str) -> int:
+    """
+    Convert a bunq timestamp string into integer microseconds since the epoch.
+    The bunq timestamps carry no timezone, so they are kept naive.
+    """
+    return (datetime.fromisoformat(created) - _EPOCH) // _MICROSECOND
+
+
+def amount_to_cents(amount: Any) -> int:
+    """
+    Convert an API amount string (e.g. '-12.34') into signed integer cents.
+
+    Raises:
+        ValueError: If the amount can't be parsed
+    """
+    try:
+        return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, TypeError):
+        raise ValueError(f"Invalid amount format: {amount}")
+
+
+class TransactionRecord:
+    """
+    Compact record of one payment or request.
+
+    Uses __slots__ instead of a per-row dict. The creation time is pre-parsed
+    into integer microseconds ('created_us') so sorting needs no string
+    parsing, and the amount is stored as signed integer cents. The original
+    'created' string is kept for display and for timed replays.
+
+    Supports read-only dict-style access (record['amount'], record.get('status'))
+    so code written against the old transaction dictionaries keeps working.
+    """
+
+    __slots__ = ('type', 'id', 'created', 'created_us', 'updated', 'amount_cents',
+                 'currency', 'description', 'status', 'counterparty_iban', 'monetary_account_id')
+
+    def __init__(self, type: str, id: int, created: str, amount_cents: Optional[int], currency: str,
+                 description: str = '', counterparty_iban: Optional[str] = None, status: Optional[str] = None,
+                 updated: Optional[str] = None, monetary_account_id: Optional[int] = None,
+                 created_us: Optional[int] = None):
+        self.type = type
+        self.id = id
+        self.created = created
+        self.created_us = created_to_micros(created) if created_us is None else created_us
+        self.updated = updated
+        self.amount_cents = amount_cents
+        self.currency = currency
+        self.description = description
+        self.status = status
+        self.counterparty_iban = counterparty_iban
+        self.monetary_account_id = monetary_account_id
+
+    @property
+    def amount(self) -> Optional[str]:
+        """
+        Signed amount as an API amount string, e.g. '-12.34'.
+        """
+        if self.amount_cents is None:
+            return None
+        sign = '-' if self.amount_cents < 0 else ''
+        cents = abs(self.amount_cents)
+        return f"{sign}{cents // 100}.{cents % 100:02d}"
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in _RECORD_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in _RECORD_KEYS and getattr(self, key) is not None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key, None) if key in _RECORD_KEYS else None
+        return default if value is None else value
+
+    def __repr__(self) -> str:
+        return f"TransactionRecord({self.type} {self.id} {self.created} {self.amount} {self.currency} {self.counterparty_iban})"
+
+    @classmethod
+    def from_dict(cls, transaction: Dict[str, Any]) -> "TransactionRecord":
+        """
+        Build a record from an old-style transaction dictionary.
+        An amount that can't be parsed is stored as None.
+        """
+        try:
+            amount_cents = amount_to_cents(transaction['amount'])
+        except ValueError:
+            amount_cents = None
+        return cls(
+            type=transaction['type'],
+            id=transaction['id'],
+            created=transaction['created'],
+            amount_cents=amount_cents,
+            currency=transaction.get('currency') or DEFAULT_CURRENCY,
+            description=transaction.get('description', ''),
+            counterparty_iban=transaction.get('counterparty_iban'),
+            status=transaction.get('status'),
+            updated=transaction.get('updated'),
+            monetary_account_id=transaction.get('monetary_account_id')
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Convert the record into an old-style transaction dictionary.
+        """
+        transaction = {key: getattr(self, key) for key in _DICT_KEYS}
+        if transaction['status'] is None:
+            del transaction['status']
+        return transaction
+
+
+# Keys available through dict-style access on a TransactionRecord
+_RECORD_KEYS = frozenset(TransactionRecord.__slots__) | {'amount'}
+
+# Keys of an old-style transaction dictionary, in the order get_user_transactions used
+_DICT_KEYS = ('type', 'id', 'created', 'updated', 'amount', 'currency', 'description',
+              'status', 'counterparty_iban', 'monetary_account_id')
+
+
+def as_records(transactions: Iterable[Any]) -> List[TransactionRecord]:
+    """
+    Return the transactions as TransactionRecords, converting old-style
+    dictionaries and passing records through unchanged.
+    """
+    return [t if isinstance(t, TransactionRecord) else TransactionRecord.from_dict(t) for t in transactions]
+
+
+class TransactionTable:
+    """
+    Column-oriented table of transactions.
+
+    Numeric columns are typed arrays: transaction ids, types, creation times in
+    microseconds and amounts in cents. Counterparty IBANs are dictionary
+    encoded, so the 'counterparty' column holds an index into `ibans`
+    (NO_COUNTERPARTY if the transaction has no IBAN).
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.types = array('b')
+        self.created = array('q')
+        self.amounts = array('q')
+        self.counterparty = array('l')
+        self.ibans: List[str] = []
+        self._iban_index: Dict[str, int] = {}
+        # Ids of the records left out by from_transactions for lack of a valid amount
+        self.invalid_amounts: List[Any] = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _encode_iban(self, iban: str) -> int:
+        if not iban:
+            return NO_COUNTERPARTY
+        index = self._iban_index.get(iban)
+        if index is None:
+            index = len(self.ibans)
+            self._iban_index[iban] = index
+            self.ibans.append(iban)
+        return index
+
+    def append(self, transaction: TransactionRecord) -> None:
+        """
+        Append one transaction record.
+
+        Raises:
+            ValueError: If the record has no valid amount
+        """
+        if transaction.amount_cents is None:
+            raise ValueError(f"Invalid amount format in transaction {transaction.id}")
+        self.ids.append(int(transaction.id))
+        self.types.append(TYPE_CODES[transaction.type])
+        self.created.append(transaction.created_us)
+        self.amounts.append(transaction.amount_cents)
+        self.counterparty.append(self._encode_iban(transaction.counterparty_iban))
+
+    @classmethod
+    def from_transactions(cls, transactions: Iterable[Any]) -> "TransactionTable":
+        """
+        Build a table from transaction records (or old-style dictionaries).
+
+        Records without a valid amount are left out; their ids are listed in
+        invalid_amounts.
+        """
+        table = cls()
+        for transaction in as_records(transactions):
+            if transaction.amount_cents is None:
+                table.invalid_amounts.append(transaction.id)
+                continue
+            table.append(transaction)
+        return table
+
+
+def micros_to_created(micros: int) -> str:
+    """
+    Convert integer microseconds since the epoch back into a bunq timestamp string.
+    """
+    return (_EPOCH + timedelta(microseconds=micros)).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def aggregate_counterparties(table: TransactionTable) -> Dict[str, Any]:
+    """
+    Compute per-counterparty statistics in a single pass over the table.
+
+    For every counterparty IBAN: transaction count, signed and absolute totals
+    in cents, first and last timestamps, number of payments and requests and
+    the transaction ids (as a compact array).
+
+    Args:
+        table: Transaction table
+
+    Returns:
+        Dictionary of per-counterparty columns, indexed like table.ibans,
+        plus 'skipped': the number of transactions without an IBAN
+    """
+    size = len(table.ibans)
+    counts = [0] * size
+    signed_totals = [0] * size
+    absolute_totals = [0] * size
+    first = [None] * size
+    last = [None] * size
+    requests = [0] * size
+    transaction_ids = [array('q') for _ in range(size)]
+    skipped = 0
+
+    for transaction_id, transaction_type, created, amount, counterparty in zip(
+            table.ids, table.types, table.created, table.amounts, table.counterparty):
+        if counterparty == NO_COUNTERPARTY:
+            skipped += 1
+            continue
+
+        counts[counterparty] += 1
+        signed_totals[counterparty] += amount
+        absolute_totals[counterparty] += amount if amount >= 0 else -amount
+        requests[counterparty] += transaction_type  # TYPE_REQUEST is 1, TYPE_PAYMENT is 0
+        transaction_ids[counterparty].append(transaction_id)
+
+        if first[counterparty] is None or created < first[counterparty]:
+            first[counterparty] = created
+        if last[counterparty] is None or created > last[counterparty]:
+            last[counterparty] = created
+
+    return {
+        'count': counts,
+        'signed_total': signed_totals,
+        'absolute_total': absolute_totals,
+        'first': first,
+        'last': last,
+        'payments': [count - request_count for count, request_count in zip(counts, requests)],
+        'requests': requests,
+        'transaction_ids': transaction_ids,
+        'skipped': skipped
+    }
@@ -1,9 +1,84 @@
 import time
-import api
 from queue import Queue
 
+from history.lazy_import import lazy_import
+
+# The bunq SDK behind api is loaded when the first action runs
+api = lazy_import("api")
+
+# Side-effect classes of action types
+READ = "read"    # Only reads sandbox state
+WRITE = "write"  # Changes sandbox state
+WAIT = "wait"    # Only waits; no API calls
+
+# Most consecutive actions handed to one batch entry point
+MAX_BATCH_SIZE = 50
+
+# Interpreter maps in which the fields named by ActionHandler.depends_on are looked up
+_DEPENDENCY_MAPS = {
+    "user_id": "user_map",
+    "account_id": "account_map",
+    "counterparty_account_id": "account_map",
+}
+
+
+class ActionHandler:
+    """
+    How BunqInterpreter runs one action type.
+
+    run(interpreter, action, event_queue, action_i) runs a single action.
+    The optional batch(interpreter, indexed_actions, event_queue) runs a run of
+    consecutive actions of the type at once: it gets (action index, action)
+    pairs and returns one outcome per pair, None on success or the exception
+    that made the action fail.
+    depends_on names the action fields that must refer to users or accounts
+    created by earlier actions; they are checked before the action runs.
+    """
+
+    def __init__(self, action_type, run, success_message, error_message, side_effect=WRITE, depends_on=()):
+        self.action_type = action_type
+        self.run = run
+        self.batch = None
+        self.success_message = success_message
+        self.error_message = error_message
+        self.side_effect = side_effect
+        self.depends_on = depends_on
+
+
+# Handlers per action type, registered with action_handler() and batch_handler()
+ACTION_HANDLERS = {}
+
+
+def action_handler(action_type, success_message, error_message, side_effect=WRITE, depends_on=()):
+    """
+    Register a BunqInterpreter method as the handler of an action type.
+    A success_message of None means the handler reports its own progress.
+    """
+    def register(run):
+        ACTION_HANDLERS[action_type] = ActionHandler(action_type, run, success_message, error_message, side_effect, depends_on)
+        return run
+    return register
+
+
+def batch_handler(action_type):
+    """
+    Register a BunqInterpreter method as the batch entry point of an action type.
+    """
+    def register(batch):
+        ACTION_HANDLERS[action_type].batch = batch
+        return batch
+    return register
+
+
 class BunqInterpreter:
-    def __init__(self):
+    def __init__(self, latency_log=None, deployment_state=None):
+        # Optional scenario_estimator.LatencyLog that collects action durations
+        self.latency_log = latency_log
+        # Optional deployment_state.DeploymentState with the users and accounts of
+        # earlier deploys; they are reused instead of created again
+        self.deployment_state = deployment_state
+        # Active accounts listed per Bunq user id to verify reused accounts
+        self._listed_accounts = {}
         # Maps UI index to Bunq user id
         self.user_map = {}
         # Maps UI index to Bunq account id
@@ -12,93 +87,205 @@ class BunqInterpreter:
         self.iban_alias_for_account = {}
 
     def interpret(self, actions, event_queue):
-        for action_i, action in enumerate(actions):
-            action_type = action.get("action_type", event_queue)
-            if action_type == "CreateUserPerson":
-                try:
-                    start = time.time()
-                    self._create_user_person(action, event_queue)
-                    elapsed = time.time() - start
-                    event_queue.put({ "action_index": action_i, "type": "success", "message": f"User created successfully in {elapsed:.3f}s"})
-                except Exception as e:
-                    event_queue.put({ "action_index": action_i, "type": "error", "message": f"Error creating user: {e}" })
-            elif action_type == "LoginUserPerson":
-                try:
-                    start = time.time()
-                    self._login_user_person(action, event_queue)
-                    elapsed = time.time() - start
-                    event_queue.put({ "action_index": action_i, "type": "success", "message": f"User logged in successfully in {elapsed:.3f}s" })
-                except Exception as e:
-                    event_queue.put({ "action_index": action_i, "type": "error", "message": f"Error logging in user: {e}" })
-            elif action_type == "CreateMonetaryAccount":
-                try:
-                    start = time.time()
-                    self._create_monetary_account(action, event_queue)
-                    elapsed = time.time() - start
-                    event_queue.put({ "action_index": action_i, "type": "success", "message": f"Monetary account created successfully in {elapsed:.3f}s" })
-                except Exception as e:
-                    event_queue.put({ "action_index": action_i, "type": "error", "message": f"Error creating monetary account: {e}" })
-            elif action_type == "GetAccountOverview":
-                try:
-                    start = time.time()
-                    self._get_account_overview(action, event_queue, action_i)
-                    elapsed = time.time() - start
-                    event_queue.put({"action_index": action_i, "type": "success", "message": f"Account overview retrieved successfully in {elapsed:.3f}s"})
-                except Exception as e:
-                    event_queue.put({"action_index": action_i, "type": "error", "message": f"Error retrieving account overview: {e}"})
-            elif action_type == "MakePayment":
-                try:
-                    start = time.time()
-                    self._make_payment(action, event_queue)
-                    elapsed = time.time() - start
-                    event_queue.put({ "action_index": action_i, "type": "success", "message": f"Payment made successfully in {elapsed:.3f}s" })
-                except Exception as e:
-                    event_queue.put({ "action_index": action_i, "type": "error", "message": f"Error making payment: {e}" })
-            elif action_type == "RequestPayment":
-                try:
-                    start = time.time()
-                    self._request_payment(action, event_queue)
-                    elapsed = time.time() - start
-                    event_queue.put({ "action_index": action_i, "type": "success", "message": f"Payment request sent successfully in {elapsed:.3f}s" })
-                except Exception as e:
-                    event_queue.put({ "action_index": action_i, "type": "error", "message": f"Error sending payment request: {e}" })
-            elif action_type == "RespondToPaymentRequest":
-                try:
-                    start = time.time()
-                    self._respond_to_payment_request(action, event_queue, action_i)
-                    elapsed = time.time() - start
-                    event_queue.put({ "action_index": action_i, "type": "success", "message": f"Responded to payment request successfully in {elapsed:.3f}s" })
-                except Exception as e:
-                    event_queue.put({ "action_index": action_i, "type": "error", "message": f"Error responding to payment request: {e}" })
-            elif action_type == "Sleep":  # Let me sleep please Im so tired
-                sleep_time = action.get("seconds", 1)
-                event_queue.put({"type": "success", "message": f"Sleeping for {sleep_time} seconds"})
-                time.sleep(sleep_time)
-            else:
+        action_i = 0
+        while action_i < len(actions):
+            action_type = actions[action_i].get("action_type")
+            handler = ACTION_HANDLERS.get(action_type)
+            if handler is None:
                 event_queue.put({"action_index": action_i, "type": "error", "message": f"Unknown action type: {action_type}"})
+                action_i += 1
+                continue
+
+            # Consecutive actions of a type with a batch entry point run together
+            run_end = action_i + 1
+            if handler.batch is not None:
+                while (run_end < len(actions) and run_end - action_i < MAX_BATCH_SIZE
+                       and actions[run_end].get("action_type") == action_type):
+                    run_end += 1
+
+            if run_end - action_i > 1:
+                self._run_batch(handler, [(i, actions[i]) for i in range(action_i, run_end)], event_queue)
+            else:
+                self._run_single(handler, action_i, actions[action_i], event_queue)
+            action_i = run_end
 
+    def _check_dependencies(self, handler, action):
+        for field in handler.depends_on:
+            value = action.get(field)
+            if field == "counterparty_account_id" and str(value).lower() == "sugardaddy":
+                continue
+            if value not in getattr(self, _DEPENDENCY_MAPS[field]):
+                raise ValueError(f"{field} {value!r} doesn't refer to an earlier created {field[:-3].replace('_', ' ')}")
 
-    def _create_user_person(self, action, event_queue):
+    def _record_latency(self, handler, seconds):
+        if self.latency_log is not None and handler.side_effect != WAIT:
+            self.latency_log.record(handler.action_type, seconds)
+
+    def _run_single(self, handler, action_i, action, event_queue):
+        try:
+            start = time.time()
+            self._check_dependencies(handler, action)
+            handler.run(self, action, event_queue, action_i)
+            elapsed = time.time() - start
+        except Exception as e:
+            event_queue.put({"action_index": action_i, "type": "error", "message": f"{handler.error_message}: {e}"})
+            return
+
+        if handler.success_message:
+            event_queue.put({"action_index": action_i, "type": "success", "message": f"{handler.success_message} in {elapsed:.3f}s"})
+        self._record_latency(handler, elapsed)
+
+    def _run_batch(self, handler, indexed_actions, event_queue):
+        ready = []
+        for action_i, action in indexed_actions:
+            try:
+                self._check_dependencies(handler, action)
+                ready.append((action_i, action))
+            except Exception as e:
+                event_queue.put({"action_index": action_i, "type": "error", "message": f"{handler.error_message}: {e}"})
+        if not ready:
+            return
+
+        start = time.time()
+        try:
+            outcomes = handler.batch(self, ready, event_queue)
+        except Exception as e:
+            outcomes = [e] * len(ready)
+        elapsed = time.time() - start
+
+        for (action_i, _), outcome in zip(ready, outcomes):
+            if outcome is None:
+                event_queue.put({"action_index": action_i, "type": "success", "message": f"{handler.success_message} in {elapsed:.3f}s (batch of {len(ready)})"})
+                # Every action of the batch is charged an equal share
+                self._record_latency(handler, elapsed / len(ready))
+            else:
+                event_queue.put({"action_index": action_i, "type": "error", "message": f"{handler.error_message}: {outcome}"})
+
+    def _reused_account(self, action, user_id):
+        """
+        Return the listed account bound to the action's UI account in an earlier
+        deploy, or None if there is none or it is no longer active.
+        One account listing per user verifies all of its bound accounts.
+        """
+        bound = self.deployment_state.account(action["account_id"]) if self.deployment_state is not None else None
+        if bound is None or bound[1] != user_id:
+            return None
+        if user_id not in self._listed_accounts:
+            self._listed_accounts[user_id] = {
+                account.MonetaryAccountBank.id_: account
+                for account in api.list_monetary_accounts_for_user(user_id)
+                if account.MonetaryAccountBank is not None and account.MonetaryAccountBank.status == "ACTIVE"
+            }
+        account = self._listed_accounts[user_id].get(bound[0])
+        if account is None:
+            self.deployment_state.forget_account(action["account_id"])
+        return account
+
+    def _add_account(self, action, account_id_bunq, user_id, account):
+        self.account_map[action["account_id"]] = account_id_bunq
+        self.user_for_account[account_id_bunq] = user_id
+        self.iban_alias_for_account[account_id_bunq] = api.get_iban_alias(account)
+
+    def _reuse_account(self, action, user_id, account, event_queue, action_i):
+        account_id_bunq = account.MonetaryAccountBank.id_
+        self._add_account(action, account_id_bunq, user_id, account)
+        # Requests left pending by an earlier deploy would otherwise be answered by this one
+        rejected = api.reject_pending_payment_requests(user_id, account_id_bunq)
+        balance = account.MonetaryAccountBank.balance
+        message = f"Reusing sandbox account {account_id_bunq} for account {action['account_id']}, starting balance {balance.value} {balance.currency}"
+        if rejected:
+            message += f", rejected {len(rejected)} pending requests left by an earlier deploy"
+        event_queue.put({"action_index": action_i, "type": "log", "message": message})
+
+    @action_handler("CreateUserPerson", "User created successfully", "Error creating user")
+    def _create_user_person(self, action, event_queue, action_i):
         user_id = action.get("user_id")
-        user_id_bunq = api.create_user_and_save_context()
+        user_id_bunq = self.deployment_state.user(user_id) if self.deployment_state is not None else None
+        if user_id_bunq is not None:
+            event_queue.put({"action_index": action_i, "type": "log", "message": f"Reusing sandbox user {user_id_bunq} for user {user_id}"})
+        else:
+            user_id_bunq = api.create_user_and_save_context()
+            if self.deployment_state is not None:
+                self.deployment_state.bind_user(user_id, user_id_bunq)
         self.user_map[user_id] = user_id_bunq
-    
-    def _login_user_person(self, action, event_queue):
+
+    @action_handler("LoginUserPerson", "User logged in successfully", "Error logging in user")
+    def _login_user_person(self, action, event_queue, action_i):
         api_key = action.get("api_key")
         user_id_bunq = api.login_user_and_save_context(api_key)
         self.user_map[action["user_id"]] = user_id_bunq
 
-    def _create_monetary_account(self, action, event_queue):
+    @action_handler("CreateMonetaryAccount", "Monetary account created successfully", "Error creating monetary account",
+                    depends_on=("user_id",))
+    def _create_monetary_account(self, action, event_queue, action_i):
         user_id = self.user_map[action["user_id"]]
-        account_id = action["account_id"]
+        account = self._reused_account(action, user_id)
+        if account is not None:
+            self._reuse_account(action, user_id, account, event_queue, action_i)
+            return
+
         currency = action.get("currency", "EUR")
         account_id_bunq = api.create_monetary_account_for_user(user_id, currency)
-        self.account_map[account_id] = account_id_bunq
+        self.account_map[action["account_id"]] = account_id_bunq
         self.user_for_account[account_id_bunq] = user_id
+        if self.deployment_state is not None:
+            self.deployment_state.bind_account(action["account_id"], account_id_bunq, action["user_id"], user_id)
 
         account = api.get_account(user_id, account_id_bunq)
         self.iban_alias_for_account[account_id_bunq] = api.get_iban_alias(account)
 
+    @batch_handler("CreateMonetaryAccount")
+    def _create_monetary_accounts(self, indexed_actions, event_queue):
+        # Per user: one listing to verify reused accounts, one context load for
+        # all creations and one account listing for the IBANs of the new ones
+        outcomes = {}
+        by_user = {}
+        for action_i, action in indexed_actions:
+            by_user.setdefault(self.user_map[action["user_id"]], []).append((action_i, action))
+
+        for user_id, user_actions in by_user.items():
+            new_actions = []
+            for action_i, action in user_actions:
+                try:
+                    account = self._reused_account(action, user_id)
+                    if account is None:
+                        new_actions.append((action_i, action))
+                        continue
+                    self._reuse_account(action, user_id, account, event_queue, action_i)
+                    outcomes[action_i] = None
+                except Exception as e:
+                    outcomes[action_i] = e
+            user_actions = new_actions
+            if not user_actions:
+                continue
+
+            try:
+                created = api.create_monetary_accounts_for_user(user_id, [action.get("currency", "EUR") for _, action in user_actions])
+                listed = {
+                    account.MonetaryAccountBank.id_: account
+                    for account in api.list_monetary_accounts_for_user(user_id)
+                    if account.MonetaryAccountBank is not None
+                }
+            except Exception as e:
+                outcomes.update((action_i, e) for action_i, _ in user_actions)
+                continue
+
+            for (action_i, action), account_id_bunq in zip(user_actions, created):
+                if isinstance(account_id_bunq, Exception):
+                    outcomes[action_i] = account_id_bunq
+                    continue
+                if self.deployment_state is not None:
+                    self.deployment_state.bind_account(action["account_id"], account_id_bunq, action["user_id"], user_id)
+                try:
+                    self._add_account(action, account_id_bunq, user_id, listed[account_id_bunq])
+                    outcomes[action_i] = None
+                except Exception as e:
+                    outcomes[action_i] = e
+
+        return [outcomes[action_i] for action_i, _ in indexed_actions]
+
+    @action_handler("GetAccountOverview", "Account overview retrieved successfully", "Error retrieving account overview",
+                    side_effect=READ, depends_on=("account_id",))
     def _get_account_overview(self, action, event_queue, action_i):
         account_id = self.account_map[action["account_id"]]
         user_id = self.user_for_account[account_id]
@@ -107,7 +294,33 @@ class BunqInterpreter:
         balance = overview.MonetaryAccountBank.balance.value
         event_queue.put({ "action_index": action_i, "type": "log", "message": f"Account {action['account_id']} balance: {balance}"})
 
-    def _make_payment(self, action, event_queue):
+    @batch_handler("GetAccountOverview")
+    def _get_account_overviews(self, indexed_actions, event_queue):
+        # One account listing per user instead of one request per account
+        outcomes = {}
+        listed = {}
+        for action_i, action in indexed_actions:
+            account_id = self.account_map[action["account_id"]]
+            user_id = self.user_for_account[account_id]
+            try:
+                if user_id not in listed:
+                    listed[user_id] = {
+                        account.MonetaryAccountBank.id_: account
+                        for account in api.list_monetary_accounts_for_user(user_id)
+                        if account.MonetaryAccountBank is not None
+                    }
+                if account_id not in listed[user_id]:
+                    raise ValueError(f"Account {action['account_id']} not found")
+                balance = listed[user_id][account_id].MonetaryAccountBank.balance.value
+                event_queue.put({"action_index": action_i, "type": "log", "message": f"Account {action['account_id']} balance: {balance}"})
+                outcomes[action_i] = None
+            except Exception as e:
+                outcomes[action_i] = e
+        return [outcomes[action_i] for action_i, _ in indexed_actions]
+
+    @action_handler("MakePayment", "Payment made successfully", "Error making payment",
+                    depends_on=("account_id", "counterparty_account_id"))
+    def _make_payment(self, action, event_queue, action_i):
         account_id = self.account_map[action["account_id"]]
         user_id = self.user_for_account[account_id]
         amount_value = str(action["amount_value"])
@@ -117,7 +330,57 @@ class BunqInterpreter:
         description = action.get("description", "No description")
         api.create_payment(user_id, account_id, amount_value, amount_currency, counterparty_alias, description)
 
-    def _request_payment(self, action, event_queue):
+    @batch_handler("MakePayment")
+    def _make_payments(self, indexed_actions, event_queue):
+        # Consecutive payments from the same account go out in payment batches;
+        # a change of source account starts a new batch, so the order is kept.
+        # The payments of a failed batch are retried one by one, so only the
+        # ones that fail on their own (e.g. insufficient funds) are reported.
+        # A batch that may have been executed (PaymentBatchOutcomeUnknown) isn't
+        # retried; its payments are reported as failed.
+        groups = []
+        for action_i, action in indexed_actions:
+            account_id = self.account_map[action["account_id"]]
+            if not groups or groups[-1][0] != account_id:
+                groups.append((account_id, []))
+            groups[-1][1].append((action_i, action))
+
+        outcomes = []
+        for account_id, group in groups:
+            payments = [
+                (
+                    str(action["amount_value"]),
+                    action["amount_currency"],
+                    self.iban_alias_for_account[self.account_map[action["counterparty_account_id"]]],
+                    action.get("description", "No description"),
+                )
+                for _, action in group
+            ]
+            user_id = self.user_for_account[account_id]
+            try:
+                batch_results = api.create_payment_batch(user_id, account_id, payments)
+            except Exception as e:
+                batch_results = [e] * -(-len(payments) // api.PAYMENT_BATCH_SIZE)
+
+            for chunk, batch_result in enumerate(batch_results):
+                chunk_payments = payments[chunk * api.PAYMENT_BATCH_SIZE:(chunk + 1) * api.PAYMENT_BATCH_SIZE]
+                if not isinstance(batch_result, Exception):
+                    outcomes.extend([None] * len(chunk_payments))
+                    continue
+                if isinstance(batch_result, api.PaymentBatchOutcomeUnknown):
+                    outcomes.extend([batch_result] * len(chunk_payments))
+                    continue
+                for payment in chunk_payments:
+                    try:
+                        api.create_payment(user_id, account_id, *payment)
+                        outcomes.append(None)
+                    except Exception as e:
+                        outcomes.append(e)
+        return outcomes
+
+    @action_handler("RequestPayment", "Payment request sent successfully", "Error sending payment request",
+                    depends_on=("account_id", "counterparty_account_id"))
+    def _request_payment(self, action, event_queue, action_i):
         account_id = self.account_map[action["account_id"]]
         user_id = self.user_for_account[account_id]
         amount_value = str(action["amount_value"])
@@ -137,6 +400,8 @@ class BunqInterpreter:
         description = action.get("description", "No description")
         api.create_payment_request(user_id, account_id, amount_value, amount_currency, counterparty_alias, description)
 
+    @action_handler("RespondToPaymentRequest", "Responded to payment request successfully", "Error responding to payment request",
+                    depends_on=("account_id", "counterparty_account_id"))
     def _respond_to_payment_request(self, action, event_queue, action_i):
         account_id = self.account_map[action["account_id"]]
         user_id = self.user_for_account[account_id]
@@ -146,6 +411,20 @@ class BunqInterpreter:
         updated_requests_id = api.respond_to_payment_request(user_id, account_id, counterparty_iban_alias, status)
         event_queue.put( {"action_index": action_i, "type": "log", "message": f"Responded to  {len(updated_requests_id)} requests for the user {action['account_id']}" })
 
+    @action_handler("ListPayments", "Payments listed successfully", "Error listing payments",
+                    side_effect=READ, depends_on=("account_id",))
+    def _list_payments(self, action, event_queue, action_i):
+        account_id = self.account_map[action["account_id"]]
+        user_id = self.user_for_account[account_id]
+        payments = api.list_payments(user_id, account_id)
+        event_queue.put({"action_index": action_i, "type": "log", "message": f"Account {action['account_id']} has {len(payments)} recent payments"})
+
+    @action_handler("Sleep", None, "Error sleeping", side_effect=WAIT)
+    def _sleep(self, action, event_queue, action_i):  # Let me sleep please Im so tired
+        sleep_time = action.get("seconds", 1)
+        event_queue.put({"type": "success", "message": f"Sleeping for {sleep_time} seconds"})
+        time.sleep(sleep_time)
+
 
 def test_create_user_and_accounts():
     actions = [
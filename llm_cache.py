@@ -0,0 +1,148 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+# File with the cached LLM responses
+LLM_CACHE_FILE = "llm_cache.db"
+
+# Bounds of the cache; the least recently used responses are evicted first
+MAX_ENTRIES = 500
+MAX_BYTES = 20 * 1024 * 1024
+
+
+def prompt_key(model, system_prompt, user_prompt):
+    """
+    Cache key of a prompt: the model, a hash of the system prompt and the user prompt.
+
+    The user prompt is stripped, so answers don't depend on stray whitespace.
+    """
+    system_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+    key = json.dumps([model, system_hash, user_prompt.strip()])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    Persistent cache of LLM responses, kept in an SQLite file.
+
+    Entries are keyed by prompt_key(). Every hit updates the entry's last
+    use, and after every insert the least recently used entries are evicted
+    until the cache is within max_entries and max_bytes. The connection is
+    shared between threads, so one cache can serve all reruns of the app.
+    """
+
+    def __init__(self, path=LLM_CACHE_FILE, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, "
+            "created REAL, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+
+    def get(self, model, system_prompt, user_prompt):
+        """
+        Return the cached response to a prompt, or None.
+        """
+        key = prompt_key(model, system_prompt, user_prompt)
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, model, system_prompt, user_prompt, response):
+        """
+        Store the response to a prompt and evict entries beyond the bounds.
+        """
+        key = prompt_key(model, system_prompt, user_prompt)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode("utf-8")), now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return
+        evicted = []
+        for key, entry_size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if entries - len(evicted) <= self.max_entries and size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        """
+        :return: Dict with the number of entries, their total size and the hits and misses so far.
+        """
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"entries": entries, "bytes": size, "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+
+def offline_answer(user_prompt):
+    """
+    Local stand-in for an "Ask" answer when the LLM can't be reached.
+    """
+    return "The LLM is offline and this question hasn't been answered before, so there is no answer yet."
+
+
+def offline_actions(user_prompt):
+    """
+    Local stand-in for "Generate actions" when the LLM can't be reached.
+
+    Builds a starter scenario from the description: as many users as the
+    first number in it (2 if there is none, at most 10), each with an account
+    funded by the sugar daddy, paying each other in a ring. The result
+    passes the action schema like a generated one.
+
+    :return: List of actions.
+    """
+    match = re.search(r"\d+", user_prompt)
+    users = min(max(int(match.group()) if match else 2, 1), 10)
+    accounts = [chr(ord("A") + i) for i in range(users)]
+    expiry_date = int(time.time()) + 7200
+
+    actions = []
+    for i, account in enumerate(accounts):
+        actions.append({"action_type": "CreateUserPerson", "user_id": i + 1})
+        actions.append({"action_type": "CreateMonetaryAccount", "user_id": i + 1, "account_id": account,
+                        "currency": "EUR", "daily_limit_value": 1000})
+        actions.append({"action_type": "RequestPayment", "user_id": i + 1, "account_id": account,
+                        "amount_value": 100, "amount_currency": "EUR", "counterparty_account_id": "sugardaddy",
+                        "expiry_date": expiry_date, "request_response_id": i + 1})
+    actions.append({"action_type": "Sleep", "seconds": 5})
+    if users > 1:
+        for i, account in enumerate(accounts):
+            actions.append({"action_type": "MakePayment", "user_id": i + 1, "account_id": account,
+                            "amount_value": 10, "amount_currency": "EUR",
+                            "counterparty_account_id": accounts[(i + 1) % users]})
+    for account in accounts:
+        actions.append({"action_type": "GetAccountOverview", "account_id": account})
+    return actions
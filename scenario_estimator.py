@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import statistics
+import threading
+
+from scenario_optimizer import API_CALLS_PER_ACTION, action_accounts
+from interpret import ACTION_HANDLERS, READ
+
+# File with the measured action latencies of previous runs
+LATENCY_FILE = "latencies.json"
+
+# Assumed duration of one sandbox API call when nothing was measured yet
+DEFAULT_SECONDS_PER_CALL = 0.3
+
+# Number of recent measurements kept per action type
+MAX_SAMPLES = 100
+
+
+class LatencyLog:
+    """
+    Measured per-action latencies, kept between runs in LATENCY_FILE.
+
+    BunqInterpreter records the duration of every action it runs; the
+    estimator predicts an action's duration as the median of the recent
+    measurements of its type. Safe to record from the interpreter thread
+    while the UI reads it.
+    """
+
+    def __init__(self, path=LATENCY_FILE, samples=None):
+        self.path = path
+        self.samples = samples or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path=LATENCY_FILE):
+        """
+        Load the latency log from a file; an empty log is returned if it doesn't exist.
+        """
+        if not os.path.exists(path):
+            return cls(path)
+        try:
+            with open(path, "r") as f:
+                return cls(path, json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Error loading latencies from {path}: {e}")
+            return cls(path)
+
+    def save(self):
+        with self._lock:
+            samples = {action_type: list(values) for action_type, values in self.samples.items()}
+        with open(self.path, "w") as f:
+            json.dump(samples, f, indent=2)
+
+    def record(self, action_type, seconds):
+        """
+        Add one measured duration, keeping the most recent MAX_SAMPLES per type.
+        """
+        with self._lock:
+            values = self.samples.setdefault(action_type, [])
+            values.append(round(seconds, 4))
+            del values[:-MAX_SAMPLES]
+
+    def predict(self, action_type):
+        """
+        Predict the duration of an action type.
+
+        :return: Tuple of (seconds, True if based on measurements).
+        """
+        with self._lock:
+            values = list(self.samples.get(action_type, ()))
+        if values:
+            return statistics.median(values), True
+        return API_CALLS_PER_ACTION.get(action_type, 1) * DEFAULT_SECONDS_PER_CALL, False
+
+
+def _dependency_keys(action):
+    """
+    Return the users and accounts an action depends on, as ('user', id) / ('account', id) keys.
+    """
+    keys = {("account", account) for account in action_accounts(action)}
+    if "user_id" in action:
+        keys.add(("user", action["user_id"]))
+    return keys
+
+
+def estimate_scenario(actions, latency_log=None):
+    """
+    Estimate the cost and duration of an action list before deploying it.
+
+    Computes the sandbox API calls per action type, the total time spent in
+    Sleep actions and two wall-clock predictions: sequential execution, as
+    BunqInterpreter runs it today, and the critical path if independent
+    actions ran in parallel. For the critical path an action waits for the
+    last earlier action that changed one of its users or accounts (reads of
+    the same account don't wait for each other), and a Sleep waits for
+    everything before it and holds back everything after it.
+
+    :param actions: List of actions.
+    :param latency_log: LatencyLog with measured latencies; defaults are used without one.
+    :return: Dict with the estimate.
+    """
+    latency_log = latency_log or LatencyLog(path=None)
+    api_calls = {}
+    sleep_seconds = 0
+    sequential_seconds = 0.0
+    measured = {}
+
+    # Finish time of the last write and the latest read since then, per key
+    last_write = {}
+    last_read = {}
+    barrier = 0.0
+    critical_path_seconds = 0.0
+
+    for action in actions:
+        action_type = action.get("action_type")
+
+        if action_type == "Sleep":
+            seconds = action.get("seconds", 1)
+            sleep_seconds += seconds
+            sequential_seconds += seconds
+            barrier = critical_path_seconds + seconds
+            critical_path_seconds = barrier
+            continue
+
+        api_calls[action_type] = api_calls.get(action_type, 0) + API_CALLS_PER_ACTION.get(action_type, 0)
+        seconds, measured[action_type] = latency_log.predict(action_type)
+        sequential_seconds += seconds
+
+        keys = _dependency_keys(action)
+        handler = ACTION_HANDLERS.get(action_type)
+        is_read = handler is not None and handler.side_effect == READ
+        start = barrier
+        for key in keys:
+            start = max(start, last_write.get(key, 0.0))
+            if not is_read:
+                start = max(start, last_read.get(key, 0.0))
+        finish = start + seconds
+
+        for key in keys:
+            if is_read:
+                last_read[key] = max(last_read.get(key, 0.0), finish)
+            else:
+                last_write[key] = finish
+                last_read.pop(key, None)
+        critical_path_seconds = max(critical_path_seconds, finish)
+
+    return {
+        "actions": len(actions),
+        "api_calls": api_calls,
+        "total_api_calls": sum(api_calls.values()),
+        "sleep_seconds": sleep_seconds,
+        "sequential_seconds": sequential_seconds,
+        "critical_path_seconds": critical_path_seconds,
+        "measured_types": sorted(action_type for action_type, known in measured.items() if known),
+        "default_types": sorted(action_type for action_type, known in measured.items() if not known),
+    }
+
+
+def format_estimate(estimate):
+    """
+    Format an estimate as a short human readable text.
+    """
+    lines = [
+        f"Actions: {estimate['actions']}",
+        f"Estimated API calls: {estimate['total_api_calls']}",
+    ]
+    for action_type, calls in sorted(estimate["api_calls"].items()):
+        lines.append(f"  {action_type}: {calls}")
+    lines.append(f"Sleep time: {estimate['sleep_seconds']}s")
+    lines.append(f"Predicted duration: {estimate['sequential_seconds']:.1f}s sequential, "
+                 f"{estimate['critical_path_seconds']:.1f}s critical path with parallel execution")
+    if estimate["default_types"]:
+        lines.append(f"No measurements yet for: {', '.join(estimate['default_types'])} (default latency used)")
+    return "\n".join(lines)
+
+
+# Estimate a scenario file from the command line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate API calls and duration of a scenario")
+    parser.add_argument("scenario", help="JSON file with the list of actions")
+    parser.add_argument("--latencies", default=LATENCY_FILE, help="File with measured latencies")
+    parser.add_argument("--optimize", action="store_true", help="Estimate the optimised scenario")
+    args = parser.parse_args()
+
+    with open(args.scenario, "r") as f:
+        scenario = json.load(f)
+
+    if args.optimize:
+        from scenario_optimizer import optimize_scenario
+        scenario, _ = optimize_scenario(scenario)
+
+    print(format_estimate(estimate_scenario(scenario, LatencyLog.load(args.latencies))))
@@ -0,0 +1,217 @@
+# Estimated sandbox API calls per action as executed by BunqInterpreter.
+# Every api.py helper restores a context, and loading it lists the user's
+# monetary accounts once before the call itself.
+API_CALLS_PER_ACTION = {
+    "CreateUserPerson": 5,          # sandbox user, installation, device, session, account list
+    "LoginUserPerson": 4,           # installation, device, session, account list
+    "CreateMonetaryAccount": 4,     # create + get account for the IBAN alias
+    "GetAccountOverview": 2,
+    "MakePayment": 2,
+    "RequestPayment": 2,
+    "RespondToPaymentRequest": 3,   # list responses + at least one update
+    "ListPayments": 2,
+    "Sleep": 0,
+}
+
+
+def estimate_api_calls(actions):
+    """
+    Estimate the number of sandbox API calls needed to run an action list.
+    """
+    return sum(API_CALLS_PER_ACTION.get(action.get("action_type"), 0) for action in actions)
+
+
+def action_accounts(action):
+    """
+    Return the account ids an action reads or writes (sugar daddy excluded).
+    """
+    accounts = {action.get("account_id"), action.get("counterparty_account_id")}
+    accounts.discard(None)
+    accounts.discard("sugardaddy")
+    return {str(account) for account in accounts}
+
+
+def _merge_payment(optimized, payment, removed):
+    """
+    Merge a payment into the last earlier payment between the same two accounts,
+    as long as nothing in between touches either account. The search stops at
+    a Sleep, which may change every account, and at action types it doesn't know.
+
+    Payments in the same direction are added up; payments in opposite
+    directions are netted, and both are dropped if they cancel out.
+
+    :return: True if the payment was merged and must not be appended.
+    """
+    accounts = action_accounts(payment)
+    for index in range(len(optimized) - 1, -1, -1):
+        earlier = optimized[index]
+        earlier_type = earlier.get("action_type")
+        if earlier_type == "Sleep" or earlier_type not in API_CALLS_PER_ACTION:
+            return False
+        if not (action_accounts(earlier) & accounts):
+            continue
+        if earlier_type != "MakePayment" or action_accounts(earlier) != accounts:
+            return False
+        if earlier["amount_currency"] != payment["amount_currency"]:
+            return False
+        if earlier.get("description") != payment.get("description"):
+            return False
+
+        if earlier["account_id"] == payment["account_id"]:
+            earlier["amount_value"] = round(earlier["amount_value"] + payment["amount_value"], 2)
+            removed["merged_payments"] += 1
+            return True
+
+        # Opposite directions: keep the difference in the direction of the larger one
+        net = round(earlier["amount_value"] - payment["amount_value"], 2)
+        if net == 0:
+            del optimized[index]
+            removed["cancelled_payments"] += 2
+        elif net > 0:
+            earlier["amount_value"] = net
+            removed["cancelled_payments"] += 1
+        else:
+            optimized[index] = {**payment, "amount_value": -net}
+            removed["cancelled_payments"] += 1
+        return True
+
+    return False
+
+
+def optimize_scenario(actions):
+    """
+    Produce an equivalent, cheaper action list.
+
+    - A repeated CreateUserPerson or CreateMonetaryAccount is dropped if the
+      user or account wasn't used since it was created; the new one would be
+      identical to the existing one. An account only counts as repeated if
+      it is created again for the same user.
+    - A GetAccountOverview is dropped if its account didn't change since the
+      previous overview of that account. A Sleep counts as a change of every
+      account, and an account with a sugar daddy request may change at any
+      time, as the sandbox accepts those requests asynchronously.
+    - A MakePayment is merged into an earlier payment between the same two
+      accounts if no action in between touches either of them and no Sleep
+      or unknown action lies in between: same-direction payments are added
+      up, opposite ones are netted.
+    - Consecutive sleeps become one sleep; sleeps at the end of the plan and
+      sleeps of zero seconds are dropped.
+
+    The input list is not modified.
+
+    :param actions: List of ACTION_SCHEMA-valid actions.
+    :return: Tuple of (optimized actions, report dict from optimization_report).
+    """
+    optimized = []
+    removed = {
+        "repeated_creations": 0,
+        "duplicate_overviews": 0,
+        "merged_payments": 0,
+        "cancelled_payments": 0,
+        "merged_sleeps": 0,
+        "dead_sleeps": 0,
+    }
+
+    # Users created but not used since, accounts created but not used since (mapped to
+    # their user), accounts changed since their last overview, and accounts that may
+    # still be funded by a pending sugar daddy request
+    unused_users = set()
+    unused_accounts = {}
+    changed = set()
+    created_accounts = set()
+    pending_funding = set()
+
+    for action in actions:
+        action = dict(action)
+        action_type = action.get("action_type")
+        accounts = action_accounts(action)
+
+        if action_type == "CreateUserPerson":
+            if action["user_id"] in unused_users:
+                removed["repeated_creations"] += 1
+                continue
+            unused_users.add(action["user_id"])
+
+        elif action_type == "CreateMonetaryAccount":
+            account_id = str(action["account_id"])
+            user_id = str(action["user_id"])
+            if unused_accounts.get(account_id) == user_id:
+                removed["repeated_creations"] += 1
+                continue
+            unused_users.discard(action["user_id"])
+            unused_accounts[account_id] = user_id
+            created_accounts.add(account_id)
+            changed.add(account_id)
+
+        elif action_type == "GetAccountOverview":
+            account_id = str(action["account_id"])
+            unused_accounts.pop(account_id, None)
+            if account_id not in changed and account_id not in pending_funding:
+                removed["duplicate_overviews"] += 1
+                continue
+            changed.discard(account_id)
+
+        elif action_type == "Sleep":
+            if action.get("seconds", 1) <= 0:
+                removed["dead_sleeps"] += 1
+                continue
+            # Balances may change while sleeping, e.g. by accepted sugar daddy requests
+            changed |= created_accounts
+            if optimized and optimized[-1].get("action_type") == "Sleep":
+                optimized[-1]["seconds"] = optimized[-1].get("seconds", 1) + action.get("seconds", 1)
+                removed["merged_sleeps"] += 1
+                continue
+
+        else:
+            if "user_id" in action:
+                unused_users.discard(action["user_id"])
+            for account_id in accounts:
+                unused_accounts.pop(account_id, None)
+            changed |= accounts
+            if action_type == "RequestPayment" and str(action.get("counterparty_account_id")).lower() == "sugardaddy":
+                pending_funding |= accounts
+            if action_type == "MakePayment" and _merge_payment(optimized, action, removed):
+                continue
+
+        optimized.append(action)
+
+    # Nothing happens after trailing sleeps
+    while optimized and optimized[-1].get("action_type") == "Sleep":
+        optimized.pop()
+        removed["dead_sleeps"] += 1
+
+    return optimized, optimization_report(actions, optimized, removed)
+
+
+def optimization_report(original, optimized, removed=None):
+    """
+    Summarise what an optimisation saved.
+
+    :return: Dict with action and estimated API call counts before and after,
+             the estimated savings and the number of removals per reason.
+    """
+    api_calls_before = estimate_api_calls(original)
+    api_calls_after = estimate_api_calls(optimized)
+    return {
+        "actions_before": len(original),
+        "actions_after": len(optimized),
+        "api_calls_before": api_calls_before,
+        "api_calls_after": api_calls_after,
+        "api_calls_saved": api_calls_before - api_calls_after,
+        "removed": dict(removed or {}),
+    }
+
+
+def format_optimization_report(report):
+    """
+    Format an optimisation report as a short human readable text.
+    """
+    lines = [
+        f"Actions: {report['actions_before']} -> {report['actions_after']}",
+        f"Estimated API calls: {report['api_calls_before']} -> {report['api_calls_after']} "
+        f"({report['api_calls_saved']} saved)",
+    ]
+    for reason, count in report["removed"].items():
+        if count:
+            lines.append(f"  {reason.replace('_', ' ')}: {count}")
+    return "\n".join(lines)
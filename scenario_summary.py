@@ -0,0 +1,243 @@
+import json
+import re
+
+# Scenarios up to this many actions go into prompts verbatim
+VERBATIM_MAX_ACTIONS = 30
+
+# Longest repeated block of actions that is collapsed into one timeline line
+MAX_BLOCK_LENGTH = 3
+
+# Maximum number of actions shown in full on request
+MAX_EXPANDED_ACTIONS = 50
+
+# Action references in a question, e.g. "#12" or "#12-#40"
+_RANGE_PATTERN = re.compile(r"#(\d+)(?:\s*(?:-|–|to)\s*#?(\d+))?")
+
+
+def _signature(action):
+    """
+    Part of an action that must be equal for it to be collapsed with its neighbours.
+    Creations keep their ids, so different users or accounts are never collapsed.
+    """
+    action_type = action.get("action_type")
+    if action_type in ("CreateUserPerson", "CreateMonetaryAccount"):
+        return action_type, action.get("user_id"), action.get("account_id")
+    return (
+        action_type,
+        action.get("account_id"),
+        action.get("counterparty_account_id"),
+        action.get("status"),
+        action.get("seconds"),
+    )
+
+
+def _describe(action):
+    """
+    Short description of an action, without its amount.
+    """
+    action_type = action.get("action_type")
+    account = action.get("account_id")
+    counterparty = action.get("counterparty_account_id")
+    if action_type == "CreateUserPerson":
+        return f"CreateUserPerson u{action.get('user_id')}"
+    if action_type == "CreateMonetaryAccount":
+        return f"CreateMonetaryAccount {account} (u{action.get('user_id')})"
+    if action_type == "MakePayment":
+        return f"MakePayment {account}→{counterparty}"
+    if action_type == "RequestPayment":
+        return f"RequestPayment {account} asks {counterparty}"
+    if action_type == "RespondToPaymentRequest":
+        return f"RespondToPaymentRequest {account} {action.get('status')} from {counterparty}"
+    if action_type == "Sleep":
+        return f"Sleep {action.get('seconds', 1)}s"
+    if account is not None:
+        return f"{action_type} {account}"
+    return str(action_type)
+
+
+def _amount_totals(actions):
+    """
+    Total amount per currency of the actions that move or ask for money.
+    """
+    totals = {}
+    for action in actions:
+        if "amount_value" in action:
+            currency = action.get("amount_currency", "EUR")
+            totals[currency] = totals.get(currency, 0) + action["amount_value"]
+    return ", ".join(f"{total:.2f} {currency}" for currency, total in sorted(totals.items()))
+
+
+def _index_range(start, end):
+    return f"#{start}" if start == end else f"#{start}-#{end}"
+
+
+def encode_runs(actions):
+    """
+    Run-length encode an action list.
+
+    At every position the longest repetition of a block of up to
+    MAX_BLOCK_LENGTH actions with equal signatures is collapsed, so both
+    "100 payments A→B" and "payment, list payments, payment, ..." become one run.
+
+    :return: List of (start index, block length, repetitions).
+    """
+    signatures = [_signature(action) for action in actions]
+    runs = []
+    i = 0
+    while i < len(actions):
+        best_length, best_repetitions = 1, 1
+        for length in range(1, MAX_BLOCK_LENGTH + 1):
+            block = signatures[i:i + length]
+            if len(block) < length:
+                break
+            repetitions = 1
+            while signatures[i + repetitions * length:i + (repetitions + 1) * length] == block:
+                repetitions += 1
+            if repetitions > 1 and length * repetitions > best_length * best_repetitions:
+                best_length, best_repetitions = length, repetitions
+        runs.append((i, best_length, best_repetitions))
+        i += best_length * best_repetitions
+    return runs
+
+
+def _timeline(actions):
+    lines = []
+    for start, length, repetitions in encode_runs(actions):
+        end = start + length * repetitions - 1
+        run = actions[start:end + 1]
+        description = "; ".join(_describe(action) for action in run[:length])
+        if repetitions > 1:
+            description = f"{repetitions}× [{description}]" if length > 1 else f"{description} ×{repetitions}"
+        totals = _amount_totals(run)
+        if totals:
+            description += f", {totals}"
+        lines.append(f"{_index_range(start, end)} {description}")
+    return lines
+
+
+def _entity_tables(actions):
+    users = {}
+    accounts = {}
+    referenced = set()
+    for index, action in enumerate(actions):
+        action_type = action.get("action_type")
+        if action_type == "CreateUserPerson":
+            users.setdefault(action.get("user_id"), {"created": index, "accounts": []})
+        elif action_type == "CreateMonetaryAccount":
+            accounts[action.get("account_id")] = action
+            users.setdefault(action.get("user_id"), {"created": None, "accounts": []})["accounts"].append(action.get("account_id"))
+        for key in ("account_id", "counterparty_account_id"):
+            if action.get(key) is not None:
+                referenced.add(str(action[key]))
+
+    lines = ["Users (id: created at, accounts):"]
+    for user_id, user in users.items():
+        created = f"#{user['created']}" if user["created"] is not None else "not created"
+        lines.append(f"  u{user_id}: {created}, accounts {', '.join(map(str, user['accounts'])) or '-'}")
+    lines.append("Accounts (id: owner, currency, daily limit):")
+    for account_id, action in accounts.items():
+        lines.append(f"  {account_id}: u{action.get('user_id')}, {action.get('currency')}, {action.get('daily_limit_value')}")
+    external = sorted(referenced - {str(account_id) for account_id in accounts})
+    if external:
+        lines.append(f"Referenced but not created: {', '.join(external)}")
+    return lines
+
+
+def _flow_table(actions):
+    flows = {}
+    for action in actions:
+        action_type = action.get("action_type")
+        if action_type not in ("MakePayment", "RequestPayment", "RespondToPaymentRequest"):
+            continue
+        pair = (action.get("account_id"), action.get("counterparty_account_id"))
+        flow = flows.setdefault(pair, {"payments": [], "requests": [], "responses": {}})
+        if action_type == "MakePayment":
+            flow["payments"].append(action)
+        elif action_type == "RequestPayment":
+            flow["requests"].append(action)
+        else:
+            status = action.get("status")
+            flow["responses"][status] = flow["responses"].get(status, 0) + 1
+
+    lines = ["Flows per account pair (from→to):"]
+    for (account, counterparty), flow in flows.items():
+        parts = []
+        if flow["payments"]:
+            parts.append(f"{len(flow['payments'])} payments {_amount_totals(flow['payments'])}")
+        if flow["requests"]:
+            parts.append(f"{len(flow['requests'])} requests {_amount_totals(flow['requests'])}")
+        if flow["responses"]:
+            parts.append("responses " + ", ".join(f"{count} {status}" for status, count in flow["responses"].items()))
+        lines.append(f"  {account}→{counterparty}: {'; '.join(parts)}")
+    return lines
+
+
+def expand_actions(actions, ranges, limit=MAX_EXPANDED_ACTIONS):
+    """
+    Show the actions of some index ranges in full, one JSON object per line.
+
+    :param ranges: List of (start, end) index ranges, both inclusive.
+    :param limit: Maximum number of actions shown.
+    :return: List of lines.
+    """
+    lines = []
+    shown = set()
+    for start, end in ranges:
+        for index in range(max(start, 0), min(end, len(actions) - 1) + 1):
+            if index in shown:
+                continue
+            if len(shown) == limit:
+                lines.append(f"(stopped after {limit} actions)")
+                return lines
+            shown.add(index)
+            lines.append(f"#{index} {json.dumps(actions[index])}")
+    return lines
+
+
+def expansion_ranges(text):
+    """
+    Find the action references ("#12", "#12-#40") in a question.
+
+    :return: List of (start, end) index ranges.
+    """
+    ranges = []
+    for match in _RANGE_PATTERN.finditer(text):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else start
+        ranges.append((min(start, end), max(start, end)))
+    return ranges
+
+
+def summarize_scenario(actions, expand=None):
+    """
+    Compact text summary of an action list for LLM prompts.
+
+    Contains the users and accounts, the payments, requests and responses
+    aggregated per account pair, and a run-length encoded timeline with
+    action indexes. The actions in the expand ranges are added in full.
+
+    :param actions: List of actions.
+    :param expand: Optional list of (start, end) index ranges to show in full.
+    :return: Summary text.
+    """
+    lines = [f"{len(actions)} actions."]
+    lines += _entity_tables(actions)
+    lines += _flow_table(actions)
+    lines.append("Timeline (action indexes, repeated runs collapsed):")
+    lines += [f"  {line}" for line in _timeline(actions)]
+    if expand:
+        lines.append("Expanded actions:")
+        lines += [f"  {line}" for line in expand_actions(actions, expand)]
+    return "\n".join(lines)
+
+
+def scenario_context(actions, question=""):
+    """
+    Scenario description to embed in a prompt about the given question.
+
+    Small scenarios are embedded as JSON. Larger ones are summarised, with
+    the actions the question refers to (e.g. "#12-#40") shown in full.
+    """
+    if len(actions) <= VERBATIM_MAX_ACTIONS:
+        return json.dumps(actions, indent=2)
+    return summarize_scenario(actions, expansion_ranges(question))
@@ -5,7 +5,12 @@ import streamlit as st
 from streamlit_agraph import agraph, Node, Edge, Config
 import json
 from datetime import datetime
-from openai import OpenAI
+
+from action_stream import ActionStreamParser
+from history.lazy_import import lazy_import
+
+# The OpenAI client is only needed once the LLM is asked something
+OpenAI = lazy_import("openai", "OpenAI")
 
 # -----------------------------------------------------------------------------
 # 1.  Session-state helpers
@@ -704,37 +709,61 @@ st.json(st.session_state.actions)
 # -----------------------------------------------------------------------------
 st.markdown("## 🤖 Ask the LLM **or** generate new actions")
 
+LLM_MODEL = "qwen/qwq-32b"
+
+# Answers and validated action lists are cached between runs (see llm_cache.py)
+if "llm_cache" not in st.session_state:
+    from llm_cache import LLMCache
+    st.session_state.llm_cache = LLMCache()
+llm_cache = st.session_state.llm_cache
+
 with st.form("ai_tools_form"):
     ai_query = st.text_area("Describe what you need (question or flow specification)")
+    offline = st.checkbox("Offline (cached answers and local stub only)")
     col_ask, col_gen = st.columns(2)
     ask_clicked  = col_ask.form_submit_button("📤 Ask LLM")
     gen_clicked  = col_gen.form_submit_button("✨ Generate actions")
 
+cache_stats = llm_cache.stats()
+st.caption(f"LLM cache: {cache_stats['entries']} responses, {cache_stats['hits']} hits this session")
+
 if ask_clicked and ai_query.strip():
     try:
-        client = OpenAI(
-            base_url="https://integrate.api.nvidia.com/v1",
-            api_key="KEY",
-        )
+        # Large scenarios are summarised; "#12-#40" in the question shows those actions in full
+        from scenario_summary import scenario_context
         system_prompt = (
             "You are an expert Bunq-sandbox assistant.\n"
             "Here is the current action sequence:\n\n"
-            f"{json.dumps(st.session_state.actions, indent=2)}\n\n"
+            f"{scenario_context(st.session_state.actions, ai_query)}\n\n"
+            "Actions are numbered from #0. If you need the details of a summarised "
+            "range, ask the user to mention it, e.g. #12-#40.\n"
             "Answer the user's question briefly."
         )
-        resp = client.chat.completions.create(
-            model="qwen/qwq-32b",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user",   "content": ai_query},
-            ],
-            temperature=0.5,
-            top_p=0.7,
-            max_tokens=1024,
-        )
-        answer = resp.choices[0].message.content
-        if "</think>" in answer:
-            answer = answer.split("</think>")[1]
+        answer = llm_cache.get(LLM_MODEL, system_prompt, ai_query)
+        if answer is not None:
+            st.caption("⚡ Cached answer")
+        elif offline:
+            from llm_cache import offline_answer
+            answer = offline_answer(ai_query)
+        else:
+            client = OpenAI(
+                base_url="https://integrate.api.nvidia.com/v1",
+                api_key="KEY",
+            )
+            resp = client.chat.completions.create(
+                model=LLM_MODEL,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user",   "content": ai_query},
+                ],
+                temperature=0.5,
+                top_p=0.7,
+                max_tokens=1024,
+            )
+            answer = resp.choices[0].message.content
+            if "</think>" in answer:
+                answer = answer.split("</think>")[1]
+            llm_cache.put(LLM_MODEL, system_prompt, ai_query, answer)
         st.success("LLM answer:")
         st.markdown(answer)
 
@@ -798,63 +827,127 @@ elif gen_clicked and ai_query.strip():
     1. Think silently how to satisfy the request and build a VALID sequence.  
     2. Respond **only** with the JSON array that passes the schema above.  
     """)
-    try:
-        client = OpenAI(
-            base_url="https://integrate.api.nvidia.com/v1",
-            api_key="KEY",
-        )
-        resp = client.chat.completions.create(
-            model="qwen/qwq-32b",
-            messages=[
-                {"role": "system", "content": gen_system_prompt},
-                {"role": "user",   "content": ai_query},
-            ],
-            temperature=0.3,
-            top_p=0.7,
-            max_tokens=30960 ,
-        )
-        raw = resp.choices[0].message.content
-        if "</think>" in raw:
-            raw = raw.split("</think>")[1]
-
-        candidate = json.loads(raw)
-        if isinstance(candidate, dict):
-            candidate = [candidate]
+    # Graph state before generating, restored if the output turns out invalid
+    snapshot = {
+        key: list(st.session_state[key])
+        for key in ("actions", "nodes", "edges", "user_ids", "account_ids", "request_ids")
+    }
+    snapshot["last_id"] = st.session_state.last_id
 
-        # --- strict validation ---
-        for a in candidate:
-            validate_action_schema(a)
+    parser = ActionStreamParser()
+    stream = None
+    try:
+        cached = llm_cache.get(LLM_MODEL, gen_system_prompt, ai_query)
+        if cached is not None:
+            st.caption("⚡ Cached actions")
+            chunks = [cached]
+        elif offline:
+            from llm_cache import offline_actions
+            chunks = [json.dumps(offline_actions(ai_query))]
+        else:
+            client = OpenAI(
+                base_url="https://integrate.api.nvidia.com/v1",
+                api_key="KEY",
+            )
+            stream = client.chat.completions.create(
+                model=LLM_MODEL,
+                messages=[
+                    {"role": "system", "content": gen_system_prompt},
+                    {"role": "user",   "content": ai_query},
+                ],
+                temperature=0.3,
+                top_p=0.7,
+                max_tokens=30960 ,
+                stream=True,
+            )
+            chunks = (chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+
+        # --- validate and add every action as soon as its object is complete ---
+        progress = st.empty()
+        validated = []
+        for chunk in chunks:
+            for a in parser.feed(chunk):
+                validate_action_schema(a)
+                validated.append(dict(a))
+                add_action_to_sequence(a)
+                progress.info(f"⏳ {len(validated)} actions added, last: {a['action_type']}")
+            if parser.done:
+                break
+        parser.close()
 
-        # --- everything OK → add to graph ---
-        for a in candidate:
-            add_action_to_sequence(a)
+        # --- only validated action lists are cached ---
+        if cached is None and not offline:
+            llm_cache.put(LLM_MODEL, gen_system_prompt, ai_query, json.dumps(validated))
 
         st.success("✅ Actions generated & added to graph!")
         st.rerun()
 
     except (json.JSONDecodeError, ValueError) as e:
+        # Drop the actions added before the bad one
+        for key, value in snapshot.items():
+            st.session_state[key] = value
         # Print a full traceback and raw LLM payload to the server console for debugging
         import traceback
         print("❗️Error validating LLM-generated actions:")
         traceback.print_exc()
-        print("Raw LLM output:", raw)
+        print("Raw LLM output:", parser.buffer)
         # Still show a concise error in the Streamlit UI
         st.error(f"⚠️ Invalid output from LLM:\n\n{e}")
     except Exception as e:
+        for key, value in snapshot.items():
+            st.session_state[key] = value
         st.error(f"Error generating actions: {e}")
+    finally:
+        # Stop generation early, e.g. after the first schema violation
+        if stream is not None:
+            stream.close()
 
-def deploy(actions: list[dict]):
+def format_deploy_event(event: dict, actions: list[dict]) -> str:
+    """
+    One debug log line for an interpreter event, naming the executed action
+    its action_index refers to.
+    """
+    index = event.get("action_index")
+    action = actions[index] if isinstance(index, int) and 0 <= index < len(actions) else {}
+    return f"#{index} {action.get('action_type', '?')} [{event.get('type')}] {event.get('message')}"
+
+
+def deploy(actions: list[dict], optimize: bool = True, reuse: bool = True):
     """
     Start the interpreter in a background thread, stream its log messages,
     and display them in the Streamlit app.
+    With optimize, the action list is first replaced by an equivalent,
+    cheaper plan and the estimated savings are shown, together with the
+    optimised list that the log lines refer to.
+    With reuse, the sandbox users and accounts of earlier deploys of the
+    scenario are used instead of new ones.
     """
     import queue
     import threading
     # TODO: adjust this import to point at your actual interpreter
     from interpret import BunqInterpreter
+    from scenario_optimizer import optimize_scenario, format_optimization_report
+    from scenario_estimator import LatencyLog
+    from deployment_state import DeploymentState
+
+    # Keyed on the scenario as designed: the state is loaded before optimising, so
+    # deploys with and without optimisation bind to the same sandbox users
+    deployment_state = DeploymentState.load(actions)
+    if not reuse:
+        deployment_state.clear()
+    elif deployment_state.users:
+        st.sidebar.info(f"♻️ Reusing {len(deployment_state.users)} users and {len(deployment_state.accounts)} accounts of an earlier deploy")
+
+    if optimize:
+        actions, report = optimize_scenario(actions)
+        st.sidebar.info("⚡ Optimised scenario\n\n" + format_optimization_report(report).replace("\n", "  \n"))
+        # The log's action indexes refer to this list, not to the designed one
+        with st.sidebar.expander("Executed (optimised) actions"):
+            st.json(actions)
 
     msg_queue = queue.Queue()
-    interpreter = BunqInterpreter()
+    latency_log = LatencyLog.load()
+    interpreter = BunqInterpreter(latency_log=latency_log, deployment_state=deployment_state)
     thread = threading.Thread(
         target=lambda: interpreter.interpret(actions, msg_queue),
         daemon=True,
@@ -867,19 +960,43 @@ def deploy(actions: list[dict]):
     st.sidebar.info("🔄 Interpreter started…")
 
     # pull messages from the queue and append to the sidebar text_area
-    while True:
-        try:
-            msg = msg_queue.get(timeout=0.5)
-            logs.append(msg)
-            log_placeholder.text_area("🛠️ Debug log", "\n".join(logs), height=300)
-        except queue.Empty:
-            if not thread.is_alive():
-                break
-
+    try:
+        while True:
+            try:
+                msg = msg_queue.get(timeout=0.5)
+                logs.append(msg)
+                log_placeholder.text_area("🛠️ Debug log", "\n".join(format_deploy_event(event, actions) for event in logs), height=300)
+            except queue.Empty:
+                if not thread.is_alive():
+                    break
+    finally:
+        # Keep the measured latencies for future estimates, even if rendering the log fails
+        latency_log.save()
     st.sidebar.success("✅ Interpreter finished processing actions!")
 
+optimize_before_deploy = st.checkbox("Optimise scenario before deploying", value=True)
+reuse_sandbox_users = st.checkbox("Reuse the sandbox users and accounts of earlier deploys", value=True,
+                                  help="Unchecked, every user and account is created again and the old ones are forgotten.")
+
+with st.expander("⏱️ Estimated cost and duration"):
+    from scenario_optimizer import optimize_scenario
+    from scenario_estimator import LatencyLog, estimate_scenario
+
+    planned_actions = st.session_state.actions
+    if optimize_before_deploy:
+        planned_actions, _ = optimize_scenario(planned_actions)
+    estimate = estimate_scenario(planned_actions, LatencyLog.load())
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric("API calls", estimate["total_api_calls"])
+    col2.metric("Sequential", f"{estimate['sequential_seconds']:.1f}s")
+    col3.metric("Critical path", f"{estimate['critical_path_seconds']:.1f}s")
+    st.caption(f"Includes {estimate['sleep_seconds']}s of Sleep actions. "
+               "Durations use measured latencies of previous runs where available.")
+    if estimate["api_calls"]:
+        st.table({"API calls": estimate["api_calls"]})
 if st.button("Deploy ▶︎"):
-    deploy(st.session_state.actions)
+    deploy(st.session_state.actions, optimize=optimize_before_deploy, reuse=reuse_sandbox_users)
 
 # -----------------------------------------------------------------------------
 # 5.  Tiny footer
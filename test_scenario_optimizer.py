@@ -0,0 +1,44 @@
+from scenario_optimizer import optimize_scenario
+
+
+def _payment(account_id, counterparty_account_id, amount_value):
+    return {
+        "action_type": "MakePayment",
+        "account_id": account_id,
+        "counterparty_account_id": counterparty_account_id,
+        "amount_value": amount_value,
+        "amount_currency": "EUR",
+        "description": "test",
+    }
+
+
+def test_payments_are_not_merged_across_a_sleep():
+    actions = [
+        {"action_type": "RequestPayment", "account_id": "A", "counterparty_account_id": "sugardaddy",
+         "amount_value": 100, "amount_currency": "EUR", "description": "funding"},
+        _payment("A", "B", 10),
+        {"action_type": "Sleep", "seconds": 10},
+        _payment("A", "B", 50),
+    ]
+    optimized, report = optimize_scenario(actions)
+    assert optimized == actions
+    assert report["removed"]["merged_payments"] == 0
+
+
+def test_payments_are_not_netted_across_a_sleep():
+    actions = [_payment("B", "A", 10), {"action_type": "Sleep", "seconds": 10}, _payment("A", "B", 10)]
+    optimized, report = optimize_scenario(actions)
+    assert optimized == actions
+    assert report["removed"]["cancelled_payments"] == 0
+
+
+def test_payments_are_not_merged_across_an_unknown_action():
+    actions = [_payment("A", "B", 10), {"action_type": "Unknown"}, _payment("A", "B", 50)]
+    optimized, _ = optimize_scenario(actions)
+    assert optimized == actions
+
+
+def test_adjacent_payments_are_still_merged():
+    optimized, report = optimize_scenario([_payment("A", "B", 10), _payment("A", "B", 50)])
+    assert [action["amount_value"] for action in optimized] == [60]
+    assert report["removed"]["merged_payments"] == 1